@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+import typing
+from typing import Annotated
+
+import discord
+from fastapi import Depends, HTTPException, status
+
+from spanner.bot import CustomBridgeBot, bot as __bot
+from spanner.share.database import DiscordOauthUser
+
+from .routes.oauth2 import is_logged_in
+
+__all__ = ("bot_is_ready", "GuildAccess", "MemberCache", "member_cache", "can_manage_guild")
+log = logging.getLogger(__name__)
+
+
+def _bot_is_ready_callback() -> CustomBridgeBot:
+    if not __bot.is_ready():
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail="Bot is not ready.")
+    return __bot
+
+
+bot_is_ready = Depends(_bot_is_ready_callback)
+
+
+class GuildAccess(typing.NamedTuple):
+    """The guild a request is for, and the logged-in user's member object and permissions in it."""
+
+    guild: discord.Guild
+    member: discord.Member
+    permissions: discord.Permissions
+
+
+class MemberCache:
+    """
+    Caches members that had to be fetched over the REST API, keyed by (guild_id, user_id), for `ttl` seconds.
+
+    Members that are in the bot's own member cache are always used directly instead, as they are kept up to date by
+    the gateway. Concurrent lookups of the same member (e.g. the dashboard's burst of requests on load) share one
+    fetch. Members that are not in the guild are cached too, as None.
+
+    Cached members are invalidated by member and role updates, see the listeners at the bottom of this module. Updates
+    to members the bot has not cached are not dispatched, so these are picked up once the entry goes stale.
+
+    :param ttl: How long a fetched member is reused for.
+    :param capacity: How many members may be cached before expired entries are cleared out.
+    """
+
+    def __init__(self, *, ttl: float = 30.0, capacity: int = 4096):
+        self.ttl = ttl
+        self.capacity = capacity
+        # guild ID -> user ID -> (member, monotonic time the entry goes stale)
+        self._entries: dict[int, dict[int, tuple[discord.Member | None, float]]] = {}
+        self._pending: dict[tuple[int, int], asyncio.Future[discord.Member | None]] = {}
+        self._generations: dict[int, int] = {}
+
+        self.gateway_hits = 0
+        self.hits = 0
+        self.fetches = 0
+        self.shared_fetches = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return "<MemberCache entries={0} fetches={1.fetches}>".format(len(self), self)
+
+    def __len__(self):
+        return sum(map(len, self._entries.values()))
+
+    def _store(self, guild_id: int, user_id: int, member: discord.Member | None) -> None:
+        if len(self) >= self.capacity:
+            now = time.monotonic()
+            for guild_entries in self._entries.values():
+                for stale in [key for key, (_, expires) in guild_entries.items() if expires <= now]:
+                    del guild_entries[stale]
+            self._entries = {guild: entries for guild, entries in self._entries.items() if entries}
+            if len(self) >= self.capacity:
+                self._entries.clear()
+        self._entries.setdefault(guild_id, {})[user_id] = (member, time.monotonic() + self.ttl)
+
+    async def _fetch(self, guild: discord.Guild, user_id: int) -> discord.Member | None:
+        generation = self._generations.get(guild.id, 0)
+        self.fetches += 1
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        # Not cached if it was invalidated while being fetched, as it may already be out of date.
+        if self._generations.get(guild.id, 0) == generation:
+            self._store(guild.id, user_id, member)
+        return member
+
+    async def get(self, guild: discord.Guild, user_id: int) -> discord.Member | None:
+        """Returns a member of the guild, or None if the user is not in it."""
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.gateway_hits += 1
+            return member
+
+        cached = self._entries.get(guild.id, {}).get(user_id)
+        if cached is not None and cached[1] > time.monotonic():
+            self.hits += 1
+            return cached[0]
+
+        key = (guild.id, user_id)
+        future = self._pending.get(key)
+        if future is not None:
+            self.shared_fetches += 1
+            return await asyncio.shield(future)
+        future = self._pending[key] = asyncio.ensure_future(self._fetch(guild, user_id))
+        future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded, so one request being cancelled does not cancel the fetch for the others.
+        return await asyncio.shield(future)
+
+    def invalidate(self, guild_id: int, user_id: int | None = None) -> None:
+        """
+        Invalidates cached members.
+
+        :param guild_id: The guild ID
+        :param user_id: The member to invalidate. If omitted, every member of the guild is invalidated (e.g. when a
+        role's permissions change).
+        """
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        self.invalidations += 1
+        if user_id is None:
+            self._entries.pop(guild_id, None)
+        else:
+            self._entries.get(guild_id, {}).pop(user_id, None)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self),
+            "gateway_hits": self.gateway_hits,
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "shared_fetches": self.shared_fetches,
+            "invalidations": self.invalidations,
+        }
+
+
+member_cache = MemberCache()
+
+
+async def _can_manage_guild_callback(
+    guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], bot: Annotated[CustomBridgeBot, bot_is_ready]
+) -> GuildAccess:
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
+
+    member = await member_cache.get(guild, user.user_id)
+    if not member:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
+    permissions = member.guild_permissions
+    if not permissions.manage_guild:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
+    return GuildAccess(guild, member, permissions)
+
+
+can_manage_guild = Depends(_can_manage_guild_callback)
+"""Resolves the requested guild, and checks that the logged-in user can manage it."""
+
+
+async def _on_member_update(_before: discord.Member, after: discord.Member) -> None:
+    member_cache.invalidate(after.guild.id, after.id)
+
+
+async def _on_member_remove(member: discord.Member) -> None:
+    member_cache.invalidate(member.guild.id, member.id)
+
+
+async def _on_guild_role_update(_before: discord.Role, after: discord.Role) -> None:
+    member_cache.invalidate(after.guild.id)
+
+
+async def _on_guild_role_delete(role: discord.Role) -> None:
+    member_cache.invalidate(role.guild.id)
+
+
+async def _on_guild_update(_before: discord.Guild, after: discord.Guild) -> None:
+    # The owner may have changed.
+    member_cache.invalidate(after.id)
+
+
+async def _on_guild_remove(guild: discord.Guild) -> None:
+    member_cache.invalidate(guild.id)
+
+
+__bot.add_listener(_on_member_update, "on_member_update")
+__bot.add_listener(_on_member_remove, "on_member_remove")
+__bot.add_listener(_on_guild_role_update, "on_guild_role_update")
+__bot.add_listener(_on_guild_role_delete, "on_guild_role_delete")
+__bot.add_listener(_on_guild_update, "on_guild_update")
+__bot.add_listener(_on_guild_remove, "on_guild_remove")
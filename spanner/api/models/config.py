@@ -1,4 +1,3 @@
-
 from pydantic import BaseModel
 
 from spanner.share.database import GuildAuditLogEntryPydantic
@@ -9,12 +8,15 @@ __all__ = ("GuildAuditLogEntryResponse", "NicknameModerationUpdateBody")
 class GuildAuditLogEntryResponse(BaseModel):
     entries: list[GuildAuditLogEntryPydantic]
     """All of the found entries that matched the given criteria."""
-    total: int
+    total: int | None = None
     """The total number of entries that matched the given query.
     
-    This is not how many were returned, but how many you can get out of pagination."""
+    This is not how many were returned, but how many you can get out of pagination.
+    This is `null` if the total was not requested (`with_total=false`)."""
     offset: int = 0
     """The offset of the query."""
+    next_cursor: str | None = None
+    """Pass this as `cursor` to get the next page of entries. `null` if this is the last page."""
 
 
 class NicknameModerationUpdateBody(BaseModel):
@@ -123,21 +123,34 @@ class ChannelInformation(BaseModel):
     flags: int = 0
 
     @classmethod
-    def from_channel(cls, channel: discord.abc.GuildChannel):
-        """Creates a BasicChannelInformation object from a discord.abc.GuildChannel object."""
+    def from_channel(
+        cls,
+        channel: discord.abc.GuildChannel,
+        *,
+        user_permissions: discord.Permissions | None = None,
+        bot_permissions: discord.Permissions | None = None,
+    ):
+        """
+        Creates a BasicChannelInformation object from a discord.abc.GuildChannel object.
+
+        `user_permissions` and `bot_permissions` can be passed if they have already been worked out. If omitted, both
+        are the bot's permissions.
+        """
         extra = {}
         if hasattr(channel, "topic"):
             extra["topic"] = channel.topic
         if hasattr(channel, "is_nsfw"):
             extra["nsfw"] = channel.is_nsfw()
+        if bot_permissions is None:
+            bot_permissions = channel.permissions_for(channel.guild.me)
         return cls(
             id=str(channel.id),
             type=channel.type.value,
             guild_id=str(channel.guild.id),
             position=channel.position,
             name=channel.name,
-            user_permissions=str(channel.permissions_for(channel.guild.me).value),
-            bot_permissions=str(channel.permissions_for(channel.guild.me).value),
+            user_permissions=str((user_permissions or bot_permissions).value),
+            bot_permissions=str(bot_permissions.value),
             flags=channel.flags.value,
             **extra,
         )
@@ -1,6 +1,23 @@
+import collections
+import heapq
+import math
 import time
+import typing
 
-__all__ = ("Bucket", "Ratelimiter")
+import orjson
+from fastapi import HTTPException, status
+from starlette.routing import compile_path
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+__all__ = (
+    "Bucket",
+    "Ratelimiter",
+    "ratelimiter",
+    "RatelimitPolicy",
+    "RatelimitMiddleware",
+    "client_key",
+    "authorization_key",
+)
 
 
 class Bucket:
@@ -16,6 +33,8 @@ class Bucket:
     # """For internal ratelimiting, the time window in seconds"""
     # external_key: str | None = None
     # """The key to use when ratelimiting against an external service"""
+    # tat: float | None = None
+    # """For internal ratelimiting, the theoretical arrival time of the next request (see Ratelimiter.hit)"""
 
     def __init__(
         self,
@@ -32,6 +51,10 @@ class Bucket:
         self.reset = reset
         self.window = window
         self.external_key = external_key
+        self.tat: float | None = None
+
+    def __repr__(self):
+        return "<Bucket key={0.key!r} limit={0.limit} remaining={0.remaining} reset={0.reset}>".format(self)
 
     @property
     def reset_after(self) -> float:
@@ -43,10 +66,16 @@ class Bucket:
         """Whether the bucket is exhausted, and another request would throw a 429"""
         return self.remaining <= 0 < self.reset_after
 
+    @property
+    def expires(self) -> float:
+        """The unix timestamp after which this bucket is no different to having no bucket at all"""
+        return self.reset if self.tat is None else self.tat
+
     def renew(self):
         """Renew the bucket, setting the remaining requests to the limit"""
         self.remaining = self.limit
         self.reset = time.time() + self.window
+        self.tat = None
 
     def renew_if_not_expired(self):
         """Renew the bucket if it is not expired"""
@@ -60,9 +89,9 @@ class Bucket:
         return {
             "X-Ratelimit-Bucket": self.key,
             "X-Ratelimit-Limit": str(self.limit),
-            "X-Ratelimit-Remaining": str(self.remaining),
+            "X-Ratelimit-Remaining": str(max(0, self.remaining)),
             "X-Ratelimit-Reset": str(self.reset),
-            "Retry-After": str(self.reset_after),
+            "Retry-After": str(max(0.0, self.reset_after)),
         }
 
     @classmethod
@@ -78,23 +107,263 @@ class Bucket:
 
 
 class Ratelimiter:
+    """
+    Keeps track of ratelimit buckets, both our own (see :meth:`hit`) and discord's (see :meth:`from_discord_headers`).
+
+    Buckets can be looked up by their key, or by discord's bucket ID (their external key), in O(1).
+    Buckets are removed once they have expired (i.e. once they are full again), by a heap-ordered sweep that runs
+    as buckets are used, so one-off clients do not keep their buckets around forever.
+    """
+
     def __init__(self):
         self.buckets: dict[str, Bucket] = {}
+        self._external: dict[str, str] = {}
+        # (expiry, key) - at most one entry per bucket. Entries are re-queued if their bucket was extended meanwhile.
+        self._expiry: list[tuple[float, str]] = []
+        self._scheduled: set[str] = set()
+
+        self.hits = 0
+        self.expired = 0
+        self.rejections: collections.Counter[str] = collections.Counter()
 
     def __repr__(self):
-        return f"<Ratelimiter buckets={self.buckets}>"
+        return "<Ratelimiter buckets={0}>".format(len(self.buckets))
+
+    def _sweep(self, now: float) -> None:
+        while self._expiry and self._expiry[0][0] <= now:
+            _, key = heapq.heappop(self._expiry)
+            bucket = self.buckets.get(key)
+            if bucket is not None and bucket.expires > now:
+                heapq.heappush(self._expiry, (bucket.expires, key))
+                continue
+            self._scheduled.discard(key)
+            if bucket is not None:
+                self._remove(bucket)
+                self.expired += 1
+
+    def _remove(self, bucket: Bucket) -> None:
+        del self.buckets[bucket.key]
+        if bucket.external_key is not None and self._external.get(bucket.external_key) == bucket.key:
+            del self._external[bucket.external_key]
+
+    def _store(self, bucket: Bucket) -> None:
+        old = self.buckets.get(bucket.key)
+        if old is not None and old is not bucket and old.external_key != bucket.external_key:
+            if old.external_key is not None and self._external.get(old.external_key) == old.key:
+                del self._external[old.external_key]
+        self.buckets[bucket.key] = bucket
+        if bucket.external_key is not None:
+            self._external[bucket.external_key] = bucket.key
+        if bucket.key not in self._scheduled:
+            self._scheduled.add(bucket.key)
+            heapq.heappush(self._expiry, (bucket.expires, bucket.key))
 
     def get_bucket(self, key: str) -> Bucket | None:
-        """Get the bucket for a given key"""
-        b = self.buckets.get(key)
-        if b:
-            return b
-        for bucket in self.buckets.values():
-            if bucket.external_key == key:
-                return bucket
+        """Get the bucket for a given key, or external key"""
+        self._sweep(time.time())
+        bucket = self.buckets.get(key)
+        if bucket is None and key in self._external:
+            bucket = self.buckets.get(self._external[key])
+        return bucket
+
+    def hit(self, key: str, *, limit: int, window: float) -> tuple[bool, Bucket]:
+        """
+        Counts a request against an internal bucket, allowing `limit` requests per `window` seconds.
+
+        This is the generic cell rate algorithm: a token-bucket that refills one request every `window / limit`
+        seconds, rather than all at once at the end of a fixed window, so clients cannot burst twice the limit across
+        a window boundary.
+
+        :return: Whether the request is allowed, and the bucket (whose headers describe the client's current state).
+        """
+        now = time.time()
+        self._sweep(now)
+        self.hits += 1
+        interval = window / limit
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.tat is None:
+            bucket = Bucket(key, limit, limit, now, window)
+            bucket.tat = now
+        bucket.limit, bucket.window = limit, window
+
+        tat = max(bucket.tat, now) + interval
+        allowed = tat - window <= now
+        if allowed:
+            bucket.tat = tat
+            bucket.remaining = math.floor((window - (tat - now)) / interval + 1e-9)
+        else:
+            bucket.remaining = 0
+        # With nothing left, the reset is when the next request is allowed. Otherwise, when the bucket is full again.
+        bucket.reset = bucket.tat - window + interval if bucket.remaining <= 0 else bucket.tat
+        self._store(bucket)
+        return allowed, bucket
 
     def from_discord_headers(self, headers: dict[str, str], *, key: str):
         """Create a bucket from a set of headers"""
+        self._sweep(time.time())
         bucket = Bucket.from_discord_headers(headers, key=key)
-        self.buckets[bucket.key] = bucket
+        self._store(bucket)
         return bucket
+
+    def exceeded(self, bucket: Bucket, *, source: str, detail: str) -> HTTPException:
+        """Counts a rejection, and creates the 429 exception to raise for it."""
+        self.rejections[source] += 1
+        return HTTPException(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"X-Ratelimit-Source": source, **bucket.generate_ratelimit_headers()},
+        )
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "buckets": len(self.buckets),
+            "internal_buckets": sum(1 for bucket in self.buckets.values() if bucket.tat is not None),
+            "external_keys": len(self._external),
+            "hits": self.hits,
+            "expired": self.expired,
+            **{"rejections_%s" % source.replace(".", "_"): count for source, count in self.rejections.items()},
+        }
+
+
+ratelimiter = Ratelimiter()
+
+
+def client_key(scope: Scope) -> str:
+    """Ratelimits each client IP separately, per request method."""
+    client = scope.get("client")
+    return "%s:%s" % (scope["method"], client[0] if client else "unknown")
+
+
+def authorization_key(scope: Scope) -> str:
+    """Ratelimits each Authorization header separately, falling back to the client IP."""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            return value.decode("latin-1")
+    return client_key(scope)
+
+
+class RatelimitPolicy:
+    """
+    A ratelimit for a group of routes.
+
+    :param name: The name of the policy, which is used as the public bucket name and in bucket keys. Policies with the
+    same name (and limits) share their buckets.
+    :param path: The path to match, in the same format as route paths (e.g. `/config/{guild_id:int}/presence`).
+    A trailing `{path:path}` matches every route under a prefix.
+    :param limit: How many requests each client may make per `window`.
+    :param window: The time window, in seconds.
+    :param methods: The request methods this applies to, or None for all.
+    :param key: Works out which client a request belongs to, from the ASGI scope.
+    """
+
+    __slots__ = ("name", "path", "limit", "window", "methods", "key", "regex", "body", "headers", "limit_header")
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        *,
+        limit: int,
+        window: float,
+        methods: typing.Iterable[str] | None = None,
+        key: typing.Callable[[Scope], str] = client_key,
+    ):
+        self.name = name
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self.methods = frozenset(method.upper() for method in methods) if methods else None
+        self.key = key
+        self.regex = compile_path(path)[0]
+        # Everything about a rejection that does not depend on the bucket's state is worked out up front.
+        self.body = orjson.dumps({"detail": "You are being ratelimited by the server."})
+        self.limit_header = (b"x-ratelimit-limit", str(limit).encode())
+        self.headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(self.body)).encode()),
+            (b"x-ratelimit-source", b"internal"),
+            (b"x-ratelimit-bucket", name.encode()),
+            self.limit_header,
+        ]
+
+    def __repr__(self):
+        return "<RatelimitPolicy name={0.name!r} path={0.path!r} limit={0.limit} window={0.window}>".format(self)
+
+    def matches(self, method: str, path: str) -> bool:
+        return (self.methods is None or method in self.methods) and self.regex.match(path) is not None
+
+
+class RatelimitMiddleware:
+    """
+    Applies :class:`RatelimitPolicy` s to requests before they are routed, so a rejected request costs a couple of dict
+    lookups, and never reaches a handler or its dependencies.
+
+    The first matching policy applies. Which policy a (method, path) resolves to is cached.
+    Responses to ratelimited routes carry `X-Ratelimit-Limit`, `X-Ratelimit-Remaining` and `X-Ratelimit-Reset`
+    headers (unless the route set its own, e.g. when relaying discord's), and 429s carry `Retry-After`.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        policies: typing.Iterable[RatelimitPolicy],
+        *,
+        limiter: Ratelimiter = ratelimiter,
+        max_cached_paths: int = 10000,
+    ):
+        self.app = app
+        self.policies = list(policies)
+        self.limiter = limiter
+        self.max_cached_paths = max_cached_paths
+        self._resolved: dict[tuple[str, str], RatelimitPolicy | None] = {}
+
+    def resolve(self, method: str, path: str) -> RatelimitPolicy | None:
+        """Returns the policy that applies to a request, if any."""
+        try:
+            return self._resolved[method, path]
+        except KeyError:
+            pass
+        policy = next((policy for policy in self.policies if policy.matches(method, path)), None)
+        # Paths contain IDs, so this would otherwise grow forever.
+        if len(self._resolved) >= self.max_cached_paths:
+            self._resolved.clear()
+        self._resolved[method, path] = policy
+        return policy
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        policy = self.resolve(scope["method"], path)
+        if policy is None:
+            return await self.app(scope, receive, send)
+
+        allowed, bucket = self.limiter.hit(
+            "%s:%s" % (policy.name, policy.key(scope)), limit=policy.limit, window=policy.window
+        )
+        state = [
+            (b"x-ratelimit-remaining", str(bucket.remaining).encode()),
+            (b"x-ratelimit-reset", str(bucket.reset).encode()),
+        ]
+        if not allowed:
+            self.limiter.rejections["internal"] += 1
+            retry_after = (b"retry-after", str(max(0.0, bucket.reset_after)).encode())
+            await send(
+                {"type": "http.response.start", "status": 429, "headers": [*policy.headers, *state, retry_after]}
+            )
+            await send({"type": "http.response.body", "body": policy.body})
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", ()))
+                if not any(name.lower() == b"x-ratelimit-limit" for name, _ in headers):
+                    headers += [policy.limit_header, *state]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
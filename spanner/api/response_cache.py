@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import secrets
+import time
+import typing
+
+import discord
+import pydantic_core
+from fastapi import Request
+from starlette.responses import Response
+
+from spanner.bot import bot as __bot
+from spanner.share.cache import LRUCache
+
+__all__ = ("ResponseCache", "response_cache")
+log = logging.getLogger(__name__)
+
+
+class _CachedResponse(typing.NamedTuple):
+    version: int
+    etag: str
+    body: bytes
+    expires: float | None
+
+
+class ResponseCache:
+    """
+    Caches serialised JSON responses, with strong ETags, for responses built from the bot's gateway cache.
+
+    Every response belongs to a scope (usually a guild ID), which has a version number. The version is bumped when
+    something in the scope changes (see the listeners at the bottom of this module), which invalidates every response
+    in it. ETags are derived from the scope's version, so a conditional request for an unchanged scope is answered
+    with a 304 without building anything.
+
+    Scopes that are not kept up to date by events (e.g. users that share no guilds with the bot) should pass a `ttl`,
+    after which the response is rebuilt, and the scope's version bumped only if the response actually changed.
+
+    :param capacity: How many responses are kept.
+    """
+
+    def __init__(self, *, capacity: int = 2048):
+        self._entries: LRUCache[tuple[typing.Hashable, typing.Hashable], _CachedResponse] = LRUCache(capacity)
+        self._versions: dict[typing.Hashable, int] = {}
+        # ETags must not repeat across restarts, as the versions start from 0 again.
+        self._epoch = secrets.token_hex(8)
+
+        self.hits = 0
+        self.builds = 0
+        self.not_modified = 0
+        self.bumps = 0
+
+    def __repr__(self):
+        return "<ResponseCache size={0} scopes={1}>".format(len(self._entries), len(self._versions))
+
+    def version(self, scope: typing.Hashable) -> int:
+        return self._versions.get(scope, 0)
+
+    def bump(self, scope: typing.Hashable) -> None:
+        """Invalidates every cached response in a scope."""
+        self._versions[scope] = self.version(scope) + 1
+        self.bumps += 1
+
+    def _etag(self, scope: typing.Hashable, version: int, key: typing.Hashable) -> str:
+        digest = hashlib.sha1(repr((self._epoch, scope, version, key)).encode()).hexdigest()
+        return '"%s"' % digest
+
+    def _response(self, request: Request, entry: _CachedResponse, headers: dict[str, str] | None) -> Response:
+        headers = {**(headers or {}), "ETag": entry.etag}
+        if entry.etag in request.headers.get("If-None-Match", ""):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type="application/json", headers=headers)
+
+    async def respond(
+        self,
+        request: Request,
+        scope: typing.Hashable,
+        key: typing.Hashable,
+        build: typing.Callable[[], typing.Awaitable[typing.Any]],
+        *,
+        ttl: float | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> Response:
+        """
+        Returns a cached response, or builds, caches and returns a new one.
+
+        :param request: The request being answered, whose If-None-Match header is checked.
+        :param scope: The scope the response belongs to, e.g. a guild ID.
+        :param key: What else the response depends on, e.g. the route, query parameters and user ID.
+        :param build: Builds the response body, which must be serialisable by pydantic (e.g. a model, or list of them).
+        :param ttl: How long the response is valid for, if the scope is not kept up to date by events.
+        :param headers: Extra headers to send with the response.
+        """
+        version = self.version(scope)
+        entry = self._entries.get((scope, key))
+        if entry is not None and entry.version == version and (entry.expires is None or entry.expires > time.time()):
+            self.hits += 1
+            return self._response(request, entry, headers)
+        if ttl is None and self._etag(scope, version, key) in request.headers.get("If-None-Match", ""):
+            # The client has the current version, even though it is no longer cached here.
+            self.not_modified += 1
+            return Response(status_code=304, headers={**(headers or {}), "ETag": self._etag(scope, version, key)})
+
+        body = pydantic_core.to_json(await build())
+        self.builds += 1
+        if entry is not None and entry.version == version == self.version(scope) and entry.body != body:
+            # The ttl has passed, and the response changed without an event saying so.
+            self.bump(scope)
+            version = self.version(scope)
+        # If the scope was bumped while building, this is cached under the old version, so is never served again.
+        entry = _CachedResponse(
+            version=version,
+            etag=self._etag(scope, version, key),
+            body=body,
+            expires=time.time() + ttl if ttl is not None else None,
+        )
+        self._entries.set((scope, key), entry)
+        return self._response(request, entry, headers)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self._entries),
+            "scopes": len(self._versions),
+            "hits": self.hits,
+            "builds": self.builds,
+            "not_modified": self.not_modified,
+            "bumps": self.bumps,
+        }
+
+
+response_cache = ResponseCache()
+
+
+async def _bump_guild(guild: discord.Guild) -> None:
+    response_cache.bump(guild.id)
+
+
+async def _on_guild_channel_update(_before: discord.abc.GuildChannel, after: discord.abc.GuildChannel) -> None:
+    response_cache.bump(after.guild.id)
+
+
+async def _on_guild_channel_change(channel: discord.abc.GuildChannel) -> None:
+    response_cache.bump(channel.guild.id)
+
+
+async def _on_guild_role_update(_before: discord.Role, after: discord.Role) -> None:
+    response_cache.bump(after.guild.id)
+
+
+async def _on_guild_role_change(role: discord.Role) -> None:
+    response_cache.bump(role.guild.id)
+
+
+async def _on_guild_update(_before: discord.Guild, after: discord.Guild) -> None:
+    response_cache.bump(after.id)
+
+
+async def _on_member_update(_before: discord.Member, after: discord.Member) -> None:
+    response_cache.bump(after.guild.id)
+
+
+async def _on_member_change(member: discord.Member) -> None:
+    response_cache.bump(member.guild.id)
+
+
+async def _on_user_update(_before: discord.User, after: discord.User) -> None:
+    response_cache.bump(("user", after.id))
+
+
+__bot.add_listener(_bump_guild, "on_guild_join")
+__bot.add_listener(_bump_guild, "on_guild_available")
+__bot.add_listener(_on_guild_update, "on_guild_update")
+__bot.add_listener(_bump_guild, "on_guild_remove")
+__bot.add_listener(_on_guild_channel_update, "on_guild_channel_update")
+__bot.add_listener(_on_guild_channel_change, "on_guild_channel_create")
+__bot.add_listener(_on_guild_channel_change, "on_guild_channel_delete")
+__bot.add_listener(_on_guild_role_update, "on_guild_role_update")
+__bot.add_listener(_on_guild_role_change, "on_guild_role_create")
+__bot.add_listener(_on_guild_role_change, "on_guild_role_delete")
+__bot.add_listener(_on_member_update, "on_member_update")
+__bot.add_listener(_on_member_change, "on_member_join")
+__bot.add_listener(_on_member_change, "on_member_remove")
+__bot.add_listener(_on_user_update, "on_user_update")
@@ -1,14 +1,19 @@
+import base64
+import binascii
 import datetime
 import hashlib
-import time
-from typing import Annotated
+import uuid
+from typing import Annotated, Literal
 
 import discord.utils
-from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, status
+from fastapi import APIRouter, HTTPException, Header, Query, status
 from pydantic import BaseModel
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from tortoise.expressions import Q
 
-from spanner.bot import CustomBridgeBot, bot as __bot
+from spanner.bot import CustomBridgeBot
+from spanner.share.audit_log_export import EXPORT_FORMATS, export_html, export_ndjson, gzip_stream
+from spanner.share.cache import log_feature_cache
 from spanner.share.database import (
     DiscordOauthUser,
     GuildAuditLogEntry,
@@ -20,8 +25,8 @@ from spanner.share.database import (
     GuildNickNameModerationPydantic,
 )
 
+from ..dependencies import GuildAccess, bot_is_ready, can_manage_guild
 from ..models.config import GuildAuditLogEntryResponse
-from ..ratelimiter import Bucket, Ratelimiter
 from .oauth2 import is_logged_in
 
 
@@ -29,41 +34,15 @@ class _FeatureToggle(BaseModel):
     enabled: bool
 
 
-def _bot_is_ready_callback() -> CustomBridgeBot:
-    if not __bot.is_ready():
-        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail="Bot is not ready.")
-    return __bot
-
-
-bot_is_ready = Depends(_bot_is_ready_callback)
-
-
 router = APIRouter(tags=["Configuration"])
-RATELIMITER = Ratelimiter()
 
 
 @router.get("/{guild_id}/presence", status_code=status.HTTP_204_NO_CONTENT)
-async def get_guild_presence(req: Request, guild_id: int, bot: Annotated[CustomBridgeBot, bot_is_ready]):
+async def get_guild_presence(guild_id: int, bot: Annotated[CustomBridgeBot, bot_is_ready]):
     """Checks that the bot is in the target server."""
     if not bot.is_ready():
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail="Bot is not ready.")
 
-    key = hashlib.sha1(
-        f"{req.client.host}:{req.headers.get('Authorization') or req.client.host}:presence".encode()
-    ).hexdigest()
-    if (bucket := RATELIMITER.get_bucket(key)) is None:
-        bucket = Bucket(key, 50, 50, time.time() + 10, 10)
-    bucket.renew_if_not_expired()
-    bucket.remaining -= 1
-    RATELIMITER.buckets[key] = bucket
-
-    if bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited by the server.",
-            headers={"X-Ratelimit-Source": "internal", **bucket.generate_ratelimit_headers()},
-        )
-
     guild = bot.get_guild(guild_id)
     if not guild:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
@@ -72,21 +51,11 @@ async def get_guild_presence(req: Request, guild_id: int, bot: Annotated[CustomB
 
 @router.get("/{guild_id}/nickname-moderation")
 async def get_nickname_moderation(
-    guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], bot: Annotated[CustomBridgeBot, bot_is_ready]
+    guild_id: int, access: Annotated[GuildAccess, can_manage_guild]
 ) -> GuildNickNameModerationPydantic:
     """
     Get the nickname moderation configuration for the given guild.
     """
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config = await GuildNickNameModeration.get_or_none(guild_id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Nickname moderation configuration not found.")
@@ -105,8 +74,7 @@ class PatchNickNameModerationBody(BaseModel):
 async def set_nickname_moderation(
     guild_id: int,
     body: PatchNickNameModerationBody,
-    user: Annotated[DiscordOauthUser, is_logged_in],
-    bot: Annotated[CustomBridgeBot, bot_is_ready],
+    access: Annotated[GuildAccess, can_manage_guild],
 ):
     """
     Update the nickname moderation configuration for the given guild.
@@ -119,16 +87,6 @@ async def set_nickname_moderation(
     sexual = body.sexual
     violence = body.violence
 
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config, _ = await GuildNickNameModeration.get_or_create(guild_id=guild_id)
 
     if hate is not None:
@@ -146,22 +104,10 @@ async def set_nickname_moderation(
 
 
 @router.delete("/{guild_id}/nickname-moderation", status_code=status.HTTP_204_NO_CONTENT)
-async def disable_nickname_moderation(
-    guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], bot: Annotated[CustomBridgeBot, bot_is_ready]
-):
+async def disable_nickname_moderation(guild_id: int, access: Annotated[GuildAccess, can_manage_guild]):
     """
     Disables nickname moderation for the guild, destroying the configuration.
     """
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config = await GuildNickNameModeration.get_or_none(guild_id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Nickname moderation configuration not found.")
@@ -181,8 +127,7 @@ async def get_log_channel(guild_id: int) -> str | None:
 @router.get("/{guild_id}/logging/features/enabled")
 async def get_logging_features(
     guild_id: int,
-    user: Annotated[DiscordOauthUser, is_logged_in],
-    bot: Annotated[CustomBridgeBot, bot_is_ready],
+    access: Annotated[GuildAccess, can_manage_guild],
     enabled: bool | None = Query(
         None, description="Whether to only return enabled/disabled (true/false) features. None returns all."
     ),
@@ -190,16 +135,6 @@ async def get_logging_features(
     """
     Get the logging features configuration for the given guild.
     """
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config = await GuildConfig.get_or_none(id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild configuration not found.")
@@ -234,8 +169,7 @@ async def set_log_feature(
     guild_id: int,
     feature: str,
     body: _FeatureToggle,
-    user: Annotated[DiscordOauthUser, is_logged_in],
-    bot: Annotated[CustomBridgeBot, bot_is_ready],
+    access: Annotated[GuildAccess, can_manage_guild],
 ):
     """
     Enable or disable a specific logging feature for the given guild.
@@ -246,21 +180,13 @@ async def set_log_feature(
     """
     if feature not in GuildLogFeatures.VALID_LOG_FEATURES:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Invalid feature.")
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
     config = await GuildConfig.get_or_none(id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild configuration not found.")
     feature, _ = await GuildLogFeatures.get_or_create(guild=config, name=feature)
     feature.enabled = body.enabled
     await feature.save()
+    log_feature_cache.invalidate(guild_id, feature.name)
     return await GuildLogFeaturesPydantic.from_tortoise_orm(feature)
 
 
@@ -268,8 +194,7 @@ async def set_log_feature(
 async def delete_log_feature(
     guild_id: int,
     feature: str,
-    user: Annotated[DiscordOauthUser, is_logged_in],
-    bot: Annotated[CustomBridgeBot, bot_is_ready],
+    access: Annotated[GuildAccess, can_manage_guild],
 ):
     """
     Disable a specific logging feature for the given guild.
@@ -278,16 +203,6 @@ async def delete_log_feature(
     if feature not in GuildLogFeatures.VALID_LOG_FEATURES:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Invalid feature.")
 
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config = await GuildConfig.get_or_none(id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild configuration not found.")
@@ -295,18 +210,37 @@ async def delete_log_feature(
     if not feature:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Feature not found.")
     await feature.delete()
+    log_feature_cache.invalidate(guild_id, feature.name)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+def _encode_audit_log_cursor(entry: GuildAuditLogEntry) -> str:
+    value = "%s|%s" % (entry.created_at.isoformat(), entry.id)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def _decode_audit_log_cursor(cursor: str) -> tuple[datetime.datetime, uuid.UUID]:
+    """Decodes an audit log cursor. Raises ValueError if it is malformed."""
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError("Malformed cursor.") from e
+    created_at, _, entry_id = value.partition("|")
+    return datetime.datetime.fromisoformat(created_at), uuid.UUID(entry_id)
+
+
 @router.get("/{guild_id}/audit-log")
 async def get_guild_audit_logs(
     guild_id: int,
     user: Annotated[DiscordOauthUser, is_logged_in],
     bot: Annotated[CustomBridgeBot, bot_is_ready],
+    access: Annotated[GuildAccess, can_manage_guild],
     before: datetime.datetime | None = Query(None),
     after: datetime.datetime | None = Query(None),
     limit: int = Query(100, le=100, ge=1),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None),
+    with_total: bool = Query(True),
     author: int | None = Query(None),
     namespace: str | None = Query(None),
     action: str | None = Query(None),
@@ -320,7 +254,10 @@ async def get_guild_audit_logs(
     * If `before` is specified, only entries created BEFORE this time are included.
     * If `after` is specified, only entries created AFTER this time are included.
     * If `limit` is specified, UP TO this many entries will be returned.
-    * `Offset` must be specified to properly paginate. It may not be required if less than LIMIT entries are returned.
+    * `cursor` should be set to the previous page's `next_cursor` to paginate. Unlike `offset`, this stays fast
+    however deep into the audit log you go.
+    * `Offset` can be used to paginate instead of `cursor`, but the two cannot be combined.
+    * If `with_total` is false, `total` is not counted (and is `null`), which saves a query on large audit logs.
     * If `author` is specified, only entries created by the given user ID will be returned.
     * If `namespace` is specified, only entries for this specific namespace (e.g. `settings.logging.features`)
     will be returned.
@@ -332,6 +269,8 @@ async def get_guild_audit_logs(
     You can set author to `0` to automatically fill in the current authenticated user's ID, or 1 for the current bot's
     user ID.
     """
+    if cursor is not None and offset:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cursor and offset cannot be used together.")
     if before and after and before >= after:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "Before must be a time predating after")
     elif after and after > discord.utils.utcnow():
@@ -347,16 +286,6 @@ async def get_guild_audit_logs(
     elif author and author > discord.utils.generate_snowflake():
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "Author snowflake does not exist yet.")
 
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id)
-    if not member:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
-    elif not member.guild_permissions.manage_guild:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You do not have the required permissions.")
-
     config = await GuildConfig.get_or_none(id=guild_id)
     if not config:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild configuration not found.")
@@ -372,8 +301,61 @@ async def get_guild_audit_logs(
     if action is not None:
         query = query.filter(action=action)
 
-    count = await query.all().count()
-    query = query.order_by("-created_at").limit(limit).offset(offset)
+    count = await query.count() if with_total else None
+    if cursor is not None:
+        try:
+            cursor_created_at, cursor_id = _decode_audit_log_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        query = query.filter(Q(created_at__lt=cursor_created_at) | Q(created_at=cursor_created_at, id__lt=cursor_id))
+    # One extra entry is fetched to find out whether there is another page.
+    entries = await query.order_by("-created_at", "-id").limit(limit + 1).offset(offset)
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = _encode_audit_log_cursor(entries[-1])
+    await GuildAuditLogEntry.rehydrate(entries)
     return GuildAuditLogEntryResponse(
-        total=count, offset=offset, entries=await GuildAuditLogEntryPydantic.from_queryset(query)
+        total=count,
+        offset=offset,
+        next_cursor=next_cursor,
+        entries=[await GuildAuditLogEntryPydantic.from_tortoise_orm(entry) for entry in entries],
+    )
+
+
+@router.get("/{guild_id}/audit-log/export")
+async def export_guild_audit_log(
+    guild_id: int,
+    access: Annotated[GuildAccess, can_manage_guild],
+    format: Literal["ndjson", "html"] = Query("ndjson"),
+    compress: bool = Query(False),
+    namespace: str | None = Query(None),
+    action: str | None = Query(None),
+) -> StreamingResponse:
+    """
+    Exports the entire audit log for the given guild, newest first.
+
+    * `format` can be `ndjson` (one JSON entry per line, in the same shape as `/audit-log` entries), or `html`.
+    * If `compress` is true, the export is gzipped.
+    * `namespace` and `action` filter the same way as in `/audit-log`.
+
+    The export is streamed as it is read from the database, so it can be arbitrarily large.
+    """
+    filters = {}
+    if namespace is not None:
+        filters["namespace"] = namespace
+    if action is not None:
+        filters["action"] = action
+    if format == "html":
+        chunks = export_html(access.guild, **filters)
+    else:
+        chunks = export_ndjson(guild_id, **filters)
+    extension, media_type = EXPORT_FORMATS[format]
+    filename = "audit-log-%d.%s" % (guild_id, extension)
+    if compress:
+        chunks = gzip_stream(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        chunks, media_type=media_type, headers={"Content-Disposition": 'attachment; filename="%s"' % filename}
     )
@@ -1,53 +1,28 @@
-import hashlib
 import logging
-import time
 from hashlib import sha1
 from typing import Annotated
 
 import discord
-import httpx
-from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, status
+from fastapi import APIRouter, HTTPException, Query, Request, status
 from fastapi.responses import JSONResponse
 
 from spanner.bot import bot
 from spanner.share.database import DiscordOauthUser
+from spanner.share.http import http_clients
 
+from ..dependencies import member_cache
 from ..models.discord_ import ChannelInformation, Member, PartialGuild, User
-from ..ratelimiter import Bucket, Ratelimiter
-from ..vars import DISCORD_API_BASE_URL
+from ..ratelimiter import ratelimiter
+from ..response_cache import response_cache
+from ..user_guilds import user_guilds
 from .oauth2 import is_logged_in
 
 router = APIRouter(tags=["Discord API Proxy"])
 logger = logging.getLogger("spanner.api.discord")
-RATELIMITER = Ratelimiter()
-DEFAULT_INTERNAL_KEY = "{req.method}:{req.client.host}"
-
-
-def handle_ratelimit(req: Request) -> Bucket:
-    key = sha1(
-        DEFAULT_INTERNAL_KEY.format(req=req, authorization=req.headers.get("Authorization", "")).encode()
-    ).hexdigest()
-    bucket = RATELIMITER.get_bucket(key)
-    if not bucket:
-        bucket = Bucket(key, 10, 10, time.time() + 10, 10)
-
-    bucket.renew_if_not_expired()
-    bucket.remaining -= 1
-    RATELIMITER.buckets[key] = bucket
-
-    if bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited by the server.",
-            headers={"X-Ratelimit-Source": "internal", **bucket.generate_ratelimit_headers()},
-        )
-    return bucket
-
-
-internal_ratelimit = Depends(handle_ratelimit)
+USER_CACHE_TTL = 300
 
 
-@router.get("/users/@me", dependencies=[internal_ratelimit])
+@router.get("/users/@me")
 async def get_me(user: Annotated[DiscordOauthUser, is_logged_in], res: JSONResponse) -> User:
     """Fetches the discord profile of the currently logged in user."""
     _user = await bot.get_or_fetch_user(user.user_id)
@@ -59,89 +34,80 @@ async def get_me(user: Annotated[DiscordOauthUser, is_logged_in], res: JSONRespo
     if "identify" not in user.scope:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Missing required scope: identify")
 
-    bucket = RATELIMITER.get_bucket(rl_key)
+    bucket = ratelimiter.get_bucket(rl_key)
     if bucket and bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited.",
-            headers={"X-Ratelimit-Source": "discord.preemptive", **bucket.generate_ratelimit_headers()},
-        )
+        raise ratelimiter.exceeded(bucket, source="discord.preemptive", detail="You are being ratelimited.")
 
-    async with httpx.AsyncClient(base_url=DISCORD_API_BASE_URL) as client:
-        logger.info("Sending request to discord API for /users/@me")
-        response = await client.get("/users/@me", headers={"Authorization": f"Bearer {user.access_token}"})
-        bucket = RATELIMITER.from_discord_headers(response.headers, key=rl_key)
-        if response.status_code == 429:
-            raise HTTPException(
-                status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="You are being ratelimited by discord.",
-                headers={"X-Ratelimit-Source": "discord", **bucket.generate_ratelimit_headers()},
-            )
-        response.raise_for_status()
-        res.headers["X-Source"] = "discord"
-        return User.model_validate(response.json())
+    client = http_clients.get("discord")
+    logger.info("Sending request to discord API for /users/@me")
+    response = await client.get("/users/@me", headers={"Authorization": f"Bearer {user.access_token}"})
+    bucket = ratelimiter.from_discord_headers(response.headers, key=rl_key)
+    if response.status_code == 429:
+        raise ratelimiter.exceeded(bucket, source="discord", detail="You are being ratelimited by discord.")
+    response.raise_for_status()
+    res.headers["X-Source"] = "discord"
+    return User.model_validate(response.json())
 
 
-@router.get("/users/@me/guilds", dependencies=[internal_ratelimit])
+@router.get("/users/@me/guilds")
 async def get_my_guilds(user: Annotated[DiscordOauthUser, is_logged_in]) -> list[PartialGuild]:
-    """Returns a list of partial guilds that the logged in user is in."""
+    """
+    Returns a list of partial guilds that the logged in user is in.
+
+    This is cached per session for a short time, see UserGuildsCache.
+    """
     if "guilds" not in user.scope:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Missing required scope: guilds")
 
-    rl_key = sha1(f"{user.user_id}:{user.access_token}:/users/@me/guilds".encode()).hexdigest()
-    bucket = RATELIMITER.get_bucket(rl_key)
-    if bucket and bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited.",
-            headers={"X-Ratelimit-Source": "discord.preemptive", **bucket.generate_ratelimit_headers()},
-        )
-
-    async with httpx.AsyncClient(base_url=DISCORD_API_BASE_URL) as client:
-        response = await client.get(
-            "/users/@me/guilds",
-            headers={"Authorization": f"Bearer {user.access_token}"},
-        )
-        bucket = RATELIMITER.from_discord_headers(response.headers, key=rl_key)
-        if response.status_code == 429:
-            raise HTTPException(
-                status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="You are being ratelimited by discord.",
-                headers={
-                    "X-Ratelimit-Source": "discord",
-                    **bucket.generate_ratelimit_headers(),
-                },
-            )
-        response.raise_for_status()
-        return [PartialGuild.model_validate(guild) for guild in response.json()]
+    return (await user_guilds.get(user)).guilds
 
 
-@router.get("/users/{user_id}", dependencies=[internal_ratelimit, is_logged_in])
-async def get_user(user_id: int, res: JSONResponse, if_none_match: str = Header(None)) -> User:
+@router.get("/users/{user_id}", dependencies=[is_logged_in])
+async def get_user(req: Request, user_id: int) -> User:
     """
     Fetches a user by ID.
 
-    This endpoint makes use of an etag header - if the display name/avatar hash has not changed,
-    the server will return a 304 Not Modified response.
+    This endpoint makes use of an etag header - if the user has not changed, the server will return a 304 Not Modified
+    response.
     """
-    user = await bot.get_or_fetch_user(user_id)
-    if not user:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="User not found.")
-    res.headers["etag"] = hashlib.md5(f"{user.display_name}{user.display_avatar}".encode()).hexdigest()
-    if if_none_match and if_none_match == res.headers["etag"]:
-        raise HTTPException(status.HTTP_304_NOT_MODIFIED)
-    return User.from_user(user)
+
+    async def build() -> User:
+        user = await bot.get_or_fetch_user(user_id)
+        if not user:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail="User not found.")
+        return User.from_user(user)
+
+    # Users that share no guilds with the bot are not updated over the gateway, so are re-checked every so often.
+    return await response_cache.respond(req, ("user", user_id), "user", build, ttl=USER_CACHE_TTL)
 
 
-@router.get("/guilds/{guild_id}", dependencies=[internal_ratelimit])
-async def get_guild(guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], res: JSONResponse) -> PartialGuild:
+@router.get("/guilds/{guild_id}")
+async def get_guild(
+    req: Request, guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], res: JSONResponse
+) -> PartialGuild:
     """
     Fetches a guild by ID.
 
     This endpoint will attempt to fetch the guild object from the bot using the gateway first.
     If that fails (i.e. the bot is not in the guild), then it will query discord's API to fetch the guild object.
     This means you may be subject to stricter ratelimits.
+
+    Guilds from the gateway are sent with an etag header, and conditional requests get a 304 Not Modified response
+    if nothing has changed.
     """
+    guild = bot.get_guild(guild_id)
+    if guild:
+
+        async def build() -> PartialGuild:
+            member = await member_cache.get(guild, user.user_id)
+            if member:
+                return PartialGuild.from_member(member)
+            return PartialGuild.from_guild(guild)
+
+        return await response_cache.respond(
+            req, guild_id, ("guild", user.user_id), build, headers={"X-Source": "internal"}
+        )
+
     guild = await discord.utils.get_or_fetch(bot, "guild", guild_id, default=None)
     if guild:
         res.headers["X-Source"] = "internal"
@@ -153,39 +119,15 @@ async def get_guild(guild_id: int, user: Annotated[DiscordOauthUser, is_logged_i
     if "guilds" not in user.scope:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Missing required scope: guilds")
 
-    rl_key = sha1(f"{user.user_id}:{user.access_token}:/users/@me/guilds".encode()).hexdigest()
-    bucket = RATELIMITER.get_bucket(rl_key)
-    if bucket and bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited.",
-            headers={"X-Ratelimit-Source": "discord.preemptive", **bucket.generate_ratelimit_headers()},
-        )
-
-    async with httpx.AsyncClient(base_url=DISCORD_API_BASE_URL) as client:
-        response = await client.get(
-            "/users/@me/guilds",
-            headers={"Authorization": f"Bearer {user.access_token}"},
-        )
-        bucket = RATELIMITER.from_discord_headers(response.headers, key=rl_key)
-        if response.status_code == 429:
-            raise HTTPException(
-                status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="You are being ratelimited by discord.",
-                headers={
-                    "X-Ratelimit-Source": "discord",
-                    **bucket.generate_ratelimit_headers(),
-                },
-            )
-        response.raise_for_status()
-        for guild in response.json():
-            if guild["id"] == str(guild_id):
-                return PartialGuild.model_validate(guild)
+    guild = (await user_guilds.get(user)).by_id.get(str(guild_id))
+    if guild is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found")
+    return guild
 
 
-@router.get("/guilds/{guild_id}/channels", dependencies=[internal_ratelimit])
+@router.get("/guilds/{guild_id}/channels")
 async def get_guild_channels(
+    req: Request,
     guild_id: int,
     user: Annotated[DiscordOauthUser, is_logged_in],
     channel_types: list[int] = Query(None, alias="types"),
@@ -194,33 +136,43 @@ async def get_guild_channels(
 ) -> list[ChannelInformation]:
     """
     Returns a list of channels in a guild that match the given filters
+
+    This endpoint makes use of an etag header - if nothing in the guild has changed, the server will return a
+    304 Not Modified response.
     """
     guild: discord.Guild = await discord.utils.get_or_fetch(bot, "guild", guild_id, default=None)
     if not guild:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
 
-    member = await discord.utils.get_or_fetch(guild, "member", user.user_id, default=None)
+    member = await member_cache.get(guild, user.user_id)
     if not member:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="You are not in this guild.")
 
-    channels = list(guild.channels)
-    resolved_channels = []
-    for channel in channels:
-        user_perms = channel.permissions_for(member)
-        bot_perms = channel.permissions_for(guild.me)
-
-        if channel_types and channel.type.value not in channel_types:
-            continue
-        elif user_perms < discord.Permissions(minimum_user_permissions):
-            continue
-        elif bot_perms < discord.Permissions(minimum_bot_permissions):
-            continue
+    channel_types = frozenset(channel_types or ())
+    minimum_user = discord.Permissions(minimum_user_permissions)
+    minimum_bot = discord.Permissions(minimum_bot_permissions)
+
+    async def build() -> list[ChannelInformation]:
+        resolved_channels = []
+        for channel in guild.channels:
+            if channel_types and channel.type.value not in channel_types:
+                continue
+            user_perms = channel.permissions_for(member)
+            if user_perms < minimum_user:
+                continue
+            bot_perms = channel.permissions_for(guild.me)
+            if bot_perms < minimum_bot:
+                continue
+            resolved_channels.append(
+                ChannelInformation.from_channel(channel, user_permissions=user_perms, bot_permissions=bot_perms)
+            )
+        return resolved_channels
 
-        resolved_channels.append(ChannelInformation.from_channel(channel))
-    return resolved_channels
+    key = ("channels", user.user_id, channel_types, minimum_user_permissions, minimum_bot_permissions)
+    return await response_cache.respond(req, guild_id, key, build)
 
 
-@router.get("/guilds/{guild_id}/@me", dependencies=[internal_ratelimit])
+@router.get("/guilds/{guild_id}/@me")
 async def get_my_guild_member(guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in], res: JSONResponse):
     """
     Fetches the current user's member object for the given guild.
@@ -243,45 +195,38 @@ async def get_my_guild_member(guild_id: int, user: Annotated[DiscordOauthUser, i
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Missing required scope: guilds.members.read")
 
     rl_key = sha1(f"{user.user_id}:{user.access_token}:/users/@me/guilds/{guild_id}/member".encode()).hexdigest()
-    bucket = RATELIMITER.get_bucket(rl_key)
+    bucket = ratelimiter.get_bucket(rl_key)
     if bucket and bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited.",
-            headers={"X-Ratelimit-Source": "discord.preemptive", **bucket.generate_ratelimit_headers()},
-        )
-
-    async with httpx.AsyncClient(base_url=DISCORD_API_BASE_URL) as client:
-        response = await client.get(
-            f"/users/@me/guilds/{guild_id}/member",
-            headers={"Authorization": f"Bearer {user.access_token}"},
-        )
-        if response.status_code == 429:
-            raise HTTPException(
-                status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="You are being ratelimited by discord.",
-                headers={
-                    "X-Ratelimit-Source": "discord",
-                    **bucket.generate_ratelimit_headers(),
-                },
-            )
-        response.raise_for_status()
-        return response.json()
-
-
-@router.get("/guilds/{guild_id}/bot", dependencies=[internal_ratelimit, is_logged_in])
-async def get_my_guild_bot(guild_id: int) -> Member:
+        raise ratelimiter.exceeded(bucket, source="discord.preemptive", detail="You are being ratelimited.")
+
+    client = http_clients.get("discord")
+    response = await client.get(
+        f"/users/@me/guilds/{guild_id}/member",
+        headers={"Authorization": f"Bearer {user.access_token}"},
+    )
+    bucket = ratelimiter.from_discord_headers(response.headers, key=rl_key)
+    if response.status_code == 429:
+        raise ratelimiter.exceeded(bucket, source="discord", detail="You are being ratelimited by discord.")
+    response.raise_for_status()
+    return response.json()
+
+
+@router.get("/guilds/{guild_id}/bot", dependencies=[is_logged_in])
+async def get_my_guild_bot(req: Request, guild_id: int) -> Member:
     """
     Fetches the bot's member object for the given guild.
     """
     guild: discord.Guild = await discord.utils.get_or_fetch(bot, "guild", guild_id, default=None)
     if not guild:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Guild not found.")
-    me = guild.me
-    return Member.from_member(me)
+
+    async def build() -> Member:
+        return Member.from_member(guild.me)
+
+    return await response_cache.respond(req, guild_id, "bot", build)
 
 
-@router.get("/guilds/{guild_id}/@me/permissions", dependencies=[internal_ratelimit])
+@router.get("/guilds/{guild_id}/@me/permissions")
 async def get_my_guild_permissions(res: JSONResponse, guild_id: int, user: Annotated[DiscordOauthUser, is_logged_in]):
     """
     Fetches the current permissions value for the current user in a given server.
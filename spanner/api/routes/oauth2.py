@@ -1,7 +1,5 @@
 import datetime
 import secrets
-import time
-from hashlib import sha1
 from typing import Annotated
 
 import discord.utils
@@ -12,9 +10,11 @@ from fastapi.security.api_key import APIKeyCookie, APIKeyHeader
 from starlette.responses import JSONResponse
 
 from spanner.share.database import DiscordOauthUser
+from spanner.share.http import http_clients
 
 from ..models.discord_ import AccessTokenResponse, User
-from ..ratelimiter import Bucket, Ratelimiter
+from ..sessions import sessions
+from ..user_guilds import user_guilds
 from ..vars import DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET, DISCORD_OAUTH_CALLBACK
 
 __all__ = ("router", "is_logged_in")
@@ -26,30 +26,6 @@ STATES: dict[str, str] = {}
 cookie_scheme = APIKeyCookie(name="session", auto_error=False)
 bearer_scheme = APIKeyHeader(name="X-Spanner-Session", auto_error=False)
 
-RATELIMITER = Ratelimiter()
-DEFAULT_INTERNAL_KEY = "{req.method}:{req.client.host}"
-
-
-def handle_ratelimit(req: Request) -> Bucket:
-    key = sha1(
-        DEFAULT_INTERNAL_KEY.format(req=req, authorization=req.headers.get("Authorization", "")).encode()
-    ).hexdigest()
-    bucket = RATELIMITER.get_bucket(key)
-    if not bucket:
-        bucket = Bucket(key, 5, 5, time.time() + 10, 10)
-
-    bucket.renew_if_not_expired()
-    bucket.remaining -= 1
-    RATELIMITER.buckets[key] = bucket
-
-    if bucket.exhausted:
-        raise HTTPException(
-            status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="You are being ratelimited by the server.",
-            headers={"X-Ratelimit-Source": "internal", **bucket.generate_ratelimit_headers()},
-        )
-    return bucket
-
 
 async def _is_authenticated(
     session_cookie: str | None = Depends(cookie_scheme), session_header: str | None = Depends(bearer_scheme)
@@ -58,14 +34,14 @@ async def _is_authenticated(
     if session_token is None:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Missing session cookie")
 
-    user = await DiscordOauthUser.get_or_none(session=session_token)
+    user = await sessions.resolve(session_token)
     if user is None:
         raise HTTPException(
             status.HTTP_403_FORBIDDEN, detail=f"Invalid session {session_token!r}. Clear your cookies and try again."
         )
 
+    # Expired sessions are deleted in the background, see SessionCache.purge.
     if user.expires_at < discord.utils.utcnow().timestamp():
-        await user.delete()
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail="Expired session. Clear your cookies and try again.")
 
     return user
@@ -74,7 +50,7 @@ async def _is_authenticated(
 is_logged_in = Depends(_is_authenticated)
 
 
-@router.get("/login", dependencies=[Depends(handle_ratelimit)])
+@router.get("/login")
 async def login(req: Request, return_to: str) -> RedirectResponse:
     """
     Initiates the oauth2 login flow, by redirecting to discord.
@@ -97,7 +73,7 @@ async def login(req: Request, return_to: str) -> RedirectResponse:
     return res
 
 
-@router.get("/invite", include_in_schema=False, dependencies=[Depends(handle_ratelimit)])
+@router.get("/invite", include_in_schema=False)
 async def invite(guild_id: int | None = None, return_to: str | None = None) -> RedirectResponse:
     if not all((DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET, DISCORD_OAUTH_CALLBACK)):
         raise HTTPException(503, "Oauth2 is misconfigured.")
@@ -120,7 +96,7 @@ async def invite(guild_id: int | None = None, return_to: str | None = None) -> R
     return res
 
 
-@router.get("/callback", dependencies=[Depends(handle_ratelimit)])
+@router.get("/callback")
 async def callback(
     code: str, state: str = Query(...), state_cookie: str = Cookie(..., alias="state")
 ) -> RedirectResponse:
@@ -138,44 +114,46 @@ async def callback(
     return_to = STATES[state]
     del STATES[state]
 
-    async with httpx.AsyncClient(base_url="https://discord.com/api/v10") as client:
-        code_grant = await client.post(
-            "/oauth2/token",
-            data={
-                "client_id": DISCORD_CLIENT_ID,
-                "client_secret": DISCORD_CLIENT_SECRET,
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": DISCORD_OAUTH_CALLBACK,
+    client = http_clients.get("discord")
+    code_grant = await client.post(
+        "/oauth2/token",
+        data={
+            "client_id": DISCORD_CLIENT_ID,
+            "client_secret": DISCORD_CLIENT_SECRET,
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": DISCORD_OAUTH_CALLBACK,
+        },
+        auth=(DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET),
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    if code_grant.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "message": "Failed to fetch token from upstream",
+                "status": code_grant.status_code,
+                "response": code_grant.json(),
             },
-            auth=(DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        if code_grant.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail={
-                    "message": "Failed to fetch token from upstream",
-                    "status": code_grant.status_code,
-                    "response": code_grant.json(),
-                },
-            )
-        code_payload = AccessTokenResponse.model_validate(code_grant.json())
-        if not all(x in code_payload.scope_array for x in ("identify",)):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing required scopes")
-
-        user_data = await client.get("/users/@me", headers={"Authorization": f"Bearer {code_payload.access_token}"})
-        user_data.raise_for_status()
-        user_data = User.model_validate(user_data.json())
-
-        obj = await DiscordOauthUser.create(
-            user_id=user_data.id,
-            access_token=code_payload.access_token,
-            refresh_token=code_payload.refresh_token,
-            expires_at=(discord.utils.utcnow() + datetime.timedelta(seconds=code_payload.expires_in)).timestamp(),
-            session=secrets.token_urlsafe(),
-            scope=code_payload.scope,
         )
+    code_payload = AccessTokenResponse.model_validate(code_grant.json())
+    if not all(x in code_payload.scope_array for x in ("identify",)):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing required scopes")
+
+    user_data = await client.get("/users/@me", headers={"Authorization": f"Bearer {code_payload.access_token}"})
+    user_data.raise_for_status()
+    user_data = User.model_validate(user_data.json())
+
+    session_token = secrets.token_urlsafe()
+    obj = await DiscordOauthUser.create(
+        user_id=user_data.id,
+        access_token=code_payload.access_token,
+        refresh_token=code_payload.refresh_token,
+        expires_at=(discord.utils.utcnow() + datetime.timedelta(seconds=code_payload.expires_in)).timestamp(),
+        session=session_token,
+        session_hash=DiscordOauthUser.hash_session(session_token),
+        scope=code_payload.scope,
+    )
 
     res = RedirectResponse(return_to)
     res.set_cookie("session", obj.session, expires=code_payload.expires_in, samesite="lax")
@@ -189,39 +167,40 @@ async def session(user: Annotated[DiscordOauthUser, is_logged_in]):
     return {"token": user.session, "user_id": str(user.user_id), "scopes": user.scope, "expires_at": user.expires_at}
 
 
-@router.post("/session/refresh", dependencies=[Depends(handle_ratelimit)])
+@router.post("/session/refresh")
 async def refresh_session(res: JSONResponse, user: Annotated[DiscordOauthUser, is_logged_in]):
     """Refreshes the current session token"""
-    async with httpx.AsyncClient(base_url="https://discord.com/api/v10") as client:
-        refresh = await client.post(
-            "/oauth2/token",
-            data={
-                "client_id": DISCORD_CLIENT_ID,
-                "client_secret": DISCORD_CLIENT_SECRET,
-                "grant_type": "refresh_token",
-                "refresh_token": user.refresh_token,
+    client = http_clients.get("discord")
+    refresh = await client.post(
+        "/oauth2/token",
+        data={
+            "client_id": DISCORD_CLIENT_ID,
+            "client_secret": DISCORD_CLIENT_SECRET,
+            "grant_type": "refresh_token",
+            "refresh_token": user.refresh_token,
+        },
+        auth=(DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET),
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    if refresh.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "message": "Failed to fetch token from upstream",
+                "status": refresh.status_code,
+                "response": refresh.json(),
             },
-            auth=(DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
         )
-        if refresh.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail={
-                    "message": "Failed to fetch token from upstream",
-                    "status": refresh.status_code,
-                    "response": refresh.json(),
-                },
-            )
-        refresh_payload = AccessTokenResponse.model_validate(refresh.json())
-
-        user.access_token = refresh_payload.access_token
-        if refresh_payload.refresh_token != user.refresh_token:
-            user.refresh_token = refresh_payload.refresh_token
-        if refresh_payload.scope != user.scope:
-            user.scope = refresh_payload.scope
-        user.expires_at = (discord.utils.utcnow() + datetime.timedelta(seconds=refresh_payload.expires_in)).timestamp()
-        await user.save()
+    refresh_payload = AccessTokenResponse.model_validate(refresh.json())
+
+    user.access_token = refresh_payload.access_token
+    if refresh_payload.refresh_token != user.refresh_token:
+        user.refresh_token = refresh_payload.refresh_token
+    if refresh_payload.scope != user.scope:
+        user.scope = refresh_payload.scope
+    user.expires_at = (discord.utils.utcnow() + datetime.timedelta(seconds=refresh_payload.expires_in)).timestamp()
+    await user.save()
+    sessions.revoke(user)
 
     res.set_cookie("session", user.session, expires=refresh_payload.expires_in, samesite="lax")
     return {"token": user.session, "user_id": str(user.user_id), "scopes": user.scope, "expires_at": user.expires_at}
@@ -231,14 +210,16 @@ async def refresh_session(res: JSONResponse, user: Annotated[DiscordOauthUser, i
 async def delete_session(user: Annotated[DiscordOauthUser, is_logged_in]):
     """Deletes the current session token"""
     try:
-        async with httpx.AsyncClient(base_url="https://discord.com/api/v10") as client:
-            await client.post(
-                "/oauth2/token/revoke",
-                data={"token": user.access_token},
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
+        client = http_clients.get("discord")
+        await client.post(
+            "/oauth2/token/revoke",
+            data={"token": user.access_token},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
     except httpx.HTTPError:
         pass
     finally:
+        sessions.revoke(user)
+        user_guilds.forget(user)
         await user.delete()
     return {"message": "Session deleted."}
@@ -1,17 +1,42 @@
 import platform
 import time
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from starlette.responses import RedirectResponse
 
+from spanner.share.http import http_clients
+
+from .dependencies import member_cache
+from .ratelimiter import RatelimitMiddleware, RatelimitPolicy, authorization_key, ratelimiter
+from .response_cache import response_cache
 from .routes.config import router as config_router
 from .routes.discord_api import router as discord_router
 from .routes.oauth2 import router as oauth2_router
-from .vars import CORS_ALLOW_CREDENTIALS, CORS_ALLOW_HEADERS, CORS_ALLOW_METHODS, CORS_ALLOW_ORIGINS, ROOT_PATH
+from .sessions import sessions
+from .user_guilds import user_guilds
+from .vars import (
+    CORS_ALLOW_CREDENTIALS,
+    CORS_ALLOW_HEADERS,
+    CORS_ALLOW_METHODS,
+    CORS_ALLOW_ORIGINS,
+    DISCORD_API_BASE_URL,
+    ROOT_PATH,
+)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    http_clients.register("discord", DISCORD_API_BASE_URL, max_connections=50, max_keepalive_connections=20)
+    sessions.start()
+    yield
+    await sessions.close()
+    await http_clients.close()
 
-app = FastAPI(debug=True, title="Spanner API", version="3.0.0a1.dev1", root_path=ROOT_PATH)
+
+app = FastAPI(debug=True, title="Spanner API", version="3.0.0a1.dev1", root_path=ROOT_PATH, lifespan=lifespan)
 
 
 @app.get("", include_in_schema=False)
@@ -59,6 +84,8 @@ class HealthZResponse(BaseModel):
     """Bot user information"""
     latency: LatencyPart
     """Bot latency information"""
+    metrics: dict[str, dict[str, int | float]]
+    """Statistics for internal caches and services, keyed by component name"""
 
 
 @app.get("/healthz")
@@ -86,6 +113,14 @@ async def health() -> HealthZResponse:
                 "avatar": bot.user.avatar.key if bot.user and bot.user.avatar else None,
             },
             "latency": {"now": latency, "history": list(bot.latency_history)},
+            "metrics": {
+                **bot.metrics(),
+                "api_ratelimiter": ratelimiter.stats(),
+                "api_sessions": sessions.stats(),
+                "api_member_cache": member_cache.stats(),
+                "api_response_cache": response_cache.stats(),
+                "api_user_guilds": user_guilds.stats(),
+            },
         }
     )
 
@@ -94,6 +129,18 @@ app.include_router(oauth2_router, prefix="/oauth2")
 app.include_router(discord_router, prefix="/_discord")
 app.include_router(config_router, prefix="/config")
 
+app.add_middleware(
+    RatelimitMiddleware,
+    policies=[
+        RatelimitPolicy("discord_api", "/_discord/{path:path}", limit=10, window=10),
+        RatelimitPolicy("oauth2", "/oauth2/login", limit=5, window=10),
+        RatelimitPolicy("oauth2", "/oauth2/invite", limit=5, window=10),
+        RatelimitPolicy("oauth2", "/oauth2/callback", limit=5, window=10),
+        RatelimitPolicy("oauth2", "/oauth2/session/refresh", limit=5, window=10),
+        RatelimitPolicy("presence", "/config/{guild_id:int}/presence", limit=50, window=10, key=authorization_key),
+    ],
+)
+
 if CORS_ALLOW_ORIGINS:
     app.add_middleware(
         CORSMiddleware,
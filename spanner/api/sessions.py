@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+
+from tortoise.exceptions import BaseORMException
+
+from spanner.share.cache import LRUCache
+from spanner.share.database import DiscordOauthUser
+
+__all__ = ("SessionCache", "sessions")
+log = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """
+    Resolves session tokens to their :class:`DiscordOauthUser`, caching each for `ttl` seconds.
+
+    Sessions are looked up by the hash of their token, which is indexed. Anything that changes or deletes a session
+    MUST call :meth:`revoke`, so that other requests stop using the old copy straight away.
+    Expired sessions are deleted in the background every `purge_interval` seconds, see :meth:`start`.
+
+    :param ttl: How long a resolved session is reused for, before it is loaded from the database again.
+    :param capacity: The most sessions cached at once.
+    :param purge_interval: How often expired sessions are deleted from the database.
+    """
+
+    def __init__(self, *, ttl: float = 60.0, capacity: int = 4096, purge_interval: float = 600.0):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        # Session hash -> (user, monotonic time the entry goes stale)
+        self._cache: LRUCache[str, tuple[DiscordOauthUser, float]] = LRUCache(capacity)
+        self._task: asyncio.Task | None = None
+
+        self.hits = 0
+        self.loads = 0
+        self.revocations = 0
+        self.purged = 0
+
+    def __repr__(self):
+        return "<SessionCache size={0} ttl={1.ttl}>".format(len(self._cache), self)
+
+    async def _load(self, session_hash: str) -> DiscordOauthUser | None:
+        self.loads += 1
+        return await DiscordOauthUser.get_or_none(session_hash=session_hash)
+
+    async def resolve(self, session: str) -> DiscordOauthUser | None:
+        """Returns the user a session token belongs to, or None if there is no such session. Expiry is not checked."""
+        session_hash = DiscordOauthUser.hash_session(session)
+        cached = self._cache.get(session_hash)
+        if cached is not None and cached[1] > time.monotonic():
+            self.hits += 1
+            return cached[0]
+        user = await self._load(session_hash)
+        if user is None:
+            self._cache.pop(session_hash)
+        else:
+            self._cache.set(session_hash, (user, time.monotonic() + self.ttl))
+        return user
+
+    def revoke(self, user: DiscordOauthUser) -> None:
+        """Drops a session from the cache, e.g. once it has been refreshed or deleted."""
+        if user.session_hash is not None and self._cache.pop(user.session_hash) is not None:
+            self.revocations += 1
+
+    async def purge(self) -> int:
+        """Deletes every expired session."""
+        removed = await DiscordOauthUser.filter(expires_at__lt=time.time()).delete()
+        self.purged += removed
+        if removed:
+            log.info("Purged %d expired sessions.", removed)
+        return removed
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.purge()
+            except BaseORMException as e:
+                log.error("Failed to purge expired sessions.", exc_info=e)
+            await asyncio.sleep(self.purge_interval)
+
+    def start(self) -> None:
+        """Starts purging expired sessions in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "loads": self.loads,
+            "revocations": self.revocations,
+            "purged": self.purged,
+        }
+
+
+sessions = SessionCache()
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+import typing
+import uuid
+from hashlib import sha1
+
+from spanner.share.cache import LRUCache
+from spanner.share.database import DiscordOauthUser
+from spanner.share.http import http_clients
+
+from .models.discord_ import PartialGuild
+from .ratelimiter import ratelimiter
+
+__all__ = ("GuildList", "UserGuildsCache", "user_guilds")
+log = logging.getLogger(__name__)
+
+
+class GuildList(typing.NamedTuple):
+    """A user's guilds, as returned by discord's `/users/@me/guilds`."""
+
+    guilds: list[PartialGuild]
+    by_id: dict[str, PartialGuild]
+    """The same guilds, keyed by their (string) ID."""
+    expires: float
+    """The monotonic time after which this list is refreshed."""
+
+
+class UserGuildsCache:
+    """
+    Caches each session's guild list from discord's `/users/@me/guilds`, for `ttl` seconds.
+
+    Concurrent requests from the same session (e.g. a dashboard page load) share one upstream request. While discord's
+    ratelimit bucket for a session is exhausted, its last guild list is served even if it has expired, rather than
+    failing with a 429. So each session makes at most one upstream request per `ttl`.
+
+    :param ttl: How long a guild list is used for before it is fetched again.
+    :param capacity: How many sessions' guild lists are kept.
+    """
+
+    def __init__(self, *, ttl: float = 30.0, capacity: int = 1024):
+        self.ttl = ttl
+        self._entries: LRUCache[uuid.UUID, GuildList] = LRUCache(capacity)
+        self._pending: dict[uuid.UUID, asyncio.Future[GuildList]] = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.fetches = 0
+        self.shared_fetches = 0
+
+    def __repr__(self):
+        return "<UserGuildsCache size={0} ttl={1.ttl}>".format(len(self._entries), self)
+
+    @staticmethod
+    def ratelimit_key(user: DiscordOauthUser) -> str:
+        return sha1(f"{user.user_id}:{user.access_token}:/users/@me/guilds".encode()).hexdigest()
+
+    async def _fetch(self, user: DiscordOauthUser) -> GuildList:
+        rl_key = self.ratelimit_key(user)
+        bucket = ratelimiter.get_bucket(rl_key)
+        if bucket and bucket.exhausted:
+            raise ratelimiter.exceeded(bucket, source="discord.preemptive", detail="You are being ratelimited.")
+
+        self.fetches += 1
+        client = http_clients.get("discord")
+        response = await client.get("/users/@me/guilds", headers={"Authorization": f"Bearer {user.access_token}"})
+        bucket = ratelimiter.from_discord_headers(response.headers, key=rl_key)
+        if response.status_code == 429:
+            raise ratelimiter.exceeded(bucket, source="discord", detail="You are being ratelimited by discord.")
+        response.raise_for_status()
+
+        guilds = [PartialGuild.model_validate(guild) for guild in response.json()]
+        entry = GuildList(guilds, {guild.id: guild for guild in guilds}, time.monotonic() + self.ttl)
+        self._entries.set(user.guid, entry)
+        return entry
+
+    async def get(self, user: DiscordOauthUser) -> GuildList:
+        """
+        Returns the session's guilds, fetching them from discord if they are not cached (or have expired).
+
+        :raises fastapi.HTTPException: 429 if discord's ratelimit is hit, and nothing is cached to fall back on.
+        :raises httpx.HTTPStatusError: Discord responded with an error.
+        """
+        entry = self._entries.get(user.guid)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                self.hits += 1
+                return entry
+            bucket = ratelimiter.get_bucket(self.ratelimit_key(user))
+            if bucket and bucket.exhausted:
+                self.stale_hits += 1
+                return entry
+
+        future = self._pending.get(user.guid)
+        if future is not None:
+            self.shared_fetches += 1
+        else:
+            future = self._pending[user.guid] = asyncio.ensure_future(self._fetch(user))
+            future.add_done_callback(lambda _: self._pending.pop(user.guid, None))
+        # Shielded, so one request being cancelled does not cancel the fetch for the others.
+        return await asyncio.shield(future)
+
+    def forget(self, user: DiscordOauthUser) -> None:
+        """Drops a session's guild list, e.g. once the session has been deleted."""
+        self._entries.pop(user.guid)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "fetches": self.fetches,
+            "shared_fetches": self.shared_fetches,
+        }
+
+
+user_guilds = UserGuildsCache()
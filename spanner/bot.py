@@ -15,8 +15,17 @@ from discord.ext import bridge, commands, tasks
 from tortoise import Tortoise
 from tortoise.contrib.fastapi import RegisterTortoise
 
+from spanner.share.audit_log import AuditLogCorrelator
+from spanner.share.audit_log_retention import AuditLogRetention
+from spanner.share.cache import log_feature_cache, starboard_config_cache
 from spanner.share.config import load_config
-from spanner.share.database import GuildConfig
+from spanner.share.database import GuildConfig, audit_log_writer
+from spanner.share.http import http_clients
+from spanner.share.log_dispatcher import LogDispatcher
+from spanner.share.message_cache import IndexedConnectionState
+from spanner.share.message_store import MessageStore
+from spanner.share.templates import templates
+from spanner.share.transcripts import TranscriptBuilder, archiver
 from spanner.share.views.self_roles import PersistentSelfRoleView
 
 TORTOISE_ORM = {
@@ -52,8 +61,53 @@ class CustomBridgeBot(bridge.Bot):
         kwargs["intents"] = intents
         self.epoch = time.time()
         self.latency_history = deque(maxlen=1440)
+        self.log_dispatcher = LogDispatcher(self, window=_config.get("log_batch_window", 1.0))
+        self.transcripts = TranscriptBuilder(
+            compression=_config.get("transcript_compression", "auto"),
+            trace_memory=_config.get("trace_transcript_memory", False),
+        )
+        self.audit_log_retention = AuditLogRetention(
+            default_days=_config.get("audit_log_retention_days", 365),
+            premium_days=_config.get("audit_log_premium_retention_days", 365 * 3),
+        )
+        http_clients.register("openai", "https://api.openai.com/v1", timeout=30.0)
+        http_clients.register("changelog", "https://git.i-am.nexus/api/v1/repos/nex/spanner-v3")
+        message_store_config = load_config()["cogs"].get("message_store", {})
+        self.message_store: MessageStore | None = None
+        if message_store_config.get("enabled", False):
+            self.message_store = MessageStore.from_config(message_store_config)
 
         super().__init__(*args, **kwargs)
+        self.audit_log = AuditLogCorrelator(self, buffer_size=_config.get("audit_log_buffer_size", 256))
+        self.add_listener(self.audit_log.feed, "on_audit_log_entry")
+
+    def _get_state(self, **options) -> IndexedConnectionState:
+        return IndexedConnectionState(
+            dispatch=self.dispatch,
+            handlers=self._handlers,
+            hooks=self._hooks,
+            http=self.http,
+            loop=self.loop,
+            **options,
+        )
+
+    async def get_or_fetch_message(self, channel_id: int, message_id: int) -> discord.Message:
+        """
+        Fetches a message from the message cache where possible, falling back to the API.
+
+        Messages fetched from the API are added to the message cache, so are kept up to date by gateway events.
+
+        :param channel_id: The ID of the channel the message is in
+        :param message_id: The message ID
+        :raises discord.HTTPException: The message (or channel) could not be fetched.
+        """
+        message = self._connection._get_message(message_id)
+        if message is not None:
+            return message
+        channel = self.get_channel(channel_id) or await self.fetch_channel(channel_id)
+        message = await channel.fetch_message(message_id)
+        self._connection._store_message(message)
+        return message
 
     @tasks.loop(minutes=1)
     async def update_latency(self):
@@ -69,6 +123,33 @@ class CustomBridgeBot(bridge.Bot):
         latency = max(-3600000, min(3600000, latency))
         bot.latency_history.append({"timestamp_ms": int(time.time() * 1000), "latency": latency})
 
+    def metrics(self) -> dict[str, dict[str, int | float]]:
+        """Collects the statistics of the bot's internal caches and services, for /healthz."""
+        metrics = {
+            "log_feature_cache": log_feature_cache.stats(),
+            "starboard_config_cache": starboard_config_cache.stats(),
+            "log_dispatcher": self.log_dispatcher.stats(),
+            "audit_log": self.audit_log.stats(),
+            "templates": templates.stats(),
+            "transcripts": self.transcripts.stats(),
+            "attachment_archiver": archiver.stats(),
+            "audit_log_writer": audit_log_writer.stats(),
+            "audit_log_retention": self.audit_log_retention.stats(),
+        }
+        if self.message_store is not None:
+            metrics["message_store"] = self.message_store.stats()
+        for name, stats in http_clients.stats().items():
+            metrics["http_%s" % name] = stats
+        if self._connection._messages is not None:
+            metrics["message_cache"] = self._connection._messages.stats()
+        ban_events = self.get_cog("BanEvents")
+        if ban_events is not None:
+            metrics["ban_pending_matches"] = ban_events.pending.stats()
+        starboard = self.get_cog("StarboardCog")
+        if starboard is not None:
+            metrics["starboard_star_counts"] = starboard.star_counts.stats()
+        return metrics
+
     async def close(self) -> None:
         if self.web is not None:
             self.web_server.should_exit = True
@@ -79,6 +160,12 @@ class CustomBridgeBot(bridge.Bot):
             except asyncio.CancelledError:
                 pass
         self.update_latency.stop()
+        await self.log_dispatcher.close()
+        if self.message_store is not None:
+            await self.message_store.close()
+        await self.audit_log_retention.close()
+        await audit_log_writer.close()
+        await http_clients.close()
         await super().close()
 
     async def clean_old_self_role_menus(self):
@@ -183,6 +270,9 @@ class CustomBridgeBot(bridge.Bot):
                     self.web = asyncio.create_task(self.web_server.serve())
                 self.epoch = time.time()
                 self.update_latency.start()
+                if self.message_store is not None:
+                    self.message_store.start()
+                self.audit_log_retention.start()
                 self.loop.create_task(self.clean_old_self_role_menus()).add_done_callback(
                     lambda _: log.info("Cleanup task complete")
                 )
@@ -2,11 +2,12 @@ import datetime
 import textwrap
 
 import discord
-import httpx
 from discord.ext import bridge, commands, pages
 
+from spanner.share.cache import log_feature_cache, starboard_config_cache
 from spanner.share.config import load_config
 from spanner.share.database import GuildConfig, GuildLogFeatures
+from spanner.share.http import http_clients
 
 
 class MetaCog(commands.Cog):
@@ -82,46 +83,46 @@ class MetaCog(commands.Cog):
         from spanner.share.version import __sha__
 
         msg = await ctx.reply("Loading changelog...")
-        async with httpx.AsyncClient(base_url="https://git.i-am.nexus/api/v1/repos/nex/spanner-v3") as client:
-            changes = []
-            page = 0
-            while True:
-                try:
-                    response = await client.get(
-                        "/commits",
-                        params={
-                            "sha": "dev",
-                            "stat": False,
-                            "verification": False,
-                            "files": False,
-                            "page": page,
-                            "limit": "100",
+        client = http_clients.get("changelog")
+        changes = []
+        page = 0
+        while True:
+            try:
+                response = await client.get(
+                    "/commits",
+                    params={
+                        "sha": "dev",
+                        "stat": False,
+                        "verification": False,
+                        "files": False,
+                        "page": page,
+                        "limit": "100",
+                    },
+                )
+            except ConnectionError:
+                return await msg.edit(content="Failed to contact source server.")
+            if response.status_code != 200:
+                break
+            data = response.json()
+            if not data:
+                break
+            for commit in data:
+                _cm = commit["commit"]["message"].strip()
+                cm = _cm.splitlines()[0]
+                changes.append(
+                    {
+                        "sha": commit["sha"],
+                        "created": datetime.datetime.fromisoformat(commit["created"]),
+                        "url": "https://github.com/nexy7574/spanner-v3/commit/" + commit["sha"],
+                        "author": {
+                            "name": commit["commit"]["committer"]["name"],
+                            "url": "https://github.com/" + commit["commit"]["committer"]["name"],
                         },
-                    )
-                except ConnectionError:
-                    return await msg.edit(content="Failed to contact source server.")
-                if response.status_code != 200:
-                    break
-                data = response.json()
-                if not data:
-                    break
-                for commit in data:
-                    _cm = commit["commit"]["message"].strip()
-                    cm = _cm.splitlines()[0]
-                    changes.append(
-                        {
-                            "sha": commit["sha"],
-                            "created": datetime.datetime.fromisoformat(commit["created"]),
-                            "url": "https://github.com/nexy7574/spanner-v3/commit/" + commit["sha"],
-                            "author": {
-                                "name": commit["commit"]["committer"]["name"],
-                                "url": "https://github.com/" + commit["commit"]["committer"]["name"],
-                            },
-                            "current": commit["sha"] == __sha__,
-                            "message": textwrap.shorten(cm, width=100, placeholder="..."),
-                        }
-                    )
-                page += 1
+                        "current": commit["sha"] == __sha__,
+                        "message": textwrap.shorten(cm, width=100, placeholder="..."),
+                    }
+                )
+            page += 1
 
         if not changes:
             return await ctx.reply("No changelog entries found.")
@@ -140,6 +141,11 @@ class MetaCog(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         await GuildConfig.filter(id=guild.id).delete()
+        log_feature_cache.invalidate(guild.id)
+        self.bot.audit_log.forget(guild.id)
+        starboard_config_cache.invalidate(guild.id)
+        if self.bot.message_store is not None:
+            await self.bot.message_store.forget(guild.id)
 
 
 def setup(bot: commands.Bot):
@@ -107,16 +107,12 @@ class SelfRolesCog(commands.Cog):
             channel = ctx.guild.get_channel(menu.channel)
             if not channel:
                 paginator.add_line(f"* **{menu.name}** (missing channel; needs reconfiguring)")
-            message = discord.utils.get(
-                ctx.bot.cached_messages,
-                id=menu.message,
-            )
-            if not message:
-                try:
-                    message = await channel.fetch_message(menu.message)
-                except discord.NotFound:
-                    paginator.add_line(f"* **{menu.name}** (missing message; needs reconfiguring)")
-                    continue
+                continue
+            try:
+                message = await ctx.bot.get_or_fetch_message(channel.id, menu.message)
+            except discord.NotFound:
+                paginator.add_line(f"* **{menu.name}** (missing message; needs reconfiguring)")
+                continue
 
             first_three = list(filter(None, map(ctx.guild.get_role, menu.roles)))[:3]
             rm = ", ".join([role.mention for role in first_three])
@@ -1,12 +1,21 @@
 import fnmatch
+import tempfile
 import typing
 
 import discord
 from discord.ext import bridge, commands
 from tortoise.transactions import in_transaction
 
+from spanner.share.audit_log_export import EXPORT_FORMATS, export_html, export_ndjson, gzip_stream
+from spanner.share.cache import log_feature_cache
 from spanner.share.config import load_config
-from spanner.share.database import GuildAuditLogEntry, GuildConfig, GuildLogFeatures, GuildNickNameModeration
+from spanner.share.database import (
+    GuildAuditLogEntry,
+    GuildConfig,
+    GuildLogFeatures,
+    GuildNickNameModeration,
+    Premium,
+)
 from spanner.share.utils import hyperlink
 from spanner.share.views.confirm import ConfirmView
 from spanner.share.views.settings import NicknameFilterManager
@@ -68,6 +77,7 @@ class SettingsCog(commands.Cog):
                 },
                 using_db=tx,
             )
+        log_feature_cache.invalidate(ctx.guild_id)
 
         await ctx.respond(f"\N{WHITE HEAVY CHECK MARK} Set the log channel to {channel.mention}.")
 
@@ -106,7 +116,8 @@ class SettingsCog(commands.Cog):
                     },
                     using_db=tx,
                 )
-            return log_feature
+        log_feature_cache.invalidate(guild_id, feature)
+        return log_feature
 
     @log_feature.command(name="toggle")
     async def toggle_log_feature(
@@ -237,6 +248,77 @@ class SettingsCog(commands.Cog):
         v = NicknameFilterManager(config)
         await ctx.respond(view=v)
 
+    @settings.command(name="audit-log-retention")
+    async def set_audit_log_retention(
+        self,
+        ctx: discord.ApplicationContext,
+        days: typing.Annotated[
+            int | None,
+            discord.Option(
+                int,
+                description="How many days to keep the audit log for. Omit to keep it for as long as possible.",
+                min_value=1,
+                default=None,
+            ),
+        ],
+    ):
+        """Sets how long spanner's audit log is kept for in this server."""
+        await ctx.defer(ephemeral=True)
+        async with in_transaction() as tx:
+            config = await self._ensure_guild_config(ctx.guild_id)
+            previous = config.audit_log_retention_days
+            config.audit_log_retention_days = days
+            await config.save(using_db=tx)
+            await GuildAuditLogEntry.generate(
+                guild_id=ctx.guild_id,
+                author=ctx.user,
+                namespace="settings.audit_log.retention",
+                action="modify",
+                description=f"Set the audit log retention to {days or 'the maximum'} days.",
+                metadata={
+                    "action.historical": "modified",
+                    "old": {"days": previous},
+                    "new": {"days": days},
+                },
+                using_db=tx,
+            )
+
+        premium = await Premium.filter(guild_id=ctx.guild_id, end__gt=discord.utils.utcnow()).exists()
+        effective = self.bot.audit_log_retention.retention_days(days, premium)
+        await ctx.respond(
+            f"\N{WHITE HEAVY CHECK MARK} Audit log entries will be kept for {effective:,} days."
+            + (f" (Limited from {days:,} days.)" if days is not None and effective < days else "")
+        )
+
+    @settings.command(name="export-audit-log")
+    async def export_audit_log(
+        self,
+        ctx: discord.ApplicationContext,
+        format: typing.Annotated[
+            str, discord.Option(str, description="The format to export in.", choices=["ndjson", "html"], default="html")
+        ],
+    ):
+        """Exports spanner's audit log (configuration changes, etc.) for this server."""
+        await ctx.defer(ephemeral=True)
+        if format == "html":
+            chunks = export_html(ctx.guild)
+        else:
+            chunks = export_ndjson(ctx.guild_id)
+        extension, _ = EXPORT_FORMATS[format]
+
+        # Spooled, so that large exports are written to disk rather than held in memory.
+        buffer = tempfile.SpooledTemporaryFile(max_size=1024 * 1024 * 8)
+        async for chunk in gzip_stream(chunks):
+            buffer.write(chunk)
+        if buffer.tell() > ctx.guild.filesize_limit:
+            buffer.close()
+            return await ctx.respond(
+                "\N{CROSS MARK} The audit log is too large to upload here. You can export it through the API instead."
+            )
+        buffer.seek(0)
+        file = discord.File(buffer, filename="audit-log-%d.%s.gz" % (ctx.guild_id, extension))
+        await ctx.respond("\N{WHITE HEAVY CHECK MARK} Here is this server's audit log:", file=file)
+
 
 def setup(bot):
     bot.add_cog(SettingsCog(bot))
@@ -1,39 +1,105 @@
 import asyncio
 import io
+import logging
 import textwrap
 import typing
+import weakref
 
 import discord
 from discord.ext import commands
 from tortoise.transactions import in_transaction
 
+from spanner.share.cache import LRUCache, starboard_config_cache
+from spanner.share.config import load_config
 from spanner.share.database import GuildAuditLogEntry, GuildConfig, StarboardConfig, StarboardEntry, StarboardMode
 
 
 class StarboardCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.starboard_cache: dict[discord.Message, int] = {}
+        self.log = logging.getLogger("spanner.cogs.starboard")
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        self._pending_updates: dict[int, list] = {}
+        config = load_config().get("cogs", {}).get("starboard", {})
+        self.update_delay: float = config.get("update_delay", 2.0)
+        self.max_update_delay: float = config.get("max_update_delay", 10.0)
+        self.star_counts: LRUCache[tuple[int, int], int] = LRUCache(config.get("cache_size", 10_000))
+        # (channel ID, message ID) -> [reaction events received, last event included in the seeded star count]
+        self.reaction_events: LRUCache[tuple[int, int], list[int]] = LRUCache(config.get("cache_size", 10_000))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await starboard_config_cache.load(guild.id for guild in self.bot.guilds)
 
     @staticmethod
-    async def count_reactions(message: discord.Message, emoji: str, exclude_bots: bool = True) -> int:
-        count = 0
+    def count_reactions(message: discord.Message, emoji: str) -> int:
+        """
+        Counts the reactions on a message with the given emoji, without paginating the users who reacted.
+
+        The bot's own reaction is excluded, however reactions from other bots cannot be told apart without fetching
+        every user, so are included.
+        """
         for reaction in message.reactions:
             if str(reaction.emoji) == emoji:
-                async for user in reaction.users():
-                    if exclude_bots and user.bot:
-                        continue
-                    count += 1
-        return count
+                return max(0, reaction.count - reaction.me)
+        return 0
 
-    async def get_or_fetch_message(self, channel_id: int, message_id: int) -> discord.Message:
+    def receive_reaction_event(self, payload: discord.RawReactionActionEvent) -> int:
+        """
+        Numbers a reaction event for its message, in the order the gateway delivered them.
+
+        This must be called as soon as the event is dispatched (before awaiting anything), as the cached message's
+        reactions are updated straight after.
+        """
+        key = (payload.channel_id, payload.message_id)
+        events = self.reaction_events.get(key)
+        if events is None:
+            events = [0, 0]
+            self.reaction_events.set(key, events)
+        events[0] += 1
+        return events[0]
+
+    def update_star_count(
+        self,
+        message: discord.Message,
+        payload: discord.RawReactionActionEvent,
+        entry: StarboardEntry | None,
+        event: int,
+    ) -> int:
         """
-        Fetches a message from cache where possible, falling back to the API.
+        Updates the star count of a message from a raw reaction event.
+
+        The count is seeded once per message - from the persisted starboard entry if it has been counted, otherwise
+        from the message's reactions - and is then kept up to date incrementally from reaction events.
+        The message's reactions already include every event received before they were counted (including ones still
+        queued behind the message's lock), so those events are skipped rather than counted twice.
+
+        :param message: The starred message
+        :param payload: The reaction event
+        :param entry: The message's existing starboard entry, if any
+        :param event: The event's number, from :meth:`receive_reaction_event`
+        :return: The new star count
         """
-        message: discord.Message | None = discord.utils.get(self.bot.cached_messages, id=message_id)
-        if not message:
-            message: discord.Message = await self.bot.get_channel(channel_id).fetch_message(message_id)
-        return message
+        key = (message.channel.id, message.id)
+        events = self.reaction_events.get(key)
+        if events is None:
+            events = [event, 0]
+            self.reaction_events.set(key, events)
+        delta = 1 if payload.event_type == "REACTION_ADD" else -1
+        count = self.star_counts.get(key)
+        if count is not None:
+            if event <= events[1]:
+                return count
+            count += delta
+        elif entry is not None and entry.star_count is not None:
+            count = entry.star_count + delta
+            events[1] = event
+        else:
+            count = self.count_reactions(message, str(payload.emoji))
+            events[1] = events[0]
+        count = max(0, count)
+        self.star_counts.set(key, count)
+        return count
 
     async def generate_starboard_embed(
         self, message: discord.Message, config: StarboardConfig
@@ -45,7 +111,7 @@ class StarboardCog(commands.Cog):
         :param config: The starboard configuration.
         :return: The created embed
         """
-        star_count = self.starboard_cache.get(message, 0)
+        star_count = self.star_counts.get((message.channel.id, message.id), 0)
         star_emoji_count = config.star_emoji * min(10, star_count)
 
         embed = discord.Embed(
@@ -63,7 +129,7 @@ class StarboardCog(commands.Cog):
         )
         if message.reference:
             try:
-                ref_message = await self.get_or_fetch_message(
+                ref_message = await self.bot.get_or_fetch_message(
                     message.reference.channel_id, message.reference.message_id
                 )
             except discord.HTTPException:
@@ -133,93 +199,134 @@ class StarboardCog(commands.Cog):
 
         return [embed, *filter(lambda e: e.type == "rich", message.embeds)], star_count
 
-    @commands.Cog.listener("on_raw_reaction_add")
-    @commands.Cog.listener("on_raw_reaction_remove")
-    async def reaction_handler(self, payload: discord.RawReactionActionEvent):
-        async with in_transaction() as conn:
-            if payload.user_id == self.bot.user.id or payload.guild_id is None:
-                return
+    def schedule_update(self, message: discord.Message, config: StarboardConfig) -> None:
+        """
+        Schedules the starboard message for a source message to be updated once its reactions settle down.
 
-            guild = self.bot.get_guild(payload.guild_id)
-            if not guild:
-                # Not in guild? Return
-                return
-            source_channel: discord.abc.TextChannel | None = guild.get_channel(payload.channel_id)
-            if not source_channel:
-                # No source channel, return
-                return
+        Each call pushes the update back by `update_delay` seconds, so a burst of reactions results in a single
+        update, however an update is never delayed by more than `max_update_delay` seconds after the first call.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._pending_updates.get(message.id)
+        if pending is None:
+            deadline = loop.time() + self.update_delay
+            self._pending_updates[message.id] = [deadline, loop.time() + self.max_update_delay, message, config]
+            asyncio.create_task(self._debounced_update(message.id), name=f"starboard-update-{message.id}")
+        else:
+            pending[0] = min(loop.time() + self.update_delay, pending[1])
+            pending[2:] = [message, config]
+
+    async def _debounced_update(self, message_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        while (delay := self._pending_updates[message_id][0] - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        _, _, message, config = self._pending_updates.pop(message_id)
+        lock = self._locks.setdefault(message_id, asyncio.Lock())
+        async with lock:
             try:
-                message = await source_channel.fetch_message(payload.message_id)
-            except discord.NotFound:
-                return
+                await self.update_starboard(message, config)
+            except Exception as e:
+                self.log.error("Failed to update the starboard for message %d", message_id, exc_info=e)
+
+    async def update_starboard(self, message: discord.Message, config: StarboardConfig) -> None:
+        """Creates, edits, or removes the starboard message for a source message, based on its current star count."""
+        starboard_channel: discord.TextChannel | None = message.guild.get_channel(config.channel_id)
+        if not starboard_channel:
+            return
+        elif not starboard_channel.can_send(discord.Embed, discord.File):
+            return
 
-            config = await StarboardConfig.get_or_none(guild__id=payload.guild_id, using_db=conn)
-            if not config:
-                return
-            if str(payload.emoji) != config.star_emoji:
-                return
-            if config.allow_bot_messages is False and message.author.bot is True:
-                return
-            if config.allow_self_star is False and message.author.id == payload.user_id:
-                if payload.event_type == "REACTION_ADD":
-                    if message.channel.permissions_for(message.guild.me).manage_messages:
-                        await message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
-                    if message.channel.permissions_for(message.guild.me).send_messages:
-                        await message.channel.send(
-                            f"{message.author.mention}, you cannot star your own messages.", delete_after=10
-                        )
+        embeds, star_count = await self.generate_starboard_embed(message, config)
+        total_stars = star_count
+        if config.star_mode == StarboardMode.PERCENT:
+            star_count = (star_count / message.channel.member_count) / 100
+        enough_stars = star_count >= config.minimum_stars
+        existing_message = await StarboardEntry.get_or_none(
+            source_message_id=message.id, source_channel_id=message.channel.id
+        )
+        if existing_message:
+            try:
+                m = await self.bot.get_or_fetch_message(starboard_channel.id, existing_message.starboard_message_id)
+            except discord.NotFound:
+                await existing_message.delete()
+            else:
+                if enough_stars:
+                    await m.edit(embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+                    existing_message.star_count = total_stars
+                    await existing_message.save(update_fields=["star_count"])
+                else:
+                    await m.delete(reason="Not enough stars.")
+                    await existing_message.delete()
+        elif enough_stars:
+            try:
+                m = await starboard_channel.send(embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+            except discord.HTTPException:
                 return
+            await StarboardEntry.create(
+                source_message_id=message.id,
+                starboard_message_id=m.id,
+                source_channel_id=message.channel.id,
+                config=config,
+                star_count=total_stars,
+            )
 
-            starboard_channel: discord.TextChannel | None = guild.get_channel(config.channel_id)
-            if not starboard_channel:
-                return
-            elif not starboard_channel.can_send(discord.Embed, discord.File):
-                return
+    @commands.Cog.listener("on_raw_reaction_add")
+    @commands.Cog.listener("on_raw_reaction_remove")
+    async def reaction_handler(self, payload: discord.RawReactionActionEvent):
+        if payload.user_id == self.bot.user.id or payload.guild_id is None:
+            return
+        event = self.receive_reaction_event(payload)
 
-            await config.fetch_related("guild")
+        guild = self.bot.get_guild(payload.guild_id)
+        if not guild:
+            # Not in guild? Return
+            return
+        source_channel: discord.abc.TextChannel | None = guild.get_channel(payload.channel_id)
+        if not source_channel:
+            # No source channel, return
+            return
+        config = await starboard_config_cache.get(payload.guild_id)
+        if not config:
+            return
+        if str(payload.emoji) != config.star_emoji:
+            return
+        reactor = payload.member or self.bot.get_user(payload.user_id)
+        if reactor is not None and reactor.bot:
+            # Bots never count towards a message's stars.
+            return
+        try:
+            message = await self.bot.get_or_fetch_message(source_channel.id, payload.message_id)
+        except discord.NotFound:
+            return
 
-            if message not in self.starboard_cache:
-                self.starboard_cache[message] = await self.count_reactions(message, config.star_emoji)
-            else:
-                self.starboard_cache[message] += 1
-
-            embeds, star_count = await self.generate_starboard_embed(message, config)
-            if config.star_mode == StarboardMode.PERCENT:
-                star_count = (star_count / message.channel.member_count) / 100
-            enough_stars = star_count >= config.minimum_stars
-            existing_message = await StarboardEntry.get_or_none(
-                source_message_id=message.id, source_channel_id=source_channel.id, using_db=conn
-            )
-            if existing_message:
-                try:
-                    m = await starboard_channel.fetch_message(existing_message.starboard_message_id)
-                except discord.NotFound:
-                    await existing_message.delete(using_db=conn)
-                else:
-                    if enough_stars:
-                        return await m.edit(embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
-                    else:
-                        await m.delete(reason="Not enough stars.")
-                        return await existing_message.delete(using_db=conn)
-            else:
-                if not enough_stars:
-                    return
-                try:
-                    m = await starboard_channel.send(embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
-                except discord.HTTPException:
-                    return
-                else:
-                    await StarboardEntry.create(
-                        source_message_id=message.id,
-                        starboard_message_id=m.id,
-                        source_channel_id=source_channel.id,
-                        config=config,
-                        using_db=conn,
+        if config.allow_bot_messages is False and message.author.bot is True:
+            return
+        if config.allow_self_star is False and message.author.id == payload.user_id:
+            if payload.event_type == "REACTION_ADD":
+                if message.channel.permissions_for(message.guild.me).manage_messages:
+                    await message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+                if message.channel.permissions_for(message.guild.me).send_messages:
+                    await message.channel.send(
+                        f"{message.author.mention}, you cannot star your own messages.", delete_after=10
                     )
+            return
+
+        lock = self._locks.setdefault(message.id, asyncio.Lock())
+        async with lock:
+            existing_message = None
+            if (message.channel.id, message.id) not in self.star_counts:
+                existing_message = await StarboardEntry.get_or_none(
+                    source_message_id=message.id, source_channel_id=source_channel.id
+                )
+            self.update_star_count(message, payload, existing_message, event)
+        self.schedule_update(message, config)
 
     @commands.Cog.listener("on_raw_reaction_clear")
     async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
-        config = await StarboardConfig.get_or_none(guild__id=payload.guild_id)
+        if payload.guild_id is None:
+            return
+        self.star_counts.pop((payload.channel_id, payload.message_id))
+        config = await starboard_config_cache.get(payload.guild_id)
         if not config:
             return
         existing = await StarboardEntry.get_or_none(
@@ -229,18 +336,21 @@ class StarboardCog(commands.Cog):
             channel = self.bot.get_channel(config.channel_id)
             if channel:
                 try:
-                    await (await channel.fetch_message(existing.starboard_message_id)).delete()
+                    await (await self.bot.get_or_fetch_message(channel.id, existing.starboard_message_id)).delete()
                 except discord.HTTPException:
                     pass
             await existing.delete()
 
     @commands.Cog.listener("on_raw_reaction_clear_emoji")
     async def on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
-        config = await StarboardConfig.get_or_none(guild__id=payload.guild_id)
+        if payload.guild_id is None:
+            return
+        config = await starboard_config_cache.get(payload.guild_id)
         if not config:
             return
         if str(payload.emoji) != config.star_emoji:
             return
+        self.star_counts.pop((payload.channel_id, payload.message_id))
         existing = await StarboardEntry.get_or_none(
             source_message_id=payload.message_id, source_channel_id=payload.channel_id
         )
@@ -248,7 +358,7 @@ class StarboardCog(commands.Cog):
             channel = self.bot.get_channel(config.channel_id)
             if channel:
                 try:
-                    await (await channel.fetch_message(existing.starboard_message_id)).delete()
+                    await (await self.bot.get_or_fetch_message(channel.id, existing.starboard_message_id)).delete()
                 except discord.HTTPException:
                     pass
             await existing.delete()
@@ -361,6 +471,7 @@ class StarboardCog(commands.Cog):
                 description=f"Set the starboard emoji to {_emoji}",
             )
             await ctx.respond(f"\N{WHITE HEAVY CHECK MARK} Starboard channel set to {channel.mention}.")
+        starboard_config_cache.invalidate(ctx.guild.id)
 
     @starboard_group.command(name="set-emoji")
     @discord.default_permissions(manage_channels=True, manage_messages=True)
@@ -405,6 +516,7 @@ class StarboardCog(commands.Cog):
             )
             await ctx.edit(content=f"Starboard emoji set to {reaction.emoji}")
             await m.clear_reactions()
+        starboard_config_cache.invalidate(ctx.guild.id)
 
     @starboard_group.command(name="bot-messages")
     @discord.default_permissions(manage_channels=True, manage_messages=True)
@@ -436,6 +548,7 @@ class StarboardCog(commands.Cog):
                 description=f"{'Enabled' if enable == 'Yes' else 'Disabled'} starring bot messages",
                 metadata={"old": old, "new": config.allow_bot_messages},
             )
+        starboard_config_cache.invalidate(ctx.guild.id)
         await ctx.respond(
             "\N{WHITE HEAVY CHECK MARK} Bot messages can be %sstarred." % ("no longer be " if enable == "No" else "")
         )
@@ -470,6 +583,7 @@ class StarboardCog(commands.Cog):
                 description=f"{'Enabled' if enable == 'Yes' else 'Disabled'} self-starring",
                 metadata={"old": old, "new": config.allow_self_star},
             )
+        starboard_config_cache.invalidate(ctx.guild.id)
         await ctx.respond(
             "\N{WHITE HEAVY CHECK MARK} Users can now %sstar their own messages."
             % ("no longer " if enable == "No" else "")
@@ -523,6 +637,7 @@ class StarboardCog(commands.Cog):
                     },
                 },
             )
+        starboard_config_cache.invalidate(ctx.guild.id)
         await ctx.respond(f"\N{WHITE HEAVY CHECK MARK} Starboard threshold set to {value} {mode.name.lower()}.")
 
 
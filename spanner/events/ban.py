@@ -4,6 +4,8 @@ import discord
 from discord.ext import bridge, commands
 
 from spanner.cogs.user_info import UserInfo
+from spanner.share.audit_log import PendingMatchStore
+from spanner.share.log_dispatcher import LogEntry
 from spanner.share.utils import get_log_channel
 
 
@@ -11,37 +13,64 @@ class BanEvents(commands.Cog):
     def __init__(self, bot: bridge.Bot):
         self.bot = bot
         self.log = logging.getLogger("spanner.events.ban")
-        self.awaiting_audit_log = {}
+        self.pending: PendingMatchStore[tuple[LogEntry, discord.Embed]] = PendingMatchStore(ttl=600, max_size=1000)
+
+    @staticmethod
+    def add_audit_log_details(embed: discord.Embed, entry: discord.AuditLogEntry) -> None:
+        """Adds the moderator and reason from an audit log entry to a ban or unban embed."""
+        if entry.reason:
+            embed.add_field(name="Reason", value=entry.reason[:1024])
+        embed.set_author(name="Moderator: %s" % entry.user.display_name, icon_url=entry.user.display_avatar.url)
+        kind = "Ban" if entry.action == discord.AuditLogAction.ban else "Unban"
+        embed.set_footer(text="%s details fetched from audit log." % kind)
+
+    async def find_audit_log_entry(
+        self, guild: discord.Guild, user: discord.abc.User, action: discord.AuditLogAction
+    ) -> discord.AuditLogEntry | None:
+        """Finds the audit log entry for a ban or unban, if it has already been received."""
+        entry = self.bot.audit_log.get(guild.id, action, user.id)
+        if entry is None and not self.bot.intents.moderation:
+            # The gateway will never deliver the entry, so fall back to paging the audit log.
+            async for audit_log in guild.audit_logs(action=action):
+                if audit_log.target == user:
+                    return audit_log
+        return entry
+
+    async def expect_audit_log_entry(
+        self,
+        guild: discord.Guild,
+        user: discord.abc.User,
+        action: discord.AuditLogAction,
+        log_entry: LogEntry,
+        embed: discord.Embed,
+    ) -> None:
+        """Updates a sent log with the audit log entry for a ban or unban, once it arrives."""
+        if not self.bot.intents.moderation:
+            return
+        # The entry may have arrived while the log was being sent.
+        entry = self.bot.audit_log.get(guild.id, action, user.id)
+        if entry is None:
+            self.pending.add(guild.id, user.id, action, (log_entry, embed))
+            return
+        self.add_audit_log_details(embed, entry)
+        try:
+            await log_entry.edit(embeds=[embed, *log_entry.embeds[1:]])
+        except discord.HTTPException:
+            pass
 
     @commands.Cog.listener()
     async def on_audit_log_entry(self, entry: discord.AuditLogEntry):
-        for values in self.awaiting_audit_log.copy().values():
-            if values["target"] == entry.target:
-                if values["guild"] == entry["guild"]:
-                    if values["type"] == "ban" and entry.action == discord.AuditLogAction.ban:
-                        values["embed"].set_author(
-                            name="Moderator: %s" % entry.user.display_name, icon_url=entry.user.display_avatar.url
-                        )
-                        values["embed"].set_footer(text="Ban details fetched from audit log.")
-                        if entry.reason:
-                            values["embed"].add_field(name="Reason", value=entry.reason[:1024])
-                        try:
-                            await values["message"].edit(embed=values["embed"])
-                        except discord.HTTPException:
-                            pass
-                        self.awaiting_audit_log.pop(values["message"].user_id)
-                    elif values["type"] == "unban" and entry.action == discord.AuditLogAction.unban:
-                        values["embed"].set_author(
-                            name="Moderator: %s" % entry.user.display_name, icon_url=entry.user.display_avatar.url
-                        )
-                        values["embed"].set_footer(text="Unban details fetched from audit log.")
-                        if entry.reason:
-                            values["embed"].add_field(name="Reason", value=entry.reason[:1024])
-                        try:
-                            await values["message"].edit(embed=values["embed"])
-                        except discord.HTTPException:
-                            pass
-                        self.awaiting_audit_log.pop(values["message"].user_id)
+        if entry.action not in (discord.AuditLogAction.ban, discord.AuditLogAction.unban):
+            return
+        pending = self.pending.pop(entry)
+        if pending is None:
+            return
+        log_entry, embed = pending
+        self.add_audit_log_details(embed, entry)
+        try:
+            await log_entry.edit(embeds=[embed, *log_entry.embeds[1:]])
+        except discord.HTTPException:
+            pass
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild: discord.Guild, user: discord.User | discord.Member):
@@ -84,32 +113,19 @@ class BanEvents(commands.Cog):
                 timestamp=discord.utils.utcnow(),
             )
 
-        found_reason = False
+        audit_log = None
         if guild.me.guild_permissions.view_audit_log:
-            async for audit_log in guild.audit_logs(action=discord.AuditLogAction.ban):
-                if audit_log.target == user:
-                    if audit_log.reason:
-                        embed.add_field(name="Reason", value=audit_log.reason[:1024])
-                    embed.set_author(
-                        name="Moderator: %s" % audit_log.user.display_name, icon_url=audit_log.user.display_avatar.url
-                    )
-                    embed.set_footer(text="Ban details fetched from audit log.")
-                    found_reason = False
-                    break
+            audit_log = await self.find_audit_log_entry(guild, user, discord.AuditLogAction.ban)
+            if audit_log is not None:
+                self.add_audit_log_details(embed, audit_log)
         else:
             embed.set_footer(text="Ban details could not be fetched from audit log - missing permissions.")
         embed.set_thumbnail(url=user.display_avatar.url)
         cog = UserInfo(self.bot)
         user_info_embed = (await cog.get_info(user))["Overview"]
-        msg = await log_channel.send(embeds=[embed, user_info_embed])
-        if not found_reason:
-            self.awaiting_audit_log[msg.id] = {
-                "target": user,
-                "guild": guild,
-                "message": msg,
-                "embed": embed,
-                "type": "ban",
-            }
+        log_entry = await self.bot.log_dispatcher.send(guild.id, "member.ban", embeds=[embed, user_info_embed])
+        if log_entry is not None and audit_log is None and guild.me.guild_permissions.view_audit_log:
+            await self.expect_audit_log_entry(guild, user, discord.AuditLogAction.ban, log_entry, embed)
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild: discord.Guild, user: discord.User):
@@ -129,33 +145,20 @@ class BanEvents(commands.Cog):
             timestamp=discord.utils.utcnow(),
         )
 
-        found_reason = False
+        audit_log = None
         if guild.me.guild_permissions.view_audit_log:
-            async for audit_log in guild.audit_logs(action=discord.AuditLogAction.unban):
-                if audit_log.target == user:
-                    if audit_log.reason:
-                        embed.add_field(name="Reason", value=audit_log.reason[:1024])
-                    embed.set_author(
-                        name="Moderator: %s" % audit_log.user.display_name, icon_url=audit_log.user.display_avatar.url
-                    )
-                    embed.set_footer(text="Unban details fetched from audit log.")
-                    found_reason = False
-                    break
+            audit_log = await self.find_audit_log_entry(guild, user, discord.AuditLogAction.unban)
+            if audit_log is not None:
+                self.add_audit_log_details(embed, audit_log)
         else:
             embed.set_footer(text="Unban details could not be fetched from audit log - missing permissions.")
 
         embed.set_thumbnail(url=user.display_avatar.url)
         cog = UserInfo(self.bot)
         user_info_embed = (await cog.get_info(user))["Overview"]
-        msg = await log_channel.send(embeds=[embed, user_info_embed])
-        if not found_reason:
-            self.awaiting_audit_log[msg.id] = {
-                "target": user,
-                "guild": guild,
-                "message": msg,
-                "embed": embed,
-                "type": "unban",
-            }
+        log_entry = await self.bot.log_dispatcher.send(guild.id, "member.unban", embeds=[embed, user_info_embed])
+        if log_entry is not None and audit_log is None and guild.me.guild_permissions.view_audit_log:
+            await self.expect_audit_log_entry(guild, user, discord.AuditLogAction.unban, log_entry, embed)
 
 
 def setup(bot: bridge.Bot):
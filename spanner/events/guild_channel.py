@@ -1,5 +1,3 @@
-import asyncio
-import datetime
 import logging
 
 import discord
@@ -16,31 +14,7 @@ class GuildChannelEvents(commands.Cog):
         self.log.setLevel(logging.DEBUG)
 
     async def wait_for_audit_log(self, channel: discord.abc.GuildChannel, action: discord.AuditLogAction):
-        def the_check(e: discord.AuditLogEntry):
-            if e.target == channel and e.action == action:
-                return True
-            return False
-
-        if not channel.guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(seconds=59)
-        async for entry in channel.guild.audit_logs(after=after, action=action):
-            if the_check(entry):
-                return entry
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a channel change.",
-                channel.guild,
-                channel,
-            )
-        else:
-            return entry
+        return await self.bot.audit_log.wait_for(channel.guild, action, channel.id)
 
     @commands.Cog.listener()
     async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
@@ -51,8 +25,11 @@ class GuildChannelEvents(commands.Cog):
         cog = ChannelInfoCog(self.bot)
         embeds = await cog.get_channel_info(channel)
         embeds["Overview"].title = f"Channel created: {channel.name}"
-        msg = await log_channel.send(embeds=list(embeds.values()))
-        await asyncio.sleep(3)
+        log_entry = await self.bot.log_dispatcher.send(
+            channel.guild.id, "server.channel.create", embeds=list(embeds.values())
+        )
+        if log_entry is None:
+            return
         entry = await self.wait_for_audit_log(channel, discord.AuditLogAction.channel_create)
         if entry:
             embeds["Overview"].set_author(
@@ -61,7 +38,7 @@ class GuildChannelEvents(commands.Cog):
             embeds["Overview"].set_footer(text="Details fetched from audit log.")
             if entry.reason:
                 embeds["Overview"].add_field(name="Reason", value=entry.reason, inline=False)
-        await msg.edit(embeds=list(embeds.values()))
+        await log_entry.edit(embeds=list(embeds.values()))
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
@@ -74,9 +51,12 @@ class GuildChannelEvents(commands.Cog):
         for _embed in embeds.values():
             _embed.colour = discord.Colour.red()
         embeds["Overview"].title = f"Channel deleted: {channel.name}"
-        msg = await log_channel.send(embeds=list(embeds.values()))
-        await asyncio.sleep(3)
-        entry = await self.wait_for_audit_log(channel, discord.AuditLogAction.channel_create)
+        log_entry = await self.bot.log_dispatcher.send(
+            channel.guild.id, "server.channel.delete", embeds=list(embeds.values())
+        )
+        if log_entry is None:
+            return
+        entry = await self.wait_for_audit_log(channel, discord.AuditLogAction.channel_delete)
         if entry:
             embeds["Overview"].set_author(
                 name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url
@@ -84,7 +64,7 @@ class GuildChannelEvents(commands.Cog):
             embeds["Overview"].set_footer(text="Details fetched from audit log.")
             if entry.reason:
                 embeds["Overview"].add_field(name="Reason", value=entry.reason, inline=False)
-        await msg.edit(embeds=list(embeds.values()))
+        await log_entry.edit(embeds=list(embeds.values()))
 
 
 def setup(bot):
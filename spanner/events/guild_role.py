@@ -1,5 +1,3 @@
-import asyncio
-import datetime
 import logging
 
 import discord
@@ -16,31 +14,7 @@ class GuildRoleEvents(commands.Cog):
         self.log.setLevel(logging.DEBUG)
 
     async def wait_for_audit_log(self, role: discord.Role, action: discord.AuditLogAction):
-        def the_check(e: discord.AuditLogEntry):
-            if e.target == role and e.action == action:
-                return True
-            return False
-
-        if not role.guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(seconds=59)
-        async for entry in role.guild.audit_logs(after=after, action=action):
-            if the_check(entry):
-                return entry
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a role change.",
-                role.guild,
-                role,
-            )
-        else:
-            return entry
+        return await self.bot.audit_log.wait_for(role.guild, action, role.id)
 
     @commands.Cog.listener()
     async def on_guild_role_create(self, role: discord.Role):
@@ -52,7 +26,9 @@ class GuildRoleEvents(commands.Cog):
         cog = RoleInfoCog(self.bot)
         embed2 = (await cog.get_role_info(role))["Overview"]
 
-        msg = await log_channel.send(embeds=[embed, embed2])
+        log_entry = await self.bot.log_dispatcher.send(role.guild.id, "server.role.create", embeds=[embed, embed2])
+        if log_entry is None:
+            return
         entry = await self.wait_for_audit_log(role, discord.AuditLogAction.role_create)
         if entry is None:
             return
@@ -60,7 +36,7 @@ class GuildRoleEvents(commands.Cog):
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Details fetched from audit log.")
-        await msg.edit(embeds=[embed, embed2])
+        await log_entry.edit(embeds=[embed, embed2])
 
     async def on_guild_role_permissions_update(self, before: discord.Role, after: discord.Role):
         log_channel = await get_log_channel(self.bot, after.guild.id, "server.role.permissions.edit")
@@ -78,15 +54,19 @@ class GuildRoleEvents(commands.Cog):
         )
         cog = RoleInfoCog(self.bot)
         role_info_embed = (await cog.get_role_info(after))["Overview"]
-        msg = await log_channel.send(embeds=[embed, role_info_embed])
-        entry = await self.wait_for_audit_log(after, discord.AuditLogAction.role_delete)
+        log_entry = await self.bot.log_dispatcher.send(
+            after.guild.id, "server.role.permissions.edit", embeds=[embed, role_info_embed]
+        )
+        if log_entry is None:
+            return
+        entry = await self.wait_for_audit_log(after, discord.AuditLogAction.role_update)
         if entry is None:
             return
 
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Details fetched from audit log.")
-        await msg.edit(embeds=[embed, role_info_embed])
+        await log_entry.edit(embeds=[embed, role_info_embed])
 
     @commands.Cog.listener()
     async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
@@ -110,15 +90,19 @@ class GuildRoleEvents(commands.Cog):
         embed3 = (await RoleInfoCog(self.bot).get_role_info(after))["Overview"]
         embed3.title = "[After] " + embed3.title
 
-        msg = await log_channel.send(embeds=[embed, embed2, embed3])
-        entry = await self.wait_for_audit_log(after, discord.AuditLogAction.role_delete)
+        log_entry = await self.bot.log_dispatcher.send(
+            after.guild.id, "server.role.edit", embeds=[embed, embed2, embed3]
+        )
+        if log_entry is None:
+            return
+        entry = await self.wait_for_audit_log(after, discord.AuditLogAction.role_update)
         if entry is None:
             return
 
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Details fetched from audit log.")
-        await msg.edit(embeds=[embed, embed2, embed3])
+        await log_entry.edit(embeds=[embed, embed2, embed3])
 
     @commands.Cog.listener()
     async def on_guild_role_delete(self, role: discord.Role):
@@ -129,7 +113,9 @@ class GuildRoleEvents(commands.Cog):
         embed = discord.Embed(title=f"Role deleted: {role.name}", colour=discord.Colour.red())
         embed2 = (await RoleInfoCog(self.bot).get_role_info(role))["Overview"]
 
-        msg = await log_channel.send(embeds=[embed, embed2])
+        log_entry = await self.bot.log_dispatcher.send(role.guild.id, "server.role.delete", embeds=[embed, embed2])
+        if log_entry is None:
+            return
         entry = await self.wait_for_audit_log(role, discord.AuditLogAction.role_delete)
         if entry is None:
             return
@@ -137,7 +123,7 @@ class GuildRoleEvents(commands.Cog):
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Details fetched from audit log.")
-        await msg.edit(embeds=[embed, embed2])
+        await log_entry.edit(embeds=[embed, embed2])
 
 
 def setup(bot):
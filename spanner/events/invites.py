@@ -21,7 +21,9 @@ class InviteEvents(commands.Cog):
         invite_info_embeds = await InviteInfo.get_discord_invite_info(invite)
         invite_info_embeds["Overview"].title = "Invite created: " + invite.code
         invite_info_embeds["Overview"].colour = discord.Colour.green()
-        await log_channel.send(embeds=list(invite_info_embeds.values()))
+        await self.bot.log_dispatcher.send(
+            invite.guild.id, "server.invite.create", embeds=list(invite_info_embeds.values())
+        )
 
     @commands.Cog.listener()
     async def on_invite_delete(self, invite: discord.Invite):
@@ -32,7 +34,9 @@ class InviteEvents(commands.Cog):
         invite_info_embeds = await InviteInfo.get_discord_invite_info(invite)
         invite_info_embeds["Overview"].title = "Invite deleted: " + invite.code
         invite_info_embeds["Overview"].colour = discord.Colour.red()
-        await log_channel.send(embeds=list(invite_info_embeds.values()))
+        await self.bot.log_dispatcher.send(
+            invite.guild.id, "server.invite.delete", embeds=list(invite_info_embeds.values())
+        )
 
 
 def setup(bot):
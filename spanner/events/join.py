@@ -31,7 +31,7 @@ class JoinEvents(commands.Cog):
             timestamp=discord.utils.utcnow(),
         )
         embed.set_thumbnail(url=member.display_avatar.url)
-        await log_channel.send(embeds=[embed, user_info_embed])
+        await self.bot.log_dispatcher.send(member.guild.id, "member.join", embeds=[embed, user_info_embed])
 
 
 def setup(bot: bridge.Bot):
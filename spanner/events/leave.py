@@ -8,6 +8,7 @@ import discord
 from discord.ext import bridge, commands
 
 from spanner.cogs.user_info import UserInfo
+from spanner.share.log_dispatcher import LogEntry
 from spanner.share.utils import get_log_channel
 
 
@@ -15,30 +16,10 @@ class LeaveEvents(commands.Cog):
     def __init__(self, bot: bridge.Bot):
         self.bot = bot
         self.log = logging.getLogger("spanner.events.leave")
-        self.leave_messages: typing.Deque[dict[discord.Member, discord.Message]] = collections.deque(maxlen=1000)
+        self.leave_messages: typing.Deque[dict[discord.Member, LogEntry]] = collections.deque(maxlen=1000)
 
     async def wait_for_audit_log(self, guild: discord.Guild, target: discord.Member):
-        if not guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(minutes=2)
-        async for entry in guild.audit_logs(after=after, action=discord.AuditLogAction.kick):
-            if entry.target == target:
-                return entry
-
-        def the_check(e: discord.AuditLogEntry):
-            return e.target == target and e.action == discord.AuditLogAction.kick
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a kick.", guild, target
-            )
-        else:
-            return entry
+        return await self.bot.audit_log.wait_for(guild, discord.AuditLogAction.kick, target.id, lookback=120)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
@@ -59,9 +40,11 @@ class LeaveEvents(commands.Cog):
         cog = UserInfo(self.bot)
         user_info_embed = (await cog.get_member_info(member))["Overview"]
         embed.set_thumbnail(url=member.display_avatar.url)
-        message = await log_channel.send(embeds=[embed, user_info_embed])
+        log_entry = await self.bot.log_dispatcher.send(member.guild.id, "member.leave", embeds=[embed, user_info_embed])
+        if log_entry is None:
+            return
+        self.leave_messages.append({member: log_entry})
         entry = await self.wait_for_audit_log(member.guild, member)
-        self.leave_messages.append({member: message})
         if entry:
             embed.title = "Member kicked!"
             embed.colour = discord.Colour.gold()
@@ -69,7 +52,7 @@ class LeaveEvents(commands.Cog):
             embed.set_footer(text="Kick details fetched from audit log.")
             if entry.reason:
                 embed.add_field(name="Reason", value=entry.reason, inline=False)
-            await message.edit(embeds=[embed, user_info_embed])
+            await log_entry.edit(embeds=[embed, user_info_embed])
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild: discord.Guild, user: discord.User | discord.Member):
@@ -78,20 +61,21 @@ class LeaveEvents(commands.Cog):
             if item.get(user):
                 if list(item.keys())[0].guild != guild:
                     continue
-                message = item[user]
+                log_entry = item[user]
+                self.leave_messages.remove(item)
                 e = discord.utils.utcnow() + datetime.timedelta(seconds=60)
-                await message.edit(
-                    content=f"This message will self-destruct {discord.utils.format_dt(e, 'R')}.",
-                    delete_after=60,
+                await log_entry.edit(
                     embeds=[
-                        *message.embeds,
+                        *log_entry.embeds,
                         discord.Embed(
                             description="This user was actually banned. If you have the `member.ban` feature enabled,"
-                            " a ban log will be sent shortly."
+                            " a ban log will be sent shortly.\n"
+                            f"This log will self-destruct {discord.utils.format_dt(e, 'R')}."
                         ),
                     ],
                 )
-                self.leave_messages.remove(item)
+                await log_entry.delete(delay=60)
+                break
 
 
 def setup(bot: bridge.Bot):
@@ -52,7 +52,9 @@ class AvatarEvents(commands.Cog):
             files = list(filter(None, files))
             cog = UserInfo(self.bot)
             user_info_embed = (await cog.get_member_info(after))["Overview"]
-            await log_channel.send(embeds=[embed, user_info_embed], files=files)
+            await self.bot.log_dispatcher.send(
+                after.guild.id, "member.avatar-change", embeds=[embed, user_info_embed], files=files
+            )
 
 
 def setup(bot: bridge.Bot):
@@ -1,10 +1,21 @@
+import asyncio
+import datetime
 import io
 import logging
 
 import discord
 from discord.ext import bridge, commands
 
-from spanner.share.utils import format_html, get_log_channel
+from spanner.share.message_store import StoredMessage
+from spanner.share.transcripts import AttachmentBudget
+from spanner.share.utils import get_log_channel
+
+# How many deleted messages go into each bulk delete transcript.
+TRANSCRIPT_CHUNK_SIZE = 100
+# How many of a bulk delete's transcripts are built (and held in memory) at once.
+TRANSCRIPT_CONCURRENCY = 2
+# How many (base64-encoded) bytes of attachments may be embedded across all of a bulk delete's transcripts.
+BULK_DELETE_ATTACHMENT_BUDGET = 1024 * 1024 * 32
 
 
 class MessageEvents(commands.Cog):
@@ -44,7 +55,7 @@ class MessageEvents(commands.Cog):
         if message.embeds:
             for embed in message.embeds[:9]:
                 embeds.append(embed)
-        await log_channel.send(embeds=embeds)
+        await self.bot.log_dispatcher.send(message.guild.id, "message.delete", embeds=embeds)
 
     @commands.Cog.listener()
     async def on_bulk_message_delete(self, messages: list[discord.Message]):
@@ -54,33 +65,89 @@ class MessageEvents(commands.Cog):
             return
 
         now = discord.utils.utcnow()
-        embeds = {}
-        for n, messages_chunk in enumerate(discord.utils.as_chunks(iter(messages), 10), start=1):
-            files = []
-            for message in messages_chunk:
-                html = await format_html(message)
-                if html:
-                    files.append(
-                        discord.File(
-                            io.BytesIO(html.encode()),
-                            filename=f"{message.author.display_name}-{message.id}"[:27] + ".html",
-                            description="The message content in HTML format.",
-                        )
-                    )
-            embed = discord.Embed(
-                title=f"{len(messages):,} messages deleted in {messages[0].channel.name}:",
-                description="Check the files for more details.",
-                color=discord.Color.red(),
-                timestamp=now,
-            )
-            embed.set_footer(text=f"Chunk {n}/{len(messages_chunk)}", icon_url=self.bot.user.display_avatar.url)
-            embeds[embed] = files
+        chunks = list(discord.utils.as_chunks(iter(messages), TRANSCRIPT_CHUNK_SIZE))
+        # Chunks take turns, in order, so that a large purge neither holds every transcript in memory at once, nor
+        # downloads more attachments than one budget allows for the whole purge.
+        semaphore = asyncio.Semaphore(TRANSCRIPT_CONCURRENCY)
+        budget = AttachmentBudget(BULK_DELETE_ATTACHMENT_BUDGET)
+
+        async def send_chunk(n: int, messages_chunk: list[discord.Message]):
+            async with semaphore:
+                transcript = await self.bot.transcripts.build(
+                    messages_chunk, filename=f"deleted-messages-{messages_chunk[0].channel.id}-{n}.html", budget=budget
+                )
+                embed = discord.Embed(
+                    title=f"{len(messages):,} messages deleted in {messages[0].channel.name}:",
+                    description="Check the file for more details.",
+                    color=discord.Color.red(),
+                    timestamp=now,
+                )
+                embed.set_footer(text=f"Chunk {n}/{len(chunks)}", icon_url=self.bot.user.display_avatar.url)
+                await self.bot.log_dispatcher.send(
+                    messages[0].guild.id, "message.delete", embeds=[embed], files=[transcript]
+                )
+
+        await asyncio.gather(*(send_chunk(n, chunk) for n, chunk in enumerate(chunks, start=1)))
 
-        first_message = None
-        for embed, files in embeds.items():
-            m = await log_channel.send(embed=embed, files=files, reference=first_message)
-            if not first_message:
-                first_message = m
+    @staticmethod
+    def edit_log(
+        channel: discord.abc.GuildChannel,
+        author: discord.abc.User,
+        before_content: str,
+        after_content: str,
+        *,
+        created_at: datetime.datetime,
+        edited_at: datetime.datetime | None,
+        jump_url: str,
+    ) -> tuple[discord.Embed, list[discord.File]]:
+        """Builds the log embed (and any overflow files) for an edited message."""
+        embed = discord.Embed(
+            title=f"[click to jump] Message edited in #{channel.name}:",
+            color=discord.Color.red(),
+            timestamp=edited_at or discord.utils.utcnow(),
+            url=jump_url,
+        )
+        embed.set_author(name=author.display_name, icon_url=author.display_avatar.url, url=author.jump_url)
+        embed.add_field(
+            name="Info:",
+            value=f"Author: {author.mention} (`{author.id}`)\n"
+            f"Created: {discord.utils.format_dt(created_at, 'R')}\n"
+            f"Edited: {discord.utils.format_dt(edited_at or discord.utils.utcnow(), 'R')}\n"
+            f"Tip: You can right-click on [this message]({jump_url}) and click 'message info' to see more.",
+        )
+        files = []
+        if len(before_content) > 1024:
+            files.append(
+                discord.File(
+                    io.BytesIO(before_content.encode(errors="replace")),
+                    filename="before.txt",
+                    description="The content of the message before it was edited.",
+                )
+            )
+            embed.add_field(
+                name="Before:",
+                value="The content of the message before it was edited is too long to display here. "
+                "Please see the attached file: `before.txt`.",
+                inline=False,
+            )
+        else:
+            embed.add_field(name="Before:", value=before_content, inline=False)
+        if len(after_content) > 1024:
+            files.append(
+                discord.File(
+                    io.BytesIO(after_content.encode(errors="replace")),
+                    filename="after.txt",
+                    description="The content of the message after it was edited.",
+                )
+            )
+            embed.add_field(
+                name="After:",
+                value="The content of the message after it was edited is too long to display here. "
+                "Please see the attached file: `after.txt`.",
+            )
+        else:
+            embed.add_field(name="After:", value=after_content)
+        return embed, files
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: discord.Message, after: discord.Message):
@@ -93,56 +160,110 @@ class MessageEvents(commands.Cog):
         if log_channel is None:
             return
 
+        embed, files = self.edit_log(
+            after.channel,
+            after.author,
+            before.content,
+            after.content,
+            created_at=after.created_at,
+            edited_at=after.edited_at,
+            jump_url=after.jump_url,
+        )
+        await self.bot.log_dispatcher.send(after.guild.id, "message.edit", embeds=[embed], files=files)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if self.bot.message_store is None or message.guild is None or message.author == self.bot.user:
+            return
+        self.bot.message_store.add(message)
+
+    async def get_stored_author(self, stored: StoredMessage) -> discord.User | discord.Member | None:
+        guild = self.bot.get_guild(stored.guild_id)
+        author = (guild and guild.get_member(stored.author_id)) or self.bot.get_user(stored.author_id)
+        if author is None:
+            try:
+                author = await self.bot.fetch_user(stored.author_id)
+            except discord.HTTPException as e:
+                self.log.warning("Failed to fetch the author of stored message %d.", stored.id, exc_info=e)
+        return author
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if self.bot.message_store is None or payload.guild_id is None:
+            return
+        before = await self.bot.message_store.update(payload)
+        # Cached messages are logged by on_message_edit.
+        if before is None or payload.cached_message is not None:
+            return
+        after = before.apply_update(payload.data)
+        if after.content == before.content:
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        log_channel = await self.get_log_channel(payload.guild_id, "message.edit")
+        if log_channel is None:
+            return
+
+        author = await self.get_stored_author(before)
+        if author is None:
+            return
+        embed, files = self.edit_log(
+            channel,
+            author,
+            before.content,
+            after.content,
+            created_at=before.created,
+            edited_at=after.edited,
+            jump_url=before.jump_url,
+        )
+        embed.set_footer(text="This message was not cached, so was recovered from the message store.")
+        await self.bot.log_dispatcher.send(payload.guild_id, "message.edit", embeds=[embed], files=files)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if self.bot.message_store is None or payload.guild_id is None:
+            return
+        stored = await self.bot.message_store.get(payload.message_id)
+        self.bot.message_store.remove(payload.message_id)
+        # Cached messages are logged by on_message_delete.
+        if stored is None or payload.cached_message is not None:
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        log_channel = await self.get_log_channel(payload.guild_id, "message.delete")
+        if log_channel is None:
+            return
+
+        author = await self.get_stored_author(stored)
         embed = discord.Embed(
-            title=f"[click to jump] Message edited in #{after.channel.name}:",
+            title=f"Message deleted in #{channel.name}:",
+            description=stored.content or "*No content.*",
             color=discord.Color.red(),
-            timestamp=after.edited_at or discord.utils.utcnow(),
-            url=after.jump_url,
-        )
-        embed.set_author(
-            name=after.author.display_name, icon_url=after.author.display_avatar.url, url=after.author.jump_url
+            timestamp=discord.utils.utcnow(),
         )
+        if author is not None:
+            embed.set_author(name=author.display_name, icon_url=author.display_avatar.url, url=author.jump_url)
+        else:
+            embed.set_author(name=stored.author_name, icon_url=stored.author_avatar)
         embed.add_field(
             name="Info:",
-            value=f"Author: {after.author.mention} (`{after.author.id}`)\n"
-            f"Created: {discord.utils.format_dt(after.created_at, 'R')}\n"
-            f"Edited: {discord.utils.format_dt(after.edited_at, 'R')}\n"
-            f"Tip: You can right-click on [this message]({after.jump_url}) and click 'message info' to see more.",
+            value=f"Author: <@{stored.author_id}> (`{stored.author_id}`)\n"
+            f"Created: {discord.utils.format_dt(stored.created, 'R')}\n"
+            f"Was pinned: {stored.pinned}",
         )
-        files = []
-        if before.content != after.content:
-            if len(before.content) > 1024:
-                files.append(
-                    discord.File(
-                        io.BytesIO(before.content.encode(errors="replace")),
-                        filename="before.txt",
-                        description="The content of the message before it was edited.",
-                    )
-                )
-                embed.add_field(
-                    name="Before:",
-                    value="The content of the message before it was edited is too long to display here. "
-                    "Please see the attached file: `before.txt`.",
-                    inline=False,
-                )
-            else:
-                embed.add_field(name="Before:", value=before.content, inline=False)
-            if len(after.content) > 1024:
-                files.append(
-                    discord.File(
-                        io.BytesIO(after.content.encode(errors="replace")),
-                        filename="after.txt",
-                        description="The content of the message after it was edited.",
-                    )
-                )
-                embed.add_field(
-                    name="After:",
-                    value="The content of the message after it was edited is too long to display here. "
-                    "Please see the attached file: `after.txt`.",
-                )
-            else:
-                embed.add_field(name="After:", value=after.content)
-        await log_channel.send(embed=embed, files=files)
+        if stored.attachments:
+            embed.add_field(
+                name="Attachments:",
+                value="\n".join(
+                    f"* [{attachment['filename']}]({attachment['url']})" for attachment in stored.attachments
+                )[:1024],
+                inline=False,
+            )
+        embed.set_footer(text="This message was not cached, so was recovered from the message store.")
+        embeds = [embed, *stored.to_embeds()[:9]]
+        await self.bot.log_dispatcher.send(payload.guild_id, "message.delete", embeds=embeds)
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
@@ -157,12 +278,41 @@ class MessageEvents(commands.Cog):
                 self.log.debug("[raw bulk] Found a known message: %r", message.id)
                 unknown_messages.remove(message.id)
 
+        stored = {}
+        if self.bot.message_store is not None:
+            self.bot.message_store.remove(*payload.message_ids)
+            if unknown_messages:
+                stored = await self.bot.message_store.get_many(unknown_messages)
+                unknown_messages -= stored.keys()
+
+        channel = self.bot.get_channel(payload.channel_id)
+        if stored:
+            self.log.debug("[raw bulk] Recovered %d messages from the message store.", len(stored))
+            embed = discord.Embed(
+                title=f"{len(stored):,} stored messages deleted in #{channel.name}:",
+                description="These messages were not cached, so were recovered from the message store. "
+                "Check the file for more details.",
+                color=discord.Color.red(),
+                timestamp=discord.utils.utcnow(),
+            )
+            transcript = "\n\n".join(
+                f"[{message.created.isoformat()}] {message.author_name} ({message.author_id}):\n"
+                + (message.content or "*No content.*")
+                + "".join(f"\n[Attachment: {attachment['url']}]" for attachment in message.attachments)
+                for message in sorted(stored.values())
+            )
+            file = discord.File(
+                io.BytesIO(transcript.encode(errors="replace")),
+                filename=f"deleted-messages-{payload.channel_id}.txt",
+                description="The deleted messages that were recovered from the message store.",
+            )
+            await self.bot.log_dispatcher.send(payload.guild_id, "message.delete.bulk", embeds=[embed], files=[file])
+
         if not unknown_messages:
             self.log.debug("[raw bulk] There were no unknown messages, event handled entirely by cache.")
             return
         self.log.debug("[raw bulk] Found %d unknown messages.", len(unknown_messages))
 
-        channel = self.bot.get_channel(payload.channel_id)
         embed = discord.Embed(
             title=f"{len(unknown_messages):,} unknown messages deleted in #{channel.name}:",
             description=f"{len(payload.message_ids):,} messages were deleted, "
@@ -174,7 +324,7 @@ class MessageEvents(commands.Cog):
             known = len(payload.message_ids) - len(unknown_messages)
             embed.description += f"\nYou may receive a message containing {known:,} known messages."
 
-        await log_channel.send(embed=embed)
+        await self.bot.log_dispatcher.send(payload.guild_id, "message.delete.bulk", embeds=[embed])
 
 
 def setup(bot: bridge.Bot):
@@ -1,16 +1,15 @@
 import asyncio
-import datetime
 import logging
 import os
 import random
 
 import discord
-import httpx
 from discord.ext import bridge, commands
 
 from spanner.cogs.user_info import UserInfo
 from spanner.share.config import load_config
 from spanner.share.database import GuildNickNameModeration
+from spanner.share.http import http_clients
 from spanner.share.utils import get_log_channel
 
 
@@ -21,32 +20,14 @@ class NicknameChangeEvents(commands.Cog):
         self.moderation_lock = asyncio.Lock()
 
     async def wait_for_audit_log(self, guild: discord.Guild, target: discord.Member, nick: str | None):
-        await asyncio.sleep(1)
-
         def the_check(e: discord.AuditLogEntry):
-            if e.target == target and e.action == discord.AuditLogAction.member_update:
-                return entry.target.nick == nick
+            if hasattr(e.after, "nick"):
+                return e.after.nick == nick
+            return False
 
-        if not guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(seconds=59)
-        async for entry in guild.audit_logs(after=after, action=discord.AuditLogAction.member_update):
-            if the_check(entry):
-                return entry
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a nick change.",
-                guild,
-                target,
-            )
-        else:
-            return entry
+        return await self.bot.audit_log.wait_for(
+            guild, discord.AuditLogAction.member_update, target.id, check=the_check
+        )
 
     async def moderate_name(self, after: discord.Member):
         if after.top_role >= after.guild.me.top_role:
@@ -61,53 +42,56 @@ class NicknameChangeEvents(commands.Cog):
         if not log_channel:
             return
         if any(getattr(moderation, x) is True for x in GuildNickNameModeration.CATEGORIES.keys()):
-            async with httpx.AsyncClient() as client:
-                async with self.moderation_lock:
-                    self.log.info(
-                        "Preparing to submit display name %r to OpenAI for moderation. On behalf of %r",
-                        after.display_name,
-                        after,
+            client = http_clients.get("openai")
+            async with self.moderation_lock:
+                self.log.info(
+                    "Preparing to submit display name %r to OpenAI for moderation. On behalf of %r",
+                    after.display_name,
+                    after,
+                )
+                odn = after.display_name
+                response = await client.post(
+                    "/moderations",
+                    json={"model": "text-moderation-stable", "input": odn},
+                    headers={"Authorization": f"Bearer {openai_token}"},
+                )
+            response.raise_for_status()
+            data = response.json()["results"][0]
+            self.log.info("OpenAI moderation response: %r", data)
+            flagged = data["flagged"]
+            data = data["categories"]
+            data["hate"] = data["hate"] or data["hate/threatening"]
+            data["sexual"] = data["sexual"] or data["sexual/minors"]
+            data["violence"] = data["violence"] or data["violence/graphic"]
+            data["self-harm"] = data["self-harm"] or data["self-harm/intent"] or data["self-harm/instructions"]
+            data["harassment"] = data["harassment"] or data["harassment/threatening"]
+
+            if flagged is False:
+                self.log.info("Display name %r was not flagged.", odn)
+                return False
+
+            if after.nick is None:
+                with open("/usr/share/dict/words") as words_file:
+                    words = tuple(set(map(str.casefold, words_file.readlines())))
+                new_name = [random.choice(words), random.choice(words)]
+                new_name = "-".join(new_name) + str(random.randint(0, 20))
+                new_name = new_name[:32]
+            else:
+                new_name = None
+
+            try:
+                if data["sexual"] and moderation.sexual:
+                    self.log.info("Display name %r flagged as sexual.", odn)
+                    await after.edit(
+                        nick=new_name,
+                        reason=f"Nickname ({after.display_name}) contains sexual content, which this server has "
+                        f"enabled filtering of.",
                     )
-                    odn = after.display_name
-                    response = await client.post(
-                        "https://api.openai.com/v1/moderations",
-                        json={"model": "text-moderation-stable", "input": odn},
-                        headers={"Authorization": f"Bearer {openai_token}"},
-                    )
-                response.raise_for_status()
-                data = response.json()["results"][0]
-                self.log.info("OpenAI moderation response: %r", data)
-                flagged = data["flagged"]
-                data = data["categories"]
-                data["hate"] = data["hate"] or data["hate/threatening"]
-                data["sexual"] = data["sexual"] or data["sexual/minors"]
-                data["violence"] = data["violence"] or data["violence/graphic"]
-                data["self-harm"] = data["self-harm"] or data["self-harm/intent"] or data["self-harm/instructions"]
-                data["harassment"] = data["harassment"] or data["harassment/threatening"]
-
-                if flagged is False:
-                    self.log.info("Display name %r was not flagged.", odn)
-                    return False
-
-                if after.nick is None:
-                    with open("/usr/share/dict/words") as words_file:
-                        words = tuple(set(map(str.casefold, words_file.readlines())))
-                    new_name = [random.choice(words), random.choice(words)]
-                    new_name = "-".join(new_name) + str(random.randint(0, 20))
-                    new_name = new_name[:32]
-                else:
-                    new_name = None
-
-                try:
-                    if data["sexual"] and moderation.sexual:
-                        self.log.info("Display name %r flagged as sexual.", odn)
-                        await after.edit(
-                            nick=new_name,
-                            reason=f"Nickname ({after.display_name}) contains sexual content, which this server has "
-                            f"enabled filtering of.",
-                        )
-                        await log_channel.send(
-                            embed=discord.Embed(
+                    await self.bot.log_dispatcher.send(
+                        after.guild.id,
+                        "member.nickname-change",
+                        embeds=[
+                            discord.Embed(
                                 title="Member nickname filtered: sexual content",
                                 description=f"{after.mention}'s nickname was filtered due to sexual content.\n"
                                 f"Was: {odn}\n"
@@ -117,16 +101,20 @@ class NicknameChangeEvents(commands.Cog):
                             )
                             .set_thumbnail(url=after.display_avatar.url)
                             .set_author(name=after.guild.me.display_name, icon_url=after.guild.me.display_avatar.url)
-                        )
-                    elif data["hate"] and moderation.hate:
-                        self.log.info("Display name %r flagged as hate.", odn)
-                        await after.edit(
-                            nick=new_name,
-                            reason=f"Nickname ({after.display_name}) contains hate speech, which this server has "
-                            f"enabled filtering of.",
-                        )
-                        await log_channel.send(
-                            embed=discord.Embed(
+                        ],
+                    )
+                elif data["hate"] and moderation.hate:
+                    self.log.info("Display name %r flagged as hate.", odn)
+                    await after.edit(
+                        nick=new_name,
+                        reason=f"Nickname ({after.display_name}) contains hate speech, which this server has "
+                        f"enabled filtering of.",
+                    )
+                    await self.bot.log_dispatcher.send(
+                        after.guild.id,
+                        "member.nickname-change",
+                        embeds=[
+                            discord.Embed(
                                 title="Member nickname filtered: hate speech",
                                 description=f"{after.mention}'s nickname was filtered due to hate speech.\n"
                                 f"Was: {odn}\n"
@@ -136,16 +124,20 @@ class NicknameChangeEvents(commands.Cog):
                             )
                             .set_thumbnail(url=after.display_avatar.url)
                             .set_author(name=after.guild.me.display_name, icon_url=after.guild.me.display_avatar.url)
-                        )
-                    elif data["harassment"] and moderation.harassment:
-                        self.log.info("Display name %r flagged as harassment.", odn)
-                        await after.edit(
-                            nick=new_name,
-                            reason=f"Nickname ({after.display_name}) contains harassment, which this server has "
-                            f"enabled filtering of.",
-                        )
-                        await log_channel.send(
-                            embed=discord.Embed(
+                        ],
+                    )
+                elif data["harassment"] and moderation.harassment:
+                    self.log.info("Display name %r flagged as harassment.", odn)
+                    await after.edit(
+                        nick=new_name,
+                        reason=f"Nickname ({after.display_name}) contains harassment, which this server has "
+                        f"enabled filtering of.",
+                    )
+                    await self.bot.log_dispatcher.send(
+                        after.guild.id,
+                        "member.nickname-change",
+                        embeds=[
+                            discord.Embed(
                                 title="Member nickname filtered: harassment",
                                 description=f"{after.mention}'s nickname was filtered due to harassment.\n"
                                 f"Was: {odn}\n"
@@ -155,16 +147,20 @@ class NicknameChangeEvents(commands.Cog):
                             )
                             .set_thumbnail(url=after.display_avatar.url)
                             .set_author(name=after.guild.me.display_name, icon_url=after.guild.me.display_avatar.url)
-                        )
-                    elif data["self-harm"] and moderation.self_harm:
-                        self.log.info("Display name %r flagged as self-harm.", odn)
-                        await after.edit(
-                            nick=new_name,
-                            reason=f"Nickname ({after.display_name}) contains self-harm content, which this server has "
-                            f"enabled filtering of.",
-                        )
-                        await log_channel.send(
-                            embed=discord.Embed(
+                        ],
+                    )
+                elif data["self-harm"] and moderation.self_harm:
+                    self.log.info("Display name %r flagged as self-harm.", odn)
+                    await after.edit(
+                        nick=new_name,
+                        reason=f"Nickname ({after.display_name}) contains self-harm content, which this server has "
+                        f"enabled filtering of.",
+                    )
+                    await self.bot.log_dispatcher.send(
+                        after.guild.id,
+                        "member.nickname-change",
+                        embeds=[
+                            discord.Embed(
                                 title="Member nickname filtered: self-harm",
                                 description=f"{after.mention}'s nickname was filtered due to self-harm.\n"
                                 f"Was: {odn}\n"
@@ -174,16 +170,20 @@ class NicknameChangeEvents(commands.Cog):
                             )
                             .set_thumbnail(url=after.display_avatar.url)
                             .set_author(name=after.guild.me.display_name, icon_url=after.guild.me.display_avatar.url)
-                        )
-                    elif data["violence"] and moderation.violence:
-                        self.log.info("Display name %r flagged as violence.", odn)
-                        await after.edit(
-                            nick=new_name,
-                            reason=f"Nickname ({after.display_name}) contains violence, which this server has "
-                            f"enabled filtering of.",
-                        )
-                        await log_channel.send(
-                            embed=discord.Embed(
+                        ],
+                    )
+                elif data["violence"] and moderation.violence:
+                    self.log.info("Display name %r flagged as violence.", odn)
+                    await after.edit(
+                        nick=new_name,
+                        reason=f"Nickname ({after.display_name}) contains violence, which this server has "
+                        f"enabled filtering of.",
+                    )
+                    await self.bot.log_dispatcher.send(
+                        after.guild.id,
+                        "member.nickname-change",
+                        embeds=[
+                            discord.Embed(
                                 title="Member nickname filtered: violence",
                                 description=f"{after.mention}'s nickname was filtered due to violence.\n"
                                 f"Was: {odn}\n"
@@ -193,13 +193,14 @@ class NicknameChangeEvents(commands.Cog):
                             )
                             .set_thumbnail(url=after.display_avatar.url)
                             .set_author(name=after.guild.me.display_name, icon_url=after.guild.me.display_avatar.url)
-                        )
-                except discord.Forbidden as e:
-                    if log_channel is not None:
-                        await log_channel.send(
-                            f"Failed to moderate {after}'s nickname after it was flagged. Reason: `{e}`\n"
-                            f"A moderator will need to change it manually,"
-                        )
+                        ],
+                    )
+            except discord.Forbidden as e:
+                if log_channel is not None:
+                    await log_channel.send(
+                        f"Failed to moderate {after}'s nickname after it was flagged. Reason: `{e}`\n"
+                        f"A moderator will need to change it manually,"
+                    )
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
@@ -222,14 +223,18 @@ class NicknameChangeEvents(commands.Cog):
             embed.set_thumbnail(url=after.display_avatar.url)
             cog = UserInfo(self.bot)
             user_info_embed = (await cog.get_info(after))["Overview"]
-            msg = await log_channel.send(embeds=[embed, user_info_embed])
-            entry = await self.wait_for_audit_log(before.guild, after, after.display_name)
+            log_entry = await self.bot.log_dispatcher.send(
+                before.guild.id, "member.nickname-change", embeds=[embed, user_info_embed]
+            )
+            if log_entry is None:
+                return
+            entry = await self.wait_for_audit_log(before.guild, after, after.nick)
             if entry:
                 embed.set_author(name=f"Moderator: {entry.user}", icon_url=entry.user.display_avatar.url)
                 if entry.reason:
                     embed.add_field(name="Reason", value=entry.reason, inline=False)
                 embed.set_footer(text="Nickname change details fetched from audit log.")
-                await msg.edit(embeds=[embed, user_info_embed])
+                await log_entry.edit(embeds=[embed, user_info_embed])
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
@@ -1,5 +1,3 @@
-import asyncio
-import datetime
 import logging
 from typing import Iterable
 
@@ -22,38 +20,20 @@ class RoleEvents(commands.Cog):
         before: Iterable[discord.Role] | None = None,
         after: Iterable[discord.Role] | None = None,
     ):
+        removed = {role.id for role in before or ()}
+        added = {role.id for role in after or ()}
+
         def the_check(e: discord.AuditLogEntry):
-            if e.target == target and e.action == discord.AuditLogAction.member_role_update:
-                nonlocal before, after
-                if before:
-                    # Check if any of the roles in `before` are in the `e.before` list
-                    if any(role.id in [r.id for r in e.before] for role in before):
-                        return True
-                if after:
-                    # Check if any of the roles in `after` are in the `e.after` list
-                    if any(role.id in [r.id for r in e.after] for role in after):
-                        return True
-
-        if not guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(seconds=59)
-        async for entry in guild.audit_logs(after=after, action=discord.AuditLogAction.member_role_update):
-            if the_check(entry):
-                return entry
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a role change.",
-                guild,
-                target,
-            )
-        else:
-            return entry
+            # Check if any of the roles in `before` are in the `e.before` list, or `after` in the `e.after` list
+            if removed.intersection(r.id for r in getattr(e.before, "roles", ())):
+                return True
+            if added.intersection(r.id for r in getattr(e.after, "roles", ())):
+                return True
+            return False
+
+        return await self.bot.audit_log.wait_for(
+            guild, discord.AuditLogAction.member_role_update, target.id, check=the_check
+        )
 
     @staticmethod
     def role_list(roles: Iterable[discord.Role], max_length: int = 1024) -> str:
@@ -98,15 +78,19 @@ class RoleEvents(commands.Cog):
         cog = UserInfo(self.bot)
 
         role_info_embed = (await cog.get_info(after))["Overview"]
-        msg = await log_channel.send(embeds=[embed, role_info_embed])
-        entry = await self.wait_for_audit_log(after.guild, after)
+        log_entry = await self.bot.log_dispatcher.send(
+            after.guild.id, "member.roles.update", embeds=[embed, role_info_embed]
+        )
+        if log_entry is None:
+            return
+        entry = await self.wait_for_audit_log(after.guild, after, roles_removed, roles_added)
         if entry is None:
             return
 
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Timeout details fetched from audit log.")
-        await msg.edit(embeds=[embed, role_info_embed])
+        await log_entry.edit(embeds=[embed, role_info_embed])
 
 
 def setup(bot):
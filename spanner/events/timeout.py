@@ -1,5 +1,3 @@
-import asyncio
-import datetime
 import logging
 
 import discord
@@ -16,27 +14,13 @@ class TimeoutEvents(commands.Cog):
 
     async def wait_for_audit_log(self, guild: discord.Guild, target: discord.Member, timed_out: bool = False):
         def the_check(e: discord.AuditLogEntry):
-            if e.target == target and e.action == discord.AuditLogAction.member_update:
-                return entry.target.timed_out == timed_out
+            if hasattr(e.after, "communication_disabled_until"):
+                return bool(e.after.communication_disabled_until) == timed_out
+            return False
 
-        if not guild.me.guild_permissions.view_audit_log:
-            return
-        now = discord.utils.utcnow()
-        after = now - datetime.timedelta(seconds=59)
-        async for entry in guild.audit_logs(after=after, action=discord.AuditLogAction.member_update):
-            if the_check(entry):
-                return entry
-
-        try:
-            entry = await self.bot.wait_for("audit_log_entry", check=the_check, timeout=600)
-            if not entry:
-                raise asyncio.TimeoutError
-        except asyncio.TimeoutError:
-            self.log.debug(
-                "Event(guild=%r, target=%r): Timeout waiting for audit log entry. Likely not a timeout.", guild, target
-            )
-        else:
-            return entry
+        return await self.bot.audit_log.wait_for(
+            guild, discord.AuditLogAction.member_update, target.id, check=the_check
+        )
 
     async def on_member_timeout(self, member: discord.Member):
         self.log.debug("%r timed out in %r.", member, member.guild)
@@ -57,7 +41,11 @@ class TimeoutEvents(commands.Cog):
         embed.set_thumbnail(url=member.display_avatar.url)
         cog = UserInfo(self.bot)
         user_info_embed = (await cog.get_info(member))["Overview"]
-        msg = await log_channel.send(embeds=[embed, user_info_embed])
+        log_entry = await self.bot.log_dispatcher.send(
+            member.guild.id, "member.timeout", embeds=[embed, user_info_embed]
+        )
+        if log_entry is None:
+            return
         entry = await self.wait_for_audit_log(member.guild, member, timed_out=True)
         if entry is None:
             return
@@ -65,7 +53,7 @@ class TimeoutEvents(commands.Cog):
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Timeout details fetched from audit log.")
-        await msg.edit(embeds=[embed, user_info_embed])
+        await log_entry.edit(embeds=[embed, user_info_embed])
 
     async def on_member_timeout_expire(self, member: discord.Member):
         self.log.debug("%r time out expired in %r.", member, member.guild)
@@ -85,7 +73,11 @@ class TimeoutEvents(commands.Cog):
         embed.set_thumbnail(url=member.display_avatar.url)
         cog = UserInfo(self.bot)
         user_info_embed = (await cog.get_info(member))["Overview"]
-        msg = await log_channel.send(embeds=[embed, user_info_embed])
+        log_entry = await self.bot.log_dispatcher.send(
+            member.guild.id, "member.timeout", embeds=[embed, user_info_embed]
+        )
+        if log_entry is None:
+            return
         entry = await self.wait_for_audit_log(member.guild, member)
         if entry is None:
             return
@@ -93,7 +85,7 @@ class TimeoutEvents(commands.Cog):
         embed.add_field(name="Reason", value=entry.reason or "No reason.")
         embed.set_author(name="Moderator: " + entry.user.display_name, icon_url=entry.user.display_avatar.url)
         embed.set_footer(text="Timeout details fetched from audit log.")
-        await msg.edit(embeds=[embed, user_info_embed])
+        await log_entry.edit(embeds=[embed, user_info_embed])
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
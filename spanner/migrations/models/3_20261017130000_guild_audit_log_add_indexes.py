@@ -0,0 +1,14 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE INDEX IF NOT EXISTS "idx_guildauditl_guild_i_852d82" ON "guildauditlogentry" ("guild_id", "created_at");
+        CREATE INDEX IF NOT EXISTS "idx_guildauditl_guild_i_b69252"
+            ON "guildauditlogentry" ("guild_id", "namespace", "action");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_guildauditl_guild_i_852d82";
+        DROP INDEX IF EXISTS "idx_guildauditl_guild_i_b69252";"""
@@ -0,0 +1,19 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "auditlogsnapshot" (
+    "hash" VARCHAR(64) NOT NULL PRIMARY KEY,
+    "data" JSON NOT NULL,
+    "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+        ALTER TABLE "guildauditlogentry" ADD "target_hash" VARCHAR(64);
+        CREATE INDEX IF NOT EXISTS "idx_guildauditl_target__f86dab" ON "guildauditlogentry" ("target_hash");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_guildauditl_target__f86dab";
+        ALTER TABLE "guildauditlogentry" DROP COLUMN "target_hash";
+        DROP TABLE IF EXISTS "auditlogsnapshot";"""
@@ -0,0 +1,25 @@
+import hashlib
+
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    await db.execute_script("""
+        ALTER TABLE "discordoauthuser" ADD "session_hash" VARCHAR(64);""")
+    # Existing sessions are hashed here (SQLite has no SHA256), so that every session can be looked up by its hash.
+    rows = await db.execute_query_dict(
+        'SELECT "guid", "session" FROM "discordoauthuser" WHERE "session" IS NOT NULL AND "session_hash" IS NULL'
+    )
+    if rows:
+        await db.execute_many(
+            'UPDATE "discordoauthuser" SET "session_hash" = ? WHERE "guid" = ?',
+            [[hashlib.sha256(row["session"].encode()).hexdigest(), row["guid"]] for row in rows],
+        )
+    return """
+        CREATE UNIQUE INDEX IF NOT EXISTS "uid_discordoaut_session_722481" ON "discordoauthuser" ("session_hash");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "uid_discordoaut_session_722481";
+        ALTER TABLE "discordoauthuser" DROP COLUMN "session_hash";"""
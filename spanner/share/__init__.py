@@ -1,9 +1,35 @@
-from . import config, data, database, utils, views
+from . import (
+    audit_log,
+    audit_log_export,
+    audit_log_retention,
+    cache,
+    config,
+    data,
+    database,
+    http,
+    log_dispatcher,
+    message_cache,
+    message_store,
+    templates,
+    transcripts,
+    utils,
+    views,
+)
 
 __all__ = (
+    "audit_log",
+    "audit_log_export",
+    "audit_log_retention",
+    "cache",
     "config",
     "data",
     "database",
+    "http",
+    "log_dispatcher",
+    "message_cache",
+    "message_store",
+    "templates",
+    "transcripts",
     "utils",
     "views",
 )
@@ -0,0 +1,301 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+import typing
+
+import discord
+from discord.ext import bridge
+
+__all__ = ("AuditLogCorrelator", "PendingMatchStore")
+log = logging.getLogger(__name__)
+
+_Key = tuple[discord.AuditLogAction, int | None]
+_Check = typing.Callable[[discord.AuditLogEntry], bool]
+_T = typing.TypeVar("_T")
+
+
+class _GuildBuffer:
+    """A bounded ring buffer of a single guild's recent audit log entries, indexed by (action, target_id)."""
+
+    __slots__ = ("entries", "index")
+
+    def __init__(self, size: int):
+        self.entries: collections.deque[discord.AuditLogEntry] = collections.deque(maxlen=size)
+        self.index: dict[_Key, collections.deque[discord.AuditLogEntry]] = {}
+
+    def add(self, entry: discord.AuditLogEntry) -> None:
+        if len(self.entries) == self.entries.maxlen:
+            # The oldest entry in the ring is also the oldest entry under its own key.
+            evicted = self.entries[0]
+            key = (evicted.action, evicted._target_id)
+            bucket = self.index[key]
+            bucket.popleft()
+            if not bucket:
+                del self.index[key]
+        self.entries.append(entry)
+        self.index.setdefault((entry.action, entry._target_id), collections.deque()).append(entry)
+
+    def find(self, key: _Key, after: datetime.datetime, check: _Check | None) -> discord.AuditLogEntry | None:
+        for entry in reversed(self.index.get(key, ())):
+            if entry.created_at < after:
+                break
+            if check is None or check(entry):
+                return entry
+
+
+class _Waiter:
+    __slots__ = ("future", "check", "started")
+
+    def __init__(self, check: _Check | None):
+        self.future: asyncio.Future[discord.AuditLogEntry] = asyncio.get_running_loop().create_future()
+        self.check = check
+        self.started = time.monotonic()
+
+
+class PendingMatchStore(typing.Generic[_T]):
+    """
+    Holds values that are waiting to be matched with an audit log entry, keyed by (guild_id, target_id, action).
+
+    Unlike :meth:`AuditLogCorrelator.wait_for`, nothing is kept waiting - the value is simply stored until the entry
+    arrives and :meth:`pop` is called for it. Values expire after `ttl` seconds, and once `max_size` values are held,
+    the oldest is evicted to make room for a new one.
+    """
+
+    def __init__(self, *, ttl: float = 600.0, max_size: int = 1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Insertion ordered, and every value has the same TTL, so the front of the dict always expires first.
+        self._values: dict[tuple[int, int, discord.AuditLogAction], tuple[float, _T]] = {}
+
+        self.added = 0
+        self.matched = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "<PendingMatchStore size={0} ttl={1.ttl}>".format(len(self), self)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        while self._values:
+            key, (added_at, _) = next(iter(self._values.items()))
+            if added_at > cutoff:
+                break
+            del self._values[key]
+            self.expired += 1
+
+    def add(self, guild_id: int, target_id: int, action: discord.AuditLogAction, value: _T) -> None:
+        """
+        Stores a value until an audit log entry for (guild_id, target_id, action) arrives.
+
+        If a value is already stored under the same key, it is replaced.
+        """
+        self._expire()
+        key = (guild_id, target_id, action)
+        self._values.pop(key, None)
+        while len(self._values) >= self.max_size:
+            evicted = next(iter(self._values))
+            del self._values[evicted]
+            self.evicted += 1
+            log.debug("Evicted pending audit log match %r, store is full.", evicted)
+        self._values[key] = (time.monotonic(), value)
+        self.added += 1
+
+    def pop(self, entry: discord.AuditLogEntry) -> _T | None:
+        """Removes and returns the value waiting for the given audit log entry, if there is one."""
+        self._expire()
+        stored = self._values.pop((entry.guild.id, entry._target_id, entry.action), None)
+        if stored is None:
+            return
+        self.matched += 1
+        return stored[1]
+
+    def stats(self) -> dict[str, int | float]:
+        self._expire()
+        return {
+            "size": len(self),
+            "added": self.added,
+            "matched": self.matched,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class AuditLogCorrelator:
+    """
+    Matches gateway events up with the audit log entries that caused them.
+
+    Every audit log entry received over the gateway is kept in a small per-guild ring buffer, indexed by
+    (action, target_id), and is handed straight to anything waiting on that key. This means an event handler can look
+    for its audit log entry with a dictionary lookup, regardless of whether the entry arrived before or after the
+    event itself, and without having to page the audit log over the REST API.
+
+    The REST API is only used as a fallback when the moderation intent is disabled, as the gateway will not deliver
+    audit log entries at all in that case.
+    """
+
+    def __init__(self, bot: bridge.Bot, *, buffer_size: int = 256):
+        self.bot = bot
+        self.buffer_size = buffer_size
+        self._buffers: dict[int, _GuildBuffer] = {}
+        self._waiters: dict[tuple[int, discord.AuditLogAction, int], list[_Waiter]] = {}
+
+        self.received = 0
+        self.buffer_hits = 0
+        self.matches = 0
+        self.timeouts = 0
+        self.rest_fallbacks = 0
+        self._match_latency_total = 0.0
+        self._match_latency_max = 0.0
+
+    def __repr__(self):
+        return "<AuditLogCorrelator guilds={0} pending={1}>".format(len(self._buffers), self.pending)
+
+    @property
+    def pending(self) -> int:
+        """The number of event handlers currently waiting for an audit log entry."""
+        return sum(map(len, self._waiters.values()))
+
+    async def feed(self, entry: discord.AuditLogEntry) -> None:
+        """Listener for `on_audit_log_entry`. Buffers the entry, and resolves anything that was waiting for it."""
+        self.received += 1
+        guild_id = entry.guild.id
+        buffer = self._buffers.get(guild_id)
+        if buffer is None:
+            buffer = self._buffers[guild_id] = _GuildBuffer(self.buffer_size)
+        buffer.add(entry)
+
+        key = (guild_id, entry.action, entry._target_id)
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return
+        now = time.monotonic()
+        for waiter in waiters.copy():
+            if waiter.future.done():
+                continue
+            try:
+                if waiter.check is not None and not waiter.check(entry):
+                    continue
+            except Exception as e:
+                log.error("Audit log check %r raised an exception for %r", waiter.check, entry, exc_info=e)
+                continue
+            waiter.future.set_result(entry)
+            waiters.remove(waiter)
+            self._record_match(now - waiter.started)
+        if not waiters:
+            self._waiters.pop(key, None)
+
+    def get(
+        self,
+        guild_id: int,
+        action: discord.AuditLogAction,
+        target_id: int,
+        *,
+        check: _Check | None = None,
+        lookback: float = 60.0,
+    ) -> discord.AuditLogEntry | None:
+        """
+        Returns an already-received audit log entry for an action against a target, without waiting.
+
+        :param lookback: How old (in seconds) the entry may be.
+        """
+        buffer = self._buffers.get(guild_id)
+        if buffer is None:
+            return
+        after = discord.utils.utcnow() - datetime.timedelta(seconds=lookback)
+        entry = buffer.find((action, target_id), after, check)
+        if entry is not None:
+            self.buffer_hits += 1
+            self._record_match(0.0)
+        return entry
+
+    def forget(self, guild_id: int) -> None:
+        """Drops the buffered entries for a guild, e.g. when the bot is removed from it."""
+        self._buffers.pop(guild_id, None)
+
+    def _record_match(self, latency: float) -> None:
+        self.matches += 1
+        self._match_latency_total += latency
+        self._match_latency_max = max(self._match_latency_max, latency)
+
+    async def _fetch(
+        self,
+        guild: discord.Guild,
+        action: discord.AuditLogAction,
+        target_id: int,
+        after: datetime.datetime,
+        check: _Check | None,
+    ) -> discord.AuditLogEntry | None:
+        self.rest_fallbacks += 1
+        async for entry in guild.audit_logs(after=after, action=action):
+            if entry._target_id == target_id and (check is None or check(entry)):
+                return entry
+
+    async def wait_for(
+        self,
+        guild: discord.Guild,
+        action: discord.AuditLogAction,
+        target_id: int,
+        *,
+        check: _Check | None = None,
+        timeout: float = 600.0,
+        lookback: float = 60.0,
+    ) -> discord.AuditLogEntry | None:
+        """
+        Finds the audit log entry for an action that was just performed against a target.
+
+        Entries that were already received are returned immediately, otherwise this waits for the entry to arrive.
+
+        :param guild: The guild the action happened in
+        :param action: The audit log action to look for
+        :param target_id: The ID of the target of the action (member, role, channel, etc.)
+        :param check: An additional predicate the entry must pass, for actions that cover several kinds of change.
+        :param timeout: How many seconds to wait for the entry to arrive.
+        :param lookback: How old (in seconds) an already-received entry may be to still be considered a match.
+        :return: The matching entry, or None if the bot cannot view the audit log, or nothing arrived in time.
+        """
+        if not guild.me.guild_permissions.view_audit_log:
+            return
+        entry = self.get(guild.id, action, target_id, check=check, lookback=lookback)
+        if entry is not None:
+            return entry
+
+        if not self.bot.intents.moderation:
+            after = discord.utils.utcnow() - datetime.timedelta(seconds=lookback)
+            return await self._fetch(guild, action, target_id, after, check)
+
+        key = (guild.id, action, target_id)
+        waiter = _Waiter(check)
+        self._waiters.setdefault(key, []).append(waiter)
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            log.debug("Timed out waiting for %s audit log entry for target %d in %r.", action.name, target_id, guild)
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "guilds": len(self._buffers),
+            "buffered": sum(len(buffer.entries) for buffer in self._buffers.values()),
+            "pending_waiters": self.pending,
+            "received": self.received,
+            "matches": self.matches,
+            "buffer_hits": self.buffer_hits,
+            "timeouts": self.timeouts,
+            "rest_fallbacks": self.rest_fallbacks,
+            "match_latency_avg_ms": (
+                round(self._match_latency_total / self.matches * 1000, 2) if self.matches else 0.0
+            ),
+            "match_latency_max_ms": round(self._match_latency_max * 1000, 2),
+        }
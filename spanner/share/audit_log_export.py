@@ -0,0 +1,82 @@
+import asyncio
+import typing
+import zlib
+
+import discord
+from tortoise.expressions import Q
+
+from .database import GuildAuditLogEntry, GuildAuditLogEntryPydantic
+from .templates import TemplateRegistry, templates
+
+__all__ = ("iter_audit_log", "export_ndjson", "export_html", "gzip_stream", "EXPORT_FORMATS")
+
+# The file extension and media type of each export format.
+EXPORT_FORMATS: dict[str, tuple[str, str]] = {
+    "ndjson": ("ndjson", "application/x-ndjson"),
+    "html": ("html", "text/html"),
+}
+
+
+async def iter_audit_log(
+    guild_id: int, *, batch_size: int = 500, **filters
+) -> typing.AsyncIterator[list[GuildAuditLogEntry]]:
+    """
+    Yields a guild's audit log entries in batches, newest first.
+
+    Each batch is fetched with a keyset query continuing from the last entry of the previous batch, so only one batch
+    is held in memory at a time, and later batches are as cheap to fetch as the first.
+
+    :param guild_id: The guild to export the audit log of.
+    :param batch_size: How many entries to fetch per query.
+    :param filters: Additional filters to apply, e.g. `namespace="auto_roles"`.
+    """
+    query = GuildAuditLogEntry.filter(guild_id=guild_id, **filters).order_by("-created_at", "-id")
+    last: GuildAuditLogEntry | None = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(Q(created_at__lt=last.created_at) | Q(created_at=last.created_at, id__lt=last.id))
+        batch = await page.limit(batch_size)
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+async def export_ndjson(guild_id: int, **filters) -> typing.AsyncIterator[bytes]:
+    """Streams a guild's audit log as newline-delimited JSON, one entry per line."""
+    async for batch in iter_audit_log(guild_id, **filters):
+        await GuildAuditLogEntry.rehydrate(batch)
+        lines = []
+        for entry in batch:
+            model = await GuildAuditLogEntryPydantic.from_tortoise_orm(entry)
+            lines.append(model.model_dump_json())
+        yield ("\n".join(lines) + "\n").encode()
+
+
+async def export_html(
+    guild: discord.Guild, registry: TemplateRegistry = templates, **filters
+) -> typing.AsyncIterator[bytes]:
+    """
+    Streams a guild's audit log as a standalone HTML document.
+
+    The document is rendered piece by piece: the head, then each batch of entries, then the foot, so that the whole
+    document is never held in memory at once.
+    """
+    yield (await registry.render_async("_audit_log_export_head.html", guild=guild, now=discord.utils.utcnow())).encode()
+    async for batch in iter_audit_log(guild.id, **filters):
+        yield (await registry.render_async("_audit_log_events.html", events=batch)).encode()
+    yield (await registry.render_async("_audit_log_export_foot.html")).encode()
+
+
+async def gzip_stream(chunks: typing.AsyncIterable[bytes], *, level: int = 6) -> typing.AsyncIterator[bytes]:
+    """Compresses a stream of bytes into a gzip file, chunk by chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+        # Compression is CPU-bound, so give other tasks a chance to run between chunks.
+        await asyncio.sleep(0)
+    yield compressor.flush()
@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+import logging
+
+import discord
+from tortoise.expressions import Subquery
+from tortoise.transactions import in_transaction
+
+from .database import AuditLogSnapshot, GuildAuditLogEntry, GuildConfig, Premium
+
+__all__ = ("AuditLogRetention",)
+log = logging.getLogger(__name__)
+
+
+class AuditLogRetention:
+    """
+    Deletes audit log entries that are older than their guild's retention period, in the background.
+
+    Each guild keeps entries for `default_days`, or `premium_days` while it has premium. Guilds may choose a shorter
+    period (:attr:`GuildConfig.audit_log_retention_days`), but not a longer one.
+
+    Expired entries are deleted `batch_size` at a time, each batch in its own short statement, pausing `batch_delay`
+    seconds between batches, so that a large backlog never holds a long lock on the table. Target snapshots that are
+    no longer referenced by any entry are deleted afterwards, in the same way.
+    """
+
+    def __init__(
+        self,
+        *,
+        default_days: int = 365,
+        premium_days: int = 365 * 3,
+        interval: float = 3600.0,
+        batch_size: int = 1000,
+        batch_delay: float = 0.5,
+    ):
+        self.default_days = default_days
+        self.premium_days = premium_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._task: asyncio.Task | None = None
+
+        self.runs = 0
+        self.deleted = 0
+        self.snapshots_deleted = 0
+        self._last_run_time = 0.0
+
+    def __repr__(self):
+        return "<AuditLogRetention default_days={0.default_days} premium_days={0.premium_days}>".format(self)
+
+    def retention_days(self, configured: int | None, premium: bool) -> int:
+        """The number of days a guild keeps its audit log for, given its own setting and whether it has premium."""
+        allowed = self.premium_days if premium else self.default_days
+        if configured is None:
+            return allowed
+        return max(1, min(configured, allowed))
+
+    async def _delete_before(self, guild_id: int, cutoff: datetime.datetime) -> int:
+        deleted = 0
+        while True:
+            ids = (
+                await GuildAuditLogEntry.filter(guild_id=guild_id, created_at__lt=cutoff)
+                .limit(self.batch_size)
+                .values_list("id", flat=True)
+            )
+            if not ids:
+                return deleted
+            deleted += await GuildAuditLogEntry.filter(id__in=ids).delete()
+            if len(ids) < self.batch_size:
+                return deleted
+            await asyncio.sleep(self.batch_delay)
+
+    async def _delete_orphaned_snapshots(self, cutoff: datetime.datetime) -> int:
+        # Only snapshots older than the cutoff are considered, in case a new entry is about to reference one.
+        referenced = Subquery(GuildAuditLogEntry.filter(target_hash__isnull=False).values("target_hash"))
+        deleted = 0
+        while True:
+            hashes = (
+                await AuditLogSnapshot.filter(created_at__lt=cutoff)
+                .exclude(hash__in=referenced)
+                .limit(self.batch_size)
+                .values_list("hash", flat=True)
+            )
+            if not hashes:
+                return deleted
+            # An entry may have started referencing one of these since they were listed, so the DELETE checks again.
+            async with in_transaction() as conn:
+                deleted += (
+                    await AuditLogSnapshot.filter(hash__in=hashes).exclude(hash__in=referenced).using_db(conn).delete()
+                )
+            if len(hashes) < self.batch_size:
+                return deleted
+            await asyncio.sleep(self.batch_delay)
+
+    async def run(self) -> int:
+        """
+        Deletes every guild's expired audit log entries.
+
+        :return: How many entries were deleted.
+        """
+        start = discord.utils.utcnow()
+        premium = set(await Premium.filter(end__gt=start).values_list("guild_id", flat=True))
+        deleted = 0
+        for guild_id, configured in await GuildConfig.all().values_list("id", "audit_log_retention_days"):
+            days = self.retention_days(configured, guild_id in premium)
+            removed = await self._delete_before(guild_id, start - datetime.timedelta(days=days))
+            if removed:
+                log.info("Deleted %d audit log entries older than %d days from guild %d.", removed, days, guild_id)
+            deleted += removed
+
+        if deleted:
+            self.snapshots_deleted += await self._delete_orphaned_snapshots(start - datetime.timedelta(days=1))
+
+        self.runs += 1
+        self.deleted += deleted
+        self._last_run_time = (discord.utils.utcnow() - start).total_seconds()
+        return deleted
+
+    async def _run_forever(self) -> None:
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                log.error("Failed to apply audit log retention.", exc_info=e)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """Starts applying retention every `interval` seconds, in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "snapshots_deleted": self.snapshots_deleted,
+            "last_run_time_s": round(self._last_run_time, 2),
+        }
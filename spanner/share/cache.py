@@ -0,0 +1,243 @@
+import collections
+import logging
+import sys
+import typing
+
+from .database import StarboardConfig
+
+__all__ = ("LogFeatureCache", "log_feature_cache", "LRUCache", "StarboardConfigCache", "starboard_config_cache")
+log = logging.getLogger(__name__)
+
+K = typing.TypeVar("K", bound=typing.Hashable)
+V = typing.TypeVar("V")
+
+
+class LogFeatureCache:
+    """
+    A process-wide cache of guild logging configuration.
+
+    Entries are keyed by (guild_id, feature name), and hold whether the feature is enabled, and the ID of the guild's
+    log channel at the time it was loaded. Features that do not exist in the database are cached as disabled.
+
+    Anything that writes to GuildLogFeatures, or GuildConfig.log_channel, MUST call :meth:`invalidate` once the write
+    has been committed, otherwise stale data will be served until the process restarts.
+    """
+
+    def __init__(self):
+        self._entries: dict[int, dict[str, tuple[bool, int | None]]] = {}
+        self._generations: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return "<LogFeatureCache entries={0} hits={1.hits} misses={1.misses}>".format(len(self), self)
+
+    def __len__(self):
+        return sum(map(len, self._entries.values()))
+
+    def get(self, guild_id: int, feature: str) -> tuple[bool, int | None] | None:
+        """
+        Fetches a cached (enabled, log_channel_id) pair.
+
+        :param guild_id: The guild ID
+        :param feature: The log feature name
+        :return: The cached pair, or None if there is no cached entry (a miss).
+        """
+        entry = self._entries.get(guild_id, {}).get(feature)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def generation(self, guild_id: int) -> int:
+        """
+        Returns the current invalidation generation for a guild.
+
+        This should be read before querying the database, and passed to :meth:`set`, so that a result loaded
+        concurrently with an invalidation is not cached.
+        """
+        return self._generations.get(guild_id, 0)
+
+    def set(self, guild_id: int, feature: str, enabled: bool, log_channel_id: int | None, *, generation: int) -> bool:
+        """
+        Caches a (enabled, log_channel_id) pair, if the guild has not been invalidated since `generation`.
+
+        :return: Whether the entry was stored.
+        """
+        if self.generation(guild_id) != generation:
+            log.debug("Not caching %r/%r - invalidated while loading.", guild_id, feature)
+            return False
+        self._entries.setdefault(guild_id, {})[feature] = (enabled, log_channel_id)
+        return True
+
+    def invalidate(self, guild_id: int, feature: str | None = None) -> None:
+        """
+        Invalidates cached entries for a guild.
+
+        :param guild_id: The guild ID
+        :param feature: The feature to invalidate. If omitted, every feature for the guild is invalidated (for example,
+        when the log channel changes, or the guild is removed).
+        """
+        self._generations[guild_id] = self.generation(guild_id) + 1
+        self.invalidations += 1
+        if feature is None:
+            self._entries.pop(guild_id, None)
+        else:
+            self._entries.get(guild_id, {}).pop(feature, None)
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+log_feature_cache = LogFeatureCache()
+
+
+class LRUCache(typing.Generic[K, V]):
+    """
+    A bounded mapping that evicts its least recently used entry once `capacity` entries are held.
+
+    Lookups through :meth:`get` count towards the hit rate and refresh the entry, `in` checks do neither.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("LRUCache capacity must be at least 1.")
+        self.capacity = capacity
+        self._data: collections.OrderedDict[K, V] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "<LRUCache size={0} capacity={1.capacity} hits={1.hits} misses={1.misses}>".format(len(self), self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: K, default: V | None = None) -> V | None:
+        return self._data.pop(key, default)
+
+    @property
+    def memory_usage(self) -> int:
+        """An approximation of the memory held by the cache, in bytes. This is O(n), so is only meant for metrics."""
+        size = sys.getsizeof(self._data)
+        for key, value in self._data.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+            if isinstance(key, tuple):
+                size += sum(map(sys.getsizeof, key))
+        return size
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "memory_bytes": self.memory_usage,
+        }
+
+
+class StarboardConfigCache:
+    """
+    A process-wide cache of each guild's StarboardConfig, including guilds that do not have one.
+
+    Most guilds never set up a starboard, so caching "no config" is what saves a query on every reaction.
+
+    Anything that writes to StarboardConfig MUST call :meth:`invalidate` once the write has been committed.
+    Cached configs are shared between callers, so they must not be modified in place - fetch a fresh copy to save.
+    """
+
+    def __init__(self):
+        self._entries: dict[int, StarboardConfig | None] = {}
+        self._generations: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return "<StarboardConfigCache entries={0} hits={1.hits} misses={1.misses}>".format(len(self._entries), self)
+
+    async def get(self, guild_id: int) -> StarboardConfig | None:
+        """
+        Fetches a guild's starboard config, from the cache where possible.
+
+        :param guild_id: The guild ID
+        :return: The starboard config, or None if the guild does not have a starboard.
+        """
+        try:
+            config = self._entries[guild_id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return config
+
+        generation = self._generations.get(guild_id, 0)
+        config = await StarboardConfig.get_or_none(guild__id=guild_id)
+        if self._generations.get(guild_id, 0) == generation:
+            self._entries[guild_id] = config
+        return config
+
+    async def load(self, guild_ids: typing.Iterable[int]) -> None:
+        """
+        Populates the cache for every given guild with a single query.
+
+        Guilds that do not have a starboard are cached as such.
+        """
+        generations = {guild_id: self._generations.get(guild_id, 0) for guild_id in guild_ids}
+        configs = {config.guild_id: config for config in await StarboardConfig.all()}
+        for guild_id, generation in generations.items():
+            if self._generations.get(guild_id, 0) == generation:
+                self._entries[guild_id] = configs.get(guild_id)
+        log.debug("Loaded %d starboard configs for %d guilds.", len(configs), len(generations))
+
+    def invalidate(self, guild_id: int) -> None:
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        self.invalidations += 1
+        self._entries.pop(guild_id, None)
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "configured": sum(1 for config in self._entries.values() if config is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+starboard_config_cache = StarboardConfigCache()
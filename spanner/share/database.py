@@ -1,25 +1,34 @@
+import asyncio
 import datetime
 import enum
-import json
+import hashlib
+import logging
+import time
 import typing
 import uuid
 import warnings
 from typing import Any, Union
 
 import discord
-from tortoise import fields
+import orjson
+from tortoise import fields, timezone
 from tortoise.contrib.pydantic import pydantic_model_creator
 from tortoise.models import Model
+from tortoise.transactions import in_transaction
 
 try:
     import aerich.models
 except ImportError:
     raise RuntimeError("Aerich is not installed. Please install it by running `pip install aerich`.")
 
+log = logging.getLogger(__name__)
+
 
 class GuildConfig(Model):
     id: int = fields.BigIntField(pk=True, generated=False)
     log_channel: int | None = fields.BigIntField(default=None, null=True)
+    audit_log_retention_days: int | None = fields.IntField(default=None, null=True)
+    """How many days to keep audit log entries for. None for the longest retention the guild is allowed."""
 
     def __repr__(self):
         return "GuildConfig(id={0.id!r}, log_channel={0.log_channel!r})".format(self)
@@ -123,9 +132,15 @@ class GuildAuditLogEntry(Model):
     namespace: str = fields.CharField(min_length=1, max_length=128)
     action: str = fields.CharField(min_length=1, max_length=128)
     description: str = fields.TextField()
-    created_at: datetime.datetime = fields.DatetimeField(auto_now=True)
+    created_at: datetime.datetime = fields.DatetimeField(auto_now_add=True)
     metadata: dict = fields.JSONField(default={})
     version: int = fields.IntField(default=2)
+    target_hash: str | None = fields.CharField(max_length=64, null=True, default=None, index=True)
+    """The hash of the entry's :class:`AuditLogSnapshot`, if it has a target. Version 5 entries and above."""
+
+    class Meta:
+        # Entries are always listed per guild, newest first, and often filtered by namespace and action.
+        indexes = (("guild_id", "created_at"), ("guild_id", "namespace", "action"))
 
     @classmethod
     async def generate(
@@ -139,12 +154,20 @@ class GuildAuditLogEntry(Model):
         *,
         target: Any = None,
         using_db=None,
+        wait: bool = False,
     ) -> typing.Self:
         """
         Generates a new audit log entry
 
         This function should be used instead of create(), as it produces a consistent, API-friendly output.
+
+        Entries are written in batches by :data:`audit_log_writer`, unless `using_db` is given, in which case the entry
+        is created straight away as part of that transaction.
+
+        :param wait: Whether to wait for the entry's batch to be written before returning.
+        :raises Exception: The error the entry could not be written with, if `wait` is given.
         """
+        started = time.process_time()
         metadata = metadata or {}
         if isinstance(author, int):
             author = discord.Object(id=author)
@@ -179,61 +202,270 @@ class GuildAuditLogEntry(Model):
                 case "delete":
                     metadata["action.historical"] = "deleted"
 
+        snapshot = None
         if target:
             match type(target):
                 case discord.Member:
                     from spanner.api.models.discord_ import Member
 
-                    metadata["target"] = Member.from_member(target).model_dump()
+                    snapshot = Member.from_member(target).model_dump()
                 case discord.User:
                     from spanner.api.models.discord_ import User
 
-                    metadata["target"] = User.from_user(target).model_dump()
+                    snapshot = User.from_user(target).model_dump()
                 case discord.Guild:
                     from spanner.api.models.discord_ import PartialGuild
 
-                    metadata["target"] = PartialGuild.from_guild(target).model_dump()
+                    snapshot = PartialGuild.from_guild(target).model_dump()
                 case discord.Role:
                     from spanner.api.models.discord_ import Role
 
-                    metadata["target"] = Role.from_role(target).model_dump()
+                    snapshot = Role.from_role(target).model_dump()
                 case discord.TextChannel:
                     from spanner.api.models.discord_ import ChannelInformation
 
-                    metadata["target"] = ChannelInformation.from_channel(target).model_dump()
+                    snapshot = ChannelInformation.from_channel(target).model_dump()
                 case discord.VoiceChannel:
                     from spanner.api.models.discord_ import ChannelInformation
 
-                    metadata["target"] = ChannelInformation.from_channel(target).model_dump()
+                    snapshot = ChannelInformation.from_channel(target).model_dump()
                 case discord.StageChannel:
                     from spanner.api.models.discord_ import ChannelInformation
 
-                    metadata["target"] = ChannelInformation.from_channel(target).model_dump()
+                    snapshot = ChannelInformation.from_channel(target).model_dump()
                 case discord.CategoryChannel:
                     from spanner.api.models.discord_ import ChannelInformation
 
-                    metadata["target"] = ChannelInformation.from_channel(target).model_dump()
+                    snapshot = ChannelInformation.from_channel(target).model_dump()
                 case discord.abc.Snowflake:
-                    metadata["target"] = {"id": str(target.id)}
+                    snapshot = {"id": str(target.id)}
                 case _:
                     try:
-                        metadata["target"] = json.loads(
-                            json.dumps(getattr(target, "to_dict", lambda: target)(), default=repr)
-                        )
+                        snapshot = getattr(target, "to_dict", lambda: target)()
                     except Exception as e:
-                        metadata["target"] = repr(target)
+                        snapshot = repr(target)
                         warnings.warn(f"Failed to convert target to JSON: {e!r}", RuntimeWarning, stacklevel=2)
 
-        return await cls.create(
+        target_snapshot = None
+        if snapshot is not None:
+            target_snapshot = AuditLogSnapshot.from_data(snapshot)
+
+        values = dict(
             guild_id=guild_id,
             author=str(author.id),
             namespace=namespace,
             action=action,
             description=description,
             metadata=metadata,
-            version=4 if target else 3,
-            using_db=using_db,
+            version=5 if target_snapshot else 3,
+            target_hash=target_snapshot.hash if target_snapshot else None,
+            # Entries are written a little later, in batches, but are dated when they were generated.
+            created_at=timezone.now(),
         )
+        audit_log_writer.record_generated(
+            len(orjson.dumps(metadata, default=repr, option=orjson.OPT_NON_STR_KEYS)), time.process_time() - started
+        )
+        if using_db is not None:
+            # The caller's transaction decides when (and whether) the entry is written.
+            if target_snapshot is not None:
+                await AuditLogSnapshot.bulk_create([target_snapshot], ignore_conflicts=True, using_db=using_db)
+            return await cls.create(**values, using_db=using_db)
+        entry = cls(**values)
+        written = audit_log_writer.add(entry, target_snapshot)
+        if wait:
+            error = (await written).get(entry.id)
+            if error is not None:
+                raise error
+        return entry
+
+    @classmethod
+    async def rehydrate(cls, entries: typing.Iterable["GuildAuditLogEntry"]) -> None:
+        """
+        Puts the target snapshot of each entry back into its `metadata["target"]`, as in older entries.
+
+        Entries that already have a `metadata["target"]` (e.g. prune, which stores the pruned messages there) are left
+        as they are.
+        """
+        entries = [entry for entry in entries if entry.target_hash and "target" not in entry.metadata]
+        if not entries:
+            return
+        hashes = {entry.target_hash for entry in entries}
+        snapshots = dict(await AuditLogSnapshot.filter(hash__in=hashes).values_list("hash", "data"))
+        for entry in entries:
+            if entry.target_hash in snapshots:
+                entry.metadata["target"] = snapshots[entry.target_hash]
+
+
+class AuditLogSnapshot(Model):
+    # A snapshot of an audit log entry's target (e.g. a member or role), shared by every entry with the same target.
+    # Snapshots are content-addressed: the primary key is the SHA-256 of the snapshot's canonical JSON, so identical
+    # snapshots (e.g. the same member across many auto-role entries) are only stored once.
+    hash: str = fields.CharField(max_length=64, pk=True)
+    data: typing.Any = fields.JSONField()
+    created_at: datetime.datetime = fields.DatetimeField(auto_now_add=True)
+
+    @classmethod
+    def from_data(cls, data: typing.Any) -> "AuditLogSnapshot":
+        encoded = orjson.dumps(data, default=repr, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        return cls(hash=hashlib.sha256(encoded).hexdigest(), data=orjson.loads(encoded))
+
+
+class AuditLogWriter:
+    """
+    Writes :class:`GuildAuditLogEntry` rows in batches, rather than one INSERT per entry.
+
+    Entries are flushed with a single multi-row INSERT once `max_batch` are queued, or `interval` seconds after the
+    first entry of a batch was queued, whichever comes first. If a batch fails (e.g. one entry's guild has since
+    been deleted), its entries are retried one at a time so that the rest are still written.
+    """
+
+    def __init__(self, *, max_batch: int = 100, interval: float = 1.0):
+        self.max_batch = max_batch
+        self.interval = interval
+        self._queue: list[GuildAuditLogEntry] = []
+        self._snapshots: dict[str, AuditLogSnapshot] = {}
+        self._written: asyncio.Future[dict[uuid.UUID, BaseException]] | None = None
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._batch_size_max = 0
+        self.generated = 0
+        self._metadata_bytes_total = 0
+        self._generate_cpu_total = 0.0
+
+    def __repr__(self):
+        return "<AuditLogWriter queued={0} max_batch={1.max_batch}>".format(len(self._queue), self)
+
+    def record_generated(self, metadata_bytes: int, cpu_time: float) -> None:
+        """Records the encoded metadata size of, and CPU time taken to build, a generated entry."""
+        self.generated += 1
+        self._metadata_bytes_total += metadata_bytes
+        self._generate_cpu_total += cpu_time
+
+    def add(
+        self, entry: GuildAuditLogEntry, snapshot: "AuditLogSnapshot | None" = None
+    ) -> asyncio.Future[dict[uuid.UUID, BaseException]]:
+        """
+        Queues an entry (and its target snapshot) to be written.
+
+        :return: A future that resolves once the entry's batch has been written, to the errors of the batch's entries
+        that could not be written, keyed by their ID.
+        """
+        loop = asyncio.get_running_loop()
+        if self._written is None:
+            self._written = loop.create_future()
+        written = self._written
+        self._queue.append(entry)
+        if snapshot is not None:
+            self._snapshots.setdefault(snapshot.hash, snapshot)
+        self.queued += 1
+        if len(self._queue) >= self.max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._schedule_flush)
+        return written
+
+    def _take(
+        self,
+    ) -> tuple[
+        list[GuildAuditLogEntry], list["AuditLogSnapshot"], asyncio.Future[dict[uuid.UUID, BaseException]] | None
+    ]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        snapshots, self._snapshots = list(self._snapshots.values()), {}
+        written, self._written = self._written, None
+        return batch, snapshots, written
+
+    def _schedule_flush(self) -> None:
+        # The batch is taken now, so entries queued before the flush task runs start a new batch.
+        task = asyncio.create_task(self._flush(*self._take()))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(
+        self, batch: list[GuildAuditLogEntry], snapshots: list["AuditLogSnapshot"]
+    ) -> dict[uuid.UUID, BaseException]:
+        errors: dict[uuid.UUID, BaseException] = {}
+        try:
+            async with in_transaction():
+                if snapshots:
+                    # Most snapshots will already exist, which is the point of them.
+                    await AuditLogSnapshot.bulk_create(snapshots, ignore_conflicts=True)
+                await GuildAuditLogEntry.bulk_create(batch)
+        except Exception as e:
+            log.warning("Failed to write a batch of %d audit log entries (%r), retrying individually.", len(batch), e)
+            if snapshots:
+                try:
+                    await AuditLogSnapshot.bulk_create(snapshots, ignore_conflicts=True)
+                except Exception as e:
+                    log.error("Failed to write %d audit log snapshots.", len(snapshots), exc_info=e)
+            for entry in batch:
+                try:
+                    await entry.save(force_create=True)
+                except Exception as e:
+                    self.failed += 1
+                    errors[entry.id] = e
+                    log.error("Failed to write audit log entry %r.", entry, exc_info=e)
+                else:
+                    self.written += 1
+        else:
+            self.written += len(batch)
+        return errors
+
+    async def _flush(
+        self,
+        batch: list[GuildAuditLogEntry],
+        snapshots: list["AuditLogSnapshot"],
+        written: asyncio.Future[dict[uuid.UUID, BaseException]] | None,
+    ) -> None:
+        if not batch:
+            return
+        self.batches += 1
+        self._batch_size_max = max(self._batch_size_max, len(batch))
+        errors: dict[uuid.UUID, BaseException] = {}
+        try:
+            errors = await self._write(batch, snapshots)
+        except BaseException as e:
+            # e.g. cancelled while shutting down; nothing in the batch can be assumed to have been written.
+            errors = {entry.id: e for entry in batch}
+            raise
+        finally:
+            if not written.done():
+                written.set_result(errors)
+
+    async def flush(self) -> None:
+        """Writes everything that is currently queued."""
+        await self._flush(*self._take())
+
+    async def close(self) -> None:
+        """Writes everything still queued, and waits for any flushes in progress."""
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "pending": len(self._queue),
+            "queued": self.queued,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "batch_size_avg": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "batch_size_max": self._batch_size_max,
+            "metadata_bytes_avg": round(self._metadata_bytes_total / self.generated, 2) if self.generated else 0.0,
+            "generate_cpu_avg_ms": (
+                round(self._generate_cpu_total / self.generated * 1000, 3) if self.generated else 0.0
+            ),
+        }
+
+
+audit_log_writer = AuditLogWriter()
 
 
 GuildAuditLogEntryPydantic = pydantic_model_creator(GuildAuditLogEntry, name="GuildAuditLogEntry")
@@ -268,8 +500,14 @@ class DiscordOauthUser(Model):
     refresh_token = fields.CharField(max_length=255)
     expires_at = fields.FloatField()
     session = fields.CharField(max_length=1024, default=None, null=True)
+    session_hash: str | None = fields.CharField(max_length=64, default=None, null=True, unique=True)
+    """The SHA256 of `session`, which sessions are looked up by. Set whenever `session` is."""
     scope: str = fields.TextField()
 
+    @staticmethod
+    def hash_session(session: str) -> str:
+        return hashlib.sha256(session.encode()).hexdigest()
+
 
 class StarboardMode(enum.IntEnum):
     COUNT = 0
@@ -301,6 +539,8 @@ class StarboardEntry(Model):
     source_message_id: int = fields.BigIntField()
     starboard_message_id: int = fields.BigIntField()
     source_channel_id: int = fields.BigIntField()
+    star_count: int | None = fields.IntField(null=True, default=None)
+    """The last known number of stars on the source message. None for entries that have not been counted yet."""
     config: fields.ForeignKeyRelation[StarboardConfig] = fields.ForeignKeyField(
         "models.StarboardConfig", related_name="entries", on_delete=fields.CASCADE
     )
@@ -0,0 +1,171 @@
+import logging
+import time
+import typing
+
+import httpx
+
+from .config import load_config
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    HTTP2_AVAILABLE = False
+else:
+    HTTP2_AVAILABLE = True
+
+__all__ = ("HTTPClientRegistry", "http_clients")
+log = logging.getLogger(__name__)
+
+
+class _ClientStats:
+    __slots__ = (
+        "requests",
+        "server_errors",
+        "new_connections",
+        "pool_wait_total",
+        "pool_wait_max",
+        "latency_total",
+        "latency_max",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.server_errors = 0
+        self.new_connections = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def to_dict(self) -> dict[str, int | float]:
+        return {
+            "requests": self.requests,
+            "server_errors": self.server_errors,
+            "new_connections": self.new_connections,
+            "pool_wait_avg_ms": round(self.pool_wait_total / self.requests * 1000, 2) if self.requests else 0.0,
+            "pool_wait_max_ms": round(self.pool_wait_max * 1000, 2),
+            "latency_avg_ms": round(self.latency_total / self.requests * 1000, 2) if self.requests else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 2),
+        }
+
+
+class _RequestTrace:
+    """Tracks one request through httpcore's trace events, to measure how long it waited for a pooled connection."""
+
+    __slots__ = ("stats", "started", "waited")
+
+    def __init__(self, stats: _ClientStats):
+        self.stats = stats
+        self.started = time.perf_counter()
+        self.waited = False
+
+    async def __call__(self, event: str, info: dict[str, typing.Any]) -> None:
+        if self.waited or not event.endswith(".started"):
+            return
+        # The first thing a request does once it has a connection is either open it, or send on it.
+        if event.startswith("connection.connect_tcp") or event.endswith("send_request_headers.started"):
+            self.waited = True
+            wait = time.perf_counter() - self.started
+            self.stats.pool_wait_total += wait
+            self.stats.pool_wait_max = max(self.stats.pool_wait_max, wait)
+            if event.startswith("connection.connect_tcp"):
+                self.stats.new_connections += 1
+
+
+class HTTPClientRegistry:
+    """
+    Holds one long-lived :class:`httpx.AsyncClient` per upstream service, so connections are pooled and kept alive
+    across requests, rather than set up (TCP + TLS) again for every request.
+
+    Upstreams are registered with a name and default settings, which can be overridden in the config under
+    `[http.<name>]` (`base_url`, `timeout`, `max_connections`, `max_keepalive_connections`, `http2`).
+    Clients are created the first time they are used.
+    """
+
+    def __init__(self):
+        self._settings: dict[str, dict[str, typing.Any]] = {}
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._stats: dict[str, _ClientStats] = {}
+
+    def __repr__(self):
+        return "<HTTPClientRegistry upstreams={0}>".format(list(self._settings))
+
+    def register(
+        self,
+        name: str,
+        base_url: str = "",
+        *,
+        timeout: float = 10.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        http2: bool = False,
+    ) -> None:
+        """Registers an upstream. If it was already registered (and its client created), the old client is kept."""
+        settings = dict(
+            base_url=base_url,
+            timeout=timeout,
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            http2=http2,
+        )
+        settings.update(load_config().get("http", {}).get(name, {}))
+        if settings["http2"] and not HTTP2_AVAILABLE:
+            log.warning("HTTP/2 was requested for %r, but the h2 package is not installed. Using HTTP/1.1.", name)
+            settings["http2"] = False
+        self._settings[name] = settings
+        self._stats.setdefault(name, _ClientStats())
+
+    def _create(self, name: str) -> httpx.AsyncClient:
+        settings = self._settings[name]
+        stats = self._stats[name]
+
+        async def on_request(request: httpx.Request) -> None:
+            trace = _RequestTrace(stats)
+            request.extensions["trace"] = trace
+            request.extensions["spanner.trace"] = trace
+
+        async def on_response(response: httpx.Response) -> None:
+            trace = response.request.extensions["spanner.trace"]
+            latency = time.perf_counter() - trace.started
+            stats.requests += 1
+            stats.latency_total += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            if response.status_code >= 500:
+                stats.server_errors += 1
+
+        log.debug("Creating HTTP client for %r: %r", name, settings)
+        return httpx.AsyncClient(
+            base_url=settings["base_url"],
+            timeout=settings["timeout"],
+            limits=httpx.Limits(
+                max_connections=settings["max_connections"],
+                max_keepalive_connections=settings["max_keepalive_connections"],
+            ),
+            http2=settings["http2"],
+            event_hooks={"request": [on_request], "response": [on_response]},
+        )
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """
+        Returns the shared client for an upstream. The client must not be closed by the caller.
+
+        :raises KeyError: The upstream was never registered.
+        """
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            if name not in self._settings:
+                raise KeyError("No HTTP upstream named %r has been registered." % name)
+            client = self._clients[name] = self._create(name)
+        return client
+
+    async def close(self) -> None:
+        """Closes every client. They are recreated if used again."""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> dict[str, dict[str, int | float]]:
+        return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+
+http_clients = HTTPClientRegistry()
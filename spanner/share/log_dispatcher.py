@@ -0,0 +1,317 @@
+import asyncio
+import collections
+import io
+import logging
+import math
+import time
+
+import discord
+from discord.ext import bridge
+
+from .utils import get_log_channel
+
+__all__ = ("LogEntry", "LogDispatcher")
+log = logging.getLogger(__name__)
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_FILES = 10
+
+
+def _file_size(file: discord.File) -> float:
+    """Returns the remaining size of a file's buffer, or infinity if it cannot be determined."""
+    try:
+        position = file.fp.tell()
+        size = file.fp.seek(0, io.SEEK_END) - position
+        file.fp.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return math.inf
+    return size
+
+
+def _fits(embeds: list[discord.Embed]) -> bool:
+    return len(embeds) <= MAX_EMBEDS and sum(map(len, embeds)) <= MAX_EMBED_CHARACTERS
+
+
+class _SentMessage:
+    """A log message that was sent by the dispatcher, and the entries it contains."""
+
+    __slots__ = ("message", "entries", "lock")
+
+    def __init__(self, message: discord.Message, entries: list["LogEntry"]):
+        self.message = message
+        self.entries = entries
+        self.lock = asyncio.Lock()
+
+    def embeds(self) -> list[discord.Embed]:
+        return [embed for entry in self.entries for embed in entry.embeds]
+
+
+class LogEntry:
+    """
+    A handle to a set of embeds sent through the :class:`LogDispatcher`.
+
+    Several entries may be packed into the same message, so entries should be edited and deleted through
+    :meth:`edit` and :meth:`delete`, rather than through :attr:`message` directly.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, embeds: list[discord.Embed], files: list[discord.File]):
+        self.channel = channel
+        self.embeds = embeds
+        self.files = files
+        self.created_at = time.monotonic()
+        self._sent: _SentMessage | None = None
+        self._future: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+
+    def __repr__(self):
+        return "<LogEntry channel={0.channel!r} embeds={1} message={0.message!r}>".format(self, len(self.embeds))
+
+    @property
+    def message(self) -> discord.Message | None:
+        """The message this entry was sent in, if it has been sent."""
+        return self._sent.message if self._sent else None
+
+    @property
+    def file_size(self) -> float:
+        return sum(map(_file_size, self.files))
+
+    async def edit(self, *, embeds: list[discord.Embed]) -> None:
+        """
+        Replaces this entry's embeds, leaving any other entries in the same message untouched.
+
+        If the new embeds no longer fit alongside the other entries, this entry is moved into its own message.
+        """
+        sent = self._sent
+        if sent is None:
+            raise RuntimeError("This entry has not been sent yet.")
+        async with sent.lock:
+            self.embeds = list(embeds)
+            if len(sent.entries) == 1 or _fits(sent.embeds()):
+                sent.message = await sent.message.edit(embeds=sent.embeds())
+                return
+            sent.entries.remove(self)
+            sent.message = await sent.message.edit(embeds=sent.embeds())
+        log.debug("%r no longer fits in %r, moving it to a new message.", self, sent.message)
+        message = await self.channel.send(embeds=self.embeds)
+        self._sent = _SentMessage(message, [self])
+
+    async def delete(self, *, delay: float | None = None) -> None:
+        """
+        Removes this entry from its message, deleting the message if no other entries remain in it.
+
+        :param delay: How many seconds to wait before removing the entry.
+        """
+        if delay:
+            await asyncio.sleep(delay)
+        sent = self._sent
+        if sent is None:
+            raise RuntimeError("This entry has not been sent yet.")
+        async with sent.lock:
+            if self not in sent.entries:
+                return
+            sent.entries.remove(self)
+            if sent.entries:
+                sent.message = await sent.message.edit(embeds=sent.embeds())
+            else:
+                await sent.message.delete()
+
+
+class LogDispatcher:
+    """
+    Coalesces log messages into as few sends as possible, per log channel.
+
+    Entries are queued per channel, and are flushed once the oldest queued entry is `window` seconds old, or as soon
+    as a full message's worth of embeds is waiting. Up to 10 embeds (and 10 files) are packed into each message.
+    Sends are additionally paced by a per-channel bucket of `rate` messages per `per` seconds, mirroring discord's
+    per-channel message ratelimit, so bursts are absorbed here rather than by 429s.
+    """
+
+    def __init__(self, bot: bridge.Bot, *, window: float = 1.0, rate: int = 5, per: float = 5.0):
+        self.bot = bot
+        self.window = window
+        self.rate = rate
+        self.per = per
+        self._queues: dict[int, collections.deque[LogEntry]] = {}
+        self._wakeups: dict[int, asyncio.Event] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._buckets: dict[int, collections.deque[float]] = {}
+        self._pending_embeds: dict[int, int] = {}
+        self._closing = False
+
+        self.enqueued = 0
+        self.entries_sent = 0
+        self.messages_sent = 0
+        self.embeds_sent = 0
+        self.failures = 0
+        self._flush_latency_total = 0.0
+        self._flush_latency_max = 0.0
+
+    def __repr__(self):
+        return "<LogDispatcher queued={0} channels={1}>".format(self.queue_depth, len(self._queues))
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of entries waiting to be sent, across all channels."""
+        return sum(map(len, self._queues.values()))
+
+    async def send(
+        self,
+        guild_id: int,
+        log_feature: str,
+        *,
+        embeds: list[discord.Embed],
+        files: list[discord.File] | None = None,
+    ) -> LogEntry | None:
+        """
+        Queues embeds (and files) to be sent to a guild's log channel, for the given log feature.
+
+        This waits until the entry has actually been sent.
+
+        :param guild_id: The guild ID
+        :param log_feature: The log feature name
+        :param embeds: The embeds to send. These are always kept together in the same message.
+        :param files: Files to attach. Embeds may reference these with `attachment://`.
+        :return: The sent entry, or None if the feature is disabled, the log channel is unavailable, or sending failed.
+        """
+        log_channel = await get_log_channel(self.bot, guild_id, log_feature)
+        if log_channel is None:
+            return
+        entry = LogEntry(log_channel, list(embeds), list(files or []))
+        self._enqueue(entry)
+        if await entry._future:
+            return entry
+
+    def _enqueue(self, entry: LogEntry) -> None:
+        channel_id = entry.channel.id
+        self._queues.setdefault(channel_id, collections.deque()).append(entry)
+        self._pending_embeds[channel_id] = self._pending_embeds.get(channel_id, 0) + len(entry.embeds)
+        self.enqueued += 1
+        wakeup = self._wakeups.setdefault(channel_id, asyncio.Event())
+        if self._closing or self._pending_embeds[channel_id] >= MAX_EMBEDS:
+            wakeup.set()
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._worker(channel_id), name=f"log-dispatch-{channel_id}")
+
+    @staticmethod
+    def _take_batch(queue: collections.deque[LogEntry]) -> list[LogEntry]:
+        """Pops as many entries off the front of the queue as will fit into a single message."""
+        batch = [queue.popleft()]
+        embeds = list(batch[0].embeds)
+        filenames = {file.filename for file in batch[0].files}
+        file_size = batch[0].file_size
+        limit = getattr(getattr(batch[0].channel, "guild", None), "filesize_limit", 0)
+        while queue:
+            entry = queue[0]
+            if not _fits(embeds + entry.embeds):
+                break
+            if entry.files:
+                if len(filenames) + len(entry.files) > MAX_FILES:
+                    break
+                if filenames.intersection(file.filename for file in entry.files):
+                    break
+                if file_size + entry.file_size > limit:
+                    break
+            batch.append(queue.popleft())
+            embeds += entry.embeds
+            filenames.update(file.filename for file in entry.files)
+            file_size += entry.file_size
+        return batch
+
+    async def _acquire_bucket(self, channel_id: int) -> None:
+        sent = self._buckets.setdefault(channel_id, collections.deque())
+        now = time.monotonic()
+        while sent and sent[0] <= now - self.per:
+            sent.popleft()
+        if len(sent) >= self.rate:
+            delay = sent[0] + self.per - now
+            log.debug("Log channel %d bucket exhausted, waiting %.2fs.", channel_id, delay)
+            await asyncio.sleep(delay)
+            sent.popleft()
+        sent.append(time.monotonic())
+
+    async def _worker(self, channel_id: int) -> None:
+        queue = self._queues[channel_id]
+        wakeup = self._wakeups[channel_id]
+        batch: list[LogEntry] = []
+        try:
+            while queue:
+                delay = queue[0].created_at + self.window - time.monotonic()
+                if delay > 0 and not self._closing and self._pending_embeds[channel_id] < MAX_EMBEDS:
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                batch = self._take_batch(queue)
+                self._pending_embeds[channel_id] -= sum(len(entry.embeds) for entry in batch)
+                await self._acquire_bucket(channel_id)
+                try:
+                    await self._flush(batch)
+                except Exception as e:
+                    self.failures += 1
+                    log.error("Unexpected error while flushing log entries to %d", channel_id, exc_info=e)
+                    for entry in batch:
+                        if not entry._future.done():
+                            entry._future.set_result(False)
+        finally:
+            self._workers.pop(channel_id, None)
+            self._queues.pop(channel_id, None)
+            self._wakeups.pop(channel_id, None)
+            self._pending_embeds.pop(channel_id, None)
+            for entry in (*batch, *queue):
+                if not entry._future.done():
+                    entry._future.set_result(False)
+
+    async def _flush(self, batch: list[LogEntry]) -> None:
+        channel = batch[0].channel
+        embeds = [embed for entry in batch for embed in entry.embeds]
+        files = [file for entry in batch for file in entry.files]
+        try:
+            message = await channel.send(embeds=embeds, files=files or None)
+        except discord.HTTPException as e:
+            self.failures += 1
+            log.warning("Failed to send %d log entries to %r: %s", len(batch), channel, e, exc_info=e)
+            for entry in batch:
+                entry._future.set_result(False)
+            return
+
+        sent = _SentMessage(message, batch)
+        now = time.monotonic()
+        self.entries_sent += len(batch)
+        self.messages_sent += 1
+        self.embeds_sent += len(embeds)
+        for entry in batch:
+            latency = now - entry.created_at
+            self._flush_latency_total += latency
+            self._flush_latency_max = max(self._flush_latency_max, latency)
+            entry._sent = sent
+            entry._future.set_result(True)
+        log.debug("Flushed %d log entries (%d embeds) to %r.", len(batch), len(embeds), channel)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Flushes everything that is currently queued, cancelling whatever is left after `timeout` seconds."""
+        self._closing = True
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "active_channels": len(self._workers),
+            "enqueued": self.enqueued,
+            "entries_sent": self.entries_sent,
+            "messages_sent": self.messages_sent,
+            "embeds_sent": self.embeds_sent,
+            "failures": self.failures,
+            "flush_latency_avg_ms": (
+                round(self._flush_latency_total / self.entries_sent * 1000, 2) if self.entries_sent else 0.0
+            ),
+            "flush_latency_max_ms": round(self._flush_latency_max * 1000, 2),
+        }
@@ -0,0 +1,102 @@
+import collections
+import typing
+
+import discord
+from discord.state import ConnectionState
+
+__all__ = ("MessageIndex", "IndexedConnectionState")
+
+
+class MessageIndex(collections.deque):
+    """
+    A drop-in replacement for the connection state's message cache deque, which also indexes messages by ID.
+
+    The deque keeps its usual insertion order and `maxlen` eviction, so everything else that iterates over the
+    message cache keeps working unchanged, however looking up a message by ID with :meth:`get` is O(1).
+    """
+
+    def __init__(self, iterable: typing.Iterable[discord.Message] = (), maxlen: int | None = None):
+        super().__init__(iterable, maxlen)
+        self._index: dict[int, discord.Message] = {message.id: message for message in self}
+        self.hits = 0
+        self.misses = 0
+
+    def _unindex(self, message: discord.Message) -> None:
+        # The same message may have been cached more than once, in which case only the newest copy is indexed.
+        if self._index.get(message.id) is message:
+            del self._index[message.id]
+
+    def get(self, message_id: int) -> discord.Message | None:
+        message = self._index.get(message_id)
+        if message is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return message
+
+    def append(self, message: discord.Message) -> None:
+        if self.maxlen is not None and len(self) == self.maxlen:
+            self._unindex(self[0])
+        super().append(message)
+        self._index[message.id] = message
+
+    def extend(self, messages: typing.Iterable[discord.Message]) -> None:
+        for message in messages:
+            self.append(message)
+
+    def remove(self, message: discord.Message) -> None:
+        super().remove(message)
+        self._unindex(message)
+
+    def popleft(self) -> discord.Message:
+        message = super().popleft()
+        self._unindex(message)
+        return message
+
+    def pop(self) -> discord.Message:
+        message = super().pop()
+        self._unindex(message)
+        return message
+
+    def clear(self) -> None:
+        super().clear()
+        self._index.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "indexed": len(self._index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class IndexedConnectionState(ConnectionState):
+    """
+    A connection state whose message cache is a :class:`MessageIndex`.
+
+    The library replaces the message cache wholesale in a few places (e.g. when clearing state, or leaving a guild),
+    so any deque assigned to `_messages` is converted into an index.
+    """
+
+    @property
+    def _messages(self) -> MessageIndex | None:
+        return self.__dict__.get("_message_index")
+
+    @_messages.setter
+    def _messages(self, value: typing.Iterable[discord.Message] | None) -> None:
+        if value is not None and not isinstance(value, MessageIndex):
+            value = MessageIndex(value, maxlen=self.max_messages)
+        self.__dict__["_message_index"] = value
+
+    def _get_message(self, msg_id: int | None) -> discord.Message | None:
+        if self._messages is None or msg_id is None:
+            return
+        return self._messages.get(msg_id)
+
+    def _store_message(self, message: discord.Message) -> None:
+        """Adds a message that was fetched over the REST API to the message cache."""
+        if self._messages is not None and message.id not in self._messages._index:
+            self._messages.append(message)
@@ -0,0 +1,344 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import discord
+
+__all__ = ("StoredMessage", "MessageStore")
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    author_name TEXT NOT NULL,
+    author_avatar TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    edited_at REAL,
+    pinned INTEGER NOT NULL,
+    attachments TEXT NOT NULL,
+    embeds TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_guild_created ON messages (guild_id, created_at);
+"""
+
+
+class StoredMessage(typing.NamedTuple):
+    """The parts of a message that are needed to log its edit or deletion."""
+
+    id: int
+    guild_id: int
+    channel_id: int
+    author_id: int
+    author_name: str
+    author_avatar: str
+    content: str
+    created_at: float
+    edited_at: float | None
+    pinned: bool
+    attachments: list[dict[str, typing.Any]]
+    embeds: list[dict[str, typing.Any]]
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "StoredMessage":
+        return cls(
+            id=message.id,
+            guild_id=message.guild.id,
+            channel_id=message.channel.id,
+            author_id=message.author.id,
+            author_name=message.author.display_name,
+            author_avatar=message.author.display_avatar.url,
+            content=message.content,
+            created_at=message.created_at.timestamp(),
+            edited_at=message.edited_at.timestamp() if message.edited_at else None,
+            pinned=message.pinned,
+            attachments=[
+                {
+                    "id": attachment.id,
+                    "filename": attachment.filename,
+                    "size": attachment.size,
+                    "content_type": attachment.content_type,
+                    "url": attachment.url,
+                }
+                for attachment in message.attachments
+            ],
+            embeds=[embed.to_dict() for embed in message.embeds],
+        )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "StoredMessage":
+        *fields, pinned, attachments, embeds = row
+        return cls(*fields, bool(pinned), json.loads(attachments), json.loads(embeds))
+
+    def to_row(self) -> tuple:
+        *fields, attachments, embeds = self
+        return (*fields, json.dumps(attachments, default=str), json.dumps(embeds, default=str))
+
+    def apply_update(self, data: dict[str, typing.Any]) -> "StoredMessage":
+        """Returns a copy of this message with the changes from a raw MESSAGE_UPDATE payload applied."""
+        changes = {}
+        if "content" in data:
+            changes["content"] = data["content"]
+        if "embeds" in data:
+            changes["embeds"] = data["embeds"]
+        if "pinned" in data:
+            changes["pinned"] = data["pinned"]
+        if data.get("edited_timestamp"):
+            changes["edited_at"] = datetime.datetime.fromisoformat(data["edited_timestamp"]).timestamp()
+        if "attachments" in data:
+            kept = {int(attachment["id"]) for attachment in data["attachments"]}
+            changes["attachments"] = [attachment for attachment in self.attachments if attachment["id"] in kept]
+        return self._replace(**changes)
+
+    @property
+    def created(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.created_at, datetime.timezone.utc)
+
+    @property
+    def edited(self) -> datetime.datetime | None:
+        if self.edited_at is None:
+            return
+        return datetime.datetime.fromtimestamp(self.edited_at, datetime.timezone.utc)
+
+    @property
+    def jump_url(self) -> str:
+        return "https://discord.com/channels/{0.guild_id}/{0.channel_id}/{0.id}".format(self)
+
+    def to_embeds(self) -> list[discord.Embed]:
+        return [discord.Embed.from_dict(embed) for embed in self.embeds]
+
+
+class MessageStore:
+    """
+    An on-disk store of recent guild messages, so edits and deletions can be logged after a message has left the
+    in-memory message cache.
+
+    Only what is needed for logging is kept: content, author, attachment metadata and embeds. Writes are queued and
+    flushed to SQLite in batches every `flush_interval` seconds, from a worker thread. Messages older than a guild's
+    retention period (or beyond `max_messages_per_guild`) are compacted away every `compact_interval` seconds.
+
+    :param path: The SQLite database file to store messages in.
+    :param retention: How many seconds to keep messages for, by default.
+    :param guild_retention: Per-guild overrides of `retention`, keyed by guild ID.
+    :param max_messages_per_guild: The most messages kept per guild, regardless of retention.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike = "messages.db",
+        *,
+        retention: float = 86400 * 7,
+        guild_retention: dict[int, float] | None = None,
+        max_messages_per_guild: int = 50000,
+        flush_interval: float = 2.0,
+        compact_interval: float = 3600.0,
+    ):
+        self.path = path
+        self.retention = retention
+        self.guild_retention = guild_retention or {}
+        self.max_messages_per_guild = max_messages_per_guild
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Only one thread may use the connection at once. Writes are batched, so this is rarely contended.
+        self._db_lock = threading.Lock()
+        self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript(SCHEMA)
+
+        # Message ID -> the message to write, or None to delete it. Later writes to the same message replace earlier.
+        self._pending: dict[int, StoredMessage | None] = {}
+        self._task: asyncio.Task | None = None
+        self._last_compaction = time.monotonic()
+
+        self.stored = 0
+        self.updated = 0
+        self.removed = 0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.compacted = 0
+
+    def __repr__(self):
+        return "<MessageStore path={0.path!r} pending={1}>".format(self, len(self._pending))
+
+    @classmethod
+    def from_config(cls, config: dict[str, typing.Any]) -> "MessageStore":
+        """Creates a store from the `[cogs.message_store]` section of the config."""
+        return cls(
+            config.get("path", "messages.db"),
+            retention=config.get("retention_days", 7) * 86400,
+            guild_retention={
+                int(guild_id): days * 86400 for guild_id, days in config.get("guild_retention_days", {}).items()
+            },
+            max_messages_per_guild=config.get("max_messages_per_guild", 50000),
+        )
+
+    def add(self, message: discord.Message) -> None:
+        """Queues a new message to be stored."""
+        self._pending[message.id] = StoredMessage.from_message(message)
+        self.stored += 1
+
+    async def update(self, payload: discord.RawMessageUpdateEvent) -> StoredMessage | None:
+        """
+        Applies a raw edit to a stored message.
+
+        :return: The message as it was before the edit, or None if it was not stored.
+        """
+        before = await self.get(payload.message_id)
+        if before is not None:
+            self._pending[payload.message_id] = before.apply_update(payload.data)
+            self.updated += 1
+        return before
+
+    def remove(self, *message_ids: int) -> None:
+        """Queues messages to be removed from the store, e.g. once they have been deleted."""
+        for message_id in message_ids:
+            self._pending[message_id] = None
+        self.removed += len(message_ids)
+
+    def _select(self, message_ids: list[int]) -> list[StoredMessage]:
+        placeholders = ", ".join("?" * len(message_ids))
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT * FROM messages WHERE id IN (%s) ORDER BY id" % placeholders, message_ids
+            ).fetchall()
+        return list(map(StoredMessage.from_row, rows))
+
+    async def get_many(self, message_ids: typing.Iterable[int]) -> dict[int, StoredMessage]:
+        """Returns whichever of the given messages are stored, keyed by ID."""
+        message_ids = list(message_ids)
+        found: dict[int, StoredMessage] = {}
+        missing = []
+        for message_id in message_ids:
+            if message_id in self._pending:
+                if self._pending[message_id] is not None:
+                    found[message_id] = self._pending[message_id]
+            else:
+                missing.append(message_id)
+        # SQLite limits how many parameters a single statement can have.
+        for start in range(0, len(missing), 500):
+            for message in await asyncio.to_thread(self._select, missing[start : start + 500]):
+                # The message may have been changed, or removed, while it was being read.
+                found.setdefault(message.id, self._pending.get(message.id, message))
+        found = {message_id: message for message_id, message in found.items() if message is not None}
+        self.hits += len(found)
+        self.misses += len(message_ids) - len(found)
+        return found
+
+    async def get(self, message_id: int) -> StoredMessage | None:
+        return (await self.get_many([message_id])).get(message_id)
+
+    def _write(self, batch: dict[int, StoredMessage | None]) -> None:
+        upserts = [message.to_row() for message in batch.values() if message is not None]
+        deletes = [(message_id,) for message_id, message in batch.items() if message is None]
+        with self._db_lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO messages VALUES (%s)" % ", ".join("?" * 12), upserts)
+                self._db.executemany("DELETE FROM messages WHERE id = ?", deletes)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    async def flush(self) -> None:
+        """Writes all queued changes to disk."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except sqlite3.Error as e:
+            log.error("Failed to write %d messages to the message store.", len(batch), exc_info=e)
+            # Put the batch back, without overwriting anything newer that was queued in the meantime.
+            self._pending = batch | self._pending
+            return
+        self.flushes += 1
+
+    def _compact(self) -> int:
+        now = time.time()
+        removed = 0
+        with self._db_lock:
+            guild_ids = [row[0] for row in self._db.execute("SELECT DISTINCT guild_id FROM messages")]
+            for guild_id in guild_ids:
+                cutoff = now - self.guild_retention.get(guild_id, self.retention)
+                removed += self._db.execute(
+                    "DELETE FROM messages WHERE guild_id = ? AND created_at < ?", (guild_id, cutoff)
+                ).rowcount
+                removed += self._db.execute(
+                    "DELETE FROM messages WHERE guild_id = ? AND id < ("
+                    "SELECT id FROM messages WHERE guild_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?"
+                    ")",
+                    (guild_id, guild_id, self.max_messages_per_guild - 1),
+                ).rowcount
+            self._db.execute("PRAGMA incremental_vacuum")
+        return removed
+
+    async def compact(self) -> None:
+        """Removes messages that are past their guild's retention period, or beyond the per-guild limit."""
+        await self.flush()
+        removed = await asyncio.to_thread(self._compact)
+        self.compacted += removed
+        self._last_compaction = time.monotonic()
+        log.info("Compacted %d messages out of the message store.", removed)
+
+    def _forget(self, guild_id: int) -> int:
+        with self._db_lock:
+            return self._db.execute("DELETE FROM messages WHERE guild_id = ?", (guild_id,)).rowcount
+
+    async def forget(self, guild_id: int) -> None:
+        """Removes every message from a guild, e.g. when the bot is removed from it."""
+        await self.flush()
+        self.compacted += await asyncio.to_thread(self._forget, guild_id)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - self._last_compaction >= self.compact_interval:
+                try:
+                    await self.compact()
+                except sqlite3.Error as e:
+                    log.error("Failed to compact the message store.", exc_info=e)
+
+    def start(self) -> None:
+        """Starts flushing and compacting in the background."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stops the background task, writes out anything still queued, and closes the database."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "pending_writes": len(self._pending),
+            "stored": self.stored,
+            "updated": self.updated,
+            "removed": self.removed,
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "compacted": self.compacted,
+        }
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import typing
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+__all__ = ("TemplateRegistry", "templates")
+log = logging.getLogger(__name__)
+
+
+class TemplateRegistry:
+    """
+    Loads, compiles and caches the HTML templates (and stylesheet) in the assets directory.
+
+    Templates are compiled once, and only recompiled when their file's modification time changes. Compiled bytecode
+    is additionally cached on disk, so a restart does not need to recompile unchanged templates either.
+    """
+
+    def __init__(self, directory: str | os.PathLike = "assets", *, stylesheet: str = "style.css"):
+        self.directory = Path(directory)
+        self.stylesheet = stylesheet
+        self.environment = Environment(
+            loader=FileSystemLoader(self.directory),
+            auto_reload=True,
+            bytecode_cache=FileSystemBytecodeCache(),
+        )
+        self._css: dict[bool, tuple[float, str]] = {}
+        self._css_lock = threading.Lock()
+
+        self.renders = 0
+        self.css_loads = 0
+        self._render_time_total = 0.0
+
+    def __repr__(self):
+        return "<TemplateRegistry directory={0.directory!r} renders={0.renders}>".format(self)
+
+    def get(self, name: str) -> Template:
+        """Returns the compiled template with the given file name, compiling it if it is new or has changed."""
+        return self.environment.get_template(name)
+
+    def css(self, minify: bool = True) -> str:
+        """Returns the contents of the stylesheet, re-reading it only if it has changed."""
+        path = self.directory / self.stylesheet
+        mtime = path.stat().st_mtime
+        cached = self._css.get(minify)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with self._css_lock:
+            text = path.read_text()
+            if minify:
+                text = re.sub(r"\s+", "", text)
+            self._css[minify] = (mtime, text)
+            self.css_loads += 1
+        return text
+
+    def render(self, name: str, **kwargs) -> str:
+        """
+        Renders a template. `css` defaults to the minified stylesheet.
+
+        This is CPU-bound, so should not be called from the event loop - see :meth:`render_async`.
+        """
+        kwargs.setdefault("css", self.css(True))
+        start = time.perf_counter()
+        result = self.get(name).render(**kwargs)
+        self.renders += 1
+        self._render_time_total += time.perf_counter() - start
+        return result
+
+    def generate(self, name: str, **kwargs) -> typing.Iterator[str]:
+        """
+        Renders a template piece by piece, so the output can be written out as it is produced.
+
+        Like :meth:`render`, this should not be iterated on the event loop.
+        """
+        kwargs.setdefault("css", self.css(True))
+        self.renders += 1
+        return self.get(name).generate(**kwargs)
+
+    async def render_async(self, name: str, **kwargs) -> str:
+        """Renders a template in a worker thread, so large renders do not block the event loop."""
+        return await asyncio.to_thread(self.render, name, **kwargs)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "renders": self.renders,
+            "render_time_avg_ms": round(self._render_time_total / self.renders * 1000, 2) if self.renders else 0.0,
+            "css_loads": self.css_loads,
+        }
+
+
+templates = TemplateRegistry()
@@ -0,0 +1,337 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import time
+import tracemalloc
+import typing
+import zipfile
+from base64 import b64encode
+
+import discord
+
+from .templates import TemplateRegistry, templates
+
+__all__ = (
+    "AttachmentArchiver",
+    "AttachmentBudget",
+    "archiver",
+    "attachment_budget",
+    "message_context",
+    "TranscriptBuilder",
+)
+log = logging.getLogger(__name__)
+
+MAX_ATTACHMENT_SIZE = 1024 * 1024 * 2
+# Rough sizes of the HTML surrounding each message, and each document, used to work out the attachment budget.
+MESSAGE_OVERHEAD = 4096
+DOCUMENT_OVERHEAD = 16384
+# Leaves some room for the rest of the multipart request when checking against the guild's upload limit.
+SIZE_LIMIT_HEADROOM = 8192
+
+
+class AttachmentBudget:
+    """
+    A byte budget for embedded attachments that is shared by several documents, e.g. every transcript of one purge.
+
+    :param remaining: How many (base64-encoded) bytes of attachments may still be stored.
+    """
+
+    def __init__(self, remaining: int):
+        self.remaining = remaining
+
+    def __repr__(self):
+        return "<AttachmentBudget remaining={0.remaining}>".format(self)
+
+
+class AttachmentArchiver:
+    """
+    Downloads attachments of deleted messages, so they can be embedded into HTML documents.
+
+    Downloads are limited to `concurrency` at a time across the whole process, and each document gets a byte budget:
+    once the budget is spent, any further attachments are skipped rather than downloaded. Attachments with identical
+    contents are only stored once, keyed by their hash.
+
+    :param concurrency: How many attachments may be downloaded at once.
+    :param max_attachment_size: Attachments larger than this many bytes are never downloaded.
+    """
+
+    def __init__(self, *, concurrency: int = 4, max_attachment_size: int = MAX_ATTACHMENT_SIZE):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_attachment_size = max_attachment_size
+
+        self.downloaded = 0
+        self.bytes_downloaded = 0
+        self.deduplicated = 0
+        self.skipped_budget = 0
+        self.skipped_size = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return "<AttachmentArchiver downloaded={0.downloaded} deduplicated={0.deduplicated}>".format(self)
+
+    @staticmethod
+    def encoded_size(size: int) -> int:
+        """The size of `size` bytes once base64-encoded."""
+        return 4 * math.ceil(size / 3)
+
+    async def _download(self, attachment: discord.Attachment) -> bytes | None:
+        async with self.semaphore:
+            log.debug("Downloading %r", attachment)
+            try:
+                data = await attachment.read()
+            except discord.HTTPException as e:
+                log.warning("Failed to download %r: %s", attachment, e, exc_info=e)
+                self.failed += 1
+                return
+        self.downloaded += 1
+        self.bytes_downloaded += len(data)
+        return data
+
+    async def archive(
+        self, messages: typing.Iterable[discord.Message], *, budget: int, shared: AttachmentBudget | None = None
+    ) -> tuple[list[dict[str, str]], dict[str, str]]:
+        """
+        Downloads the attachments of the given messages, within a budget.
+
+        :param messages: The messages whose attachments should be downloaded.
+        :param budget: The total number of (base64-encoded) bytes that may be stored.
+        :param shared: A budget shared with other documents, which this document's attachments are also taken from.
+        :return: For each message, a mapping of its attachments' file names to their hashes, and a mapping of hashes
+        to the base64-encoded contents.
+        """
+        messages = list(messages)
+        # Attachment ID -> attachment. The same attachment (e.g. a message included twice) is only downloaded, and
+        # paid for, once.
+        wanted: dict[int, discord.Attachment] = {}
+        skipped: set[int] = set()
+        placements: list[tuple[int, discord.Attachment]] = []
+        # Reserve the budget up front, in message order, so that nothing is downloaded just to be thrown away.
+        remaining = budget if shared is None else min(budget, shared.remaining)
+        reserved = remaining
+        for n, message in enumerate(messages):
+            for attachment in message.attachments:
+                if attachment.id in wanted:
+                    self.deduplicated += 1
+                    placements.append((n, attachment))
+                    continue
+                if attachment.id in skipped:
+                    continue
+                if attachment.size > self.max_attachment_size:
+                    self.skipped_size += 1
+                    skipped.add(attachment.id)
+                    continue
+                cost = self.encoded_size(attachment.size)
+                if cost > remaining:
+                    self.skipped_budget += 1
+                    skipped.add(attachment.id)
+                    continue
+                remaining -= cost
+                wanted[attachment.id] = attachment
+                placements.append((n, attachment))
+        reserved -= remaining
+        if shared is not None:
+            shared.remaining -= reserved
+
+        results = await asyncio.gather(*map(self._download, wanted.values()))
+        # Different attachments may still have identical contents, so are stored by their hash.
+        digests: dict[int, str] = {}
+        blobs: dict[str, str] = {}
+        for attachment, data in zip(wanted.values(), results):
+            if data is None:
+                continue
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in blobs:
+                self.deduplicated += 1
+            else:
+                blobs[digest] = b64encode(data).decode()
+            digests[attachment.id] = digest
+        references: list[dict[str, str]] = [{} for _ in messages]
+        for n, attachment in placements:
+            if attachment.id in digests:
+                references[n][attachment.filename] = digests[attachment.id]
+        if shared is not None:
+            # Failed downloads, and duplicates, did not use what was reserved for them.
+            shared.remaining += reserved - sum(map(len, blobs.values()))
+        return references, blobs
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "downloaded": self.downloaded,
+            "bytes_downloaded": self.bytes_downloaded,
+            "deduplicated": self.deduplicated,
+            "skipped_budget": self.skipped_budget,
+            "skipped_size": self.skipped_size,
+            "failed": self.failed,
+        }
+
+
+archiver = AttachmentArchiver()
+
+
+def attachment_budget(messages: typing.Iterable[discord.Message], size_limit: int) -> int:
+    """
+    Estimates how many bytes of embedded attachments a document of the given messages can hold within `size_limit`.
+    """
+    text_size = sum(MESSAGE_OVERHEAD + 2 * len(message.content.encode()) for message in messages)
+    return max(0, size_limit - DOCUMENT_OVERHEAD - text_size)
+
+
+def message_context(message: discord.Message, cached_attachments: dict[str, str]) -> dict[str, typing.Any]:
+    """
+    Builds the template variables used to render a single message (see `assets/_message.html`).
+
+    :param message: The message
+    :param cached_attachments: A mapping of the message's stored attachments' file names to their hashes.
+    """
+    embeds = [embed.to_dict() for embed in message.embeds]
+    for n, embed in enumerate(embeds, start=1):
+        embed.setdefault("title", "Untitled Embed %d" % n)
+    return dict(
+        message=message,
+        created_at=message.created_at.isoformat(),
+        edited_at=message.edited_at.isoformat() if message.edited_at else "N/A",
+        embeds=[json.dumps(embed, separators=(",", ":"), default=str, ensure_ascii=False) for embed in embeds],
+        cached_attachments=cached_attachments,
+    )
+
+
+class TranscriptBuilder:
+    """
+    Renders many messages into a single HTML transcript.
+
+    Attachments are only embedded while they fit into the guild's upload limit, see :class:`AttachmentArchiver`.
+    Rendering (and compression) happens in a worker thread. If the transcript is still too large to upload, it is
+    compressed into a zip file, and as a last resort, rendered again without the embedded attachments.
+
+    :param compression: "auto" to only compress transcripts that would otherwise be too large, "zip" or "gzip" to
+    always compress, or "none" to never compress.
+    :param trace_memory: Whether to record the peak memory allocated while rendering, using :mod:`tracemalloc`.
+    This slows down every allocation in the process while enabled, so should only be used for measurements. As other
+    threads allocate too, the figure is an upper bound.
+    """
+
+    template = "bulk-delete-transcript.html"
+
+    def __init__(
+        self,
+        registry: TemplateRegistry = templates,
+        attachments: AttachmentArchiver = archiver,
+        *,
+        compression: typing.Literal["auto", "zip", "gzip", "none"] = "auto",
+        trace_memory: bool = False,
+    ):
+        if compression not in ("auto", "zip", "gzip", "none"):
+            raise ValueError("Unknown transcript compression %r." % compression)
+        self.registry = registry
+        self.attachments = attachments
+        self.compression = compression
+        self.trace_memory = trace_memory
+
+        self.builds = 0
+        self.messages = 0
+        self.bytes_out = 0
+        self.compressed = 0
+        self.attachments_dropped = 0
+        self._build_time_total = 0.0
+        self._build_time_max = 0.0
+        self._peak_memory_max = 0
+
+    def __repr__(self):
+        return "<TranscriptBuilder compression={0.compression!r} builds={0.builds}>".format(self)
+
+    def _stream(self, context: dict[str, typing.Any]) -> bytes:
+        buffer = io.BytesIO()
+        for chunk in self.registry.generate(self.template, **context):
+            buffer.write(chunk.encode("utf-8", "replace"))
+        return buffer.getvalue()
+
+    def _compress(self, data: bytes, filename: str, size_limit: int) -> tuple[bytes, str]:
+        mode = self.compression
+        if mode == "auto":
+            mode = "zip" if len(data) > size_limit else "none"
+        if mode == "none":
+            return data, filename
+        self.compressed += 1
+        if mode == "gzip":
+            return gzip.compress(data), filename + ".gz"
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(filename, data)
+        return buffer.getvalue(), filename.rsplit(".", 1)[0] + ".zip"
+
+    def _render(self, context: dict[str, typing.Any], filename: str, size_limit: int) -> tuple[bytes, str]:
+        data, name = self._compress(self._stream(context), filename, size_limit)
+        if len(data) > size_limit and context["attachment_blobs"]:
+            log.warning("Rendered transcript was too big (%d bytes), removing cached attachments.", len(data))
+            for entry in context["entries"]:
+                self.attachments_dropped += len(entry["cached_attachments"])
+                entry["cached_attachments"] = {}
+            context["attachment_blobs"] = {}
+            data, name = self._compress(self._stream(context), filename, size_limit)
+        return data, name
+
+    def _render_traced(self, context: dict[str, typing.Any], filename: str, size_limit: int) -> tuple[bytes, str]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        result = self._render(context, filename, size_limit)
+        peak = tracemalloc.get_traced_memory()[1]
+        self._peak_memory_max = max(self._peak_memory_max, peak)
+        log.debug("Rendering %s peaked at %d bytes.", filename, peak)
+        return result
+
+    async def build(
+        self, messages: list[discord.Message], *, filename: str, budget: AttachmentBudget | None = None
+    ) -> discord.File:
+        """
+        Builds a transcript of the given messages.
+
+        :param messages: The messages to include. These must all be from the same channel.
+        :param filename: The name of the (uncompressed) HTML file.
+        :param budget: An attachment budget shared with other transcripts, e.g. the other chunks of a bulk delete.
+        :return: The transcript, ready to be uploaded.
+        """
+        start = time.perf_counter()
+        channel = messages[0].channel
+        size_limit = channel.guild.filesize_limit - SIZE_LIMIT_HEADROOM
+        references, blobs = await self.attachments.archive(
+            messages, budget=attachment_budget(messages, size_limit), shared=budget
+        )
+        context = dict(
+            entries=[message_context(message, attachments) for message, attachments in zip(messages, references)],
+            attachment_blobs=blobs,
+            channel=channel,
+            guild=channel.guild,
+            now=discord.utils.utcnow().isoformat(),
+        )
+        render = self._render_traced if self.trace_memory else self._render
+        data, filename = await asyncio.to_thread(render, context, filename, size_limit)
+
+        elapsed = time.perf_counter() - start
+        self.builds += 1
+        self.messages += len(messages)
+        self.bytes_out += len(data)
+        self._build_time_total += elapsed
+        self._build_time_max = max(self._build_time_max, elapsed)
+        log.debug(
+            "Built transcript %s of %d messages (%d bytes) in %.2fs.", filename, len(messages), len(data), elapsed
+        )
+        return discord.File(io.BytesIO(data), filename=filename, description="The deleted messages in HTML format.")
+
+    def stats(self) -> dict[str, int | float]:
+        stats = {
+            "builds": self.builds,
+            "messages": self.messages,
+            "bytes_out": self.bytes_out,
+            "compressed": self.compressed,
+            "attachments_dropped": self.attachments_dropped,
+            "build_time_avg_ms": round(self._build_time_total / self.builds * 1000, 2) if self.builds else 0.0,
+            "build_time_max_ms": round(self._build_time_max * 1000, 2),
+        }
+        if self.trace_memory:
+            stats["peak_memory_max_bytes"] = self._peak_memory_max
+        return stats
@@ -1,20 +1,16 @@
-import asyncio
-import io
-import json
 import logging
-import re
 import textwrap
-from base64 import b64encode
-from pathlib import Path
 from typing import Any, Iterable, Literal
 from urllib.parse import urlparse
 
 import discord
 from discord.ext import bridge, commands
-from jinja2 import Template
 
+from .cache import log_feature_cache
 from .data import boolean_emojis
 from .database import GuildLogFeatures, Premium
+from .templates import templates
+from .transcripts import SIZE_LIMIT_HEADROOM, archiver, attachment_budget, message_context
 
 __all__ = [
     "get_bool_emoji",
@@ -96,6 +92,9 @@ async def get_log_channel(bot: bridge.Bot, guild_id: int, log_feature: str) -> d
     """
     Fetches the log channel for a guild, where the given log feature is enabled.
 
+    The feature's state and the guild's log channel are cached in :data:`~spanner.share.cache.log_feature_cache`,
+    so a warm lookup does not touch the database.
+
     :param bot: The bot instance
     :type bot: bridge.Bot
     :param guild_id: The guild ID
@@ -105,15 +104,22 @@ async def get_log_channel(bot: bridge.Bot, guild_id: int, log_feature: str) -> d
     :return: The log channel, if found and available
     :rtype: discord.abc.Messageable | None
     """
-    lfn = log_feature
-    log_feature = await GuildLogFeatures.get_or_none(guild_id=guild_id, name=log_feature)
-    if not log_feature or log_feature.enabled is False:
-        log.debug("%r does not have the feature %r enabled.", guild_id, lfn)
-        return
+    cached = log_feature_cache.get(guild_id, log_feature)
+    if cached is None:
+        generation = log_feature_cache.generation(guild_id)
+        feature = await GuildLogFeatures.filter(guild_id=guild_id, name=log_feature).select_related("guild").first()
+        if feature is None:
+            cached = (False, None)
+        else:
+            cached = (feature.enabled, feature.guild.log_channel)
+        log_feature_cache.set(guild_id, log_feature, *cached, generation=generation)
 
-    await log_feature.fetch_related("guild")
+    enabled, log_channel_id = cached
+    if enabled is False:
+        log.debug("%r does not have the feature %r enabled.", guild_id, log_feature)
+        return
 
-    log_channel = bot.get_channel(log_feature.guild.log_channel)
+    log_channel = bot.get_channel(log_channel_id) if log_channel_id else None
     if not log_channel or not log_channel.can_send(discord.Embed, discord.File):
         log.debug("%rs log channel is missing or blocked.", guild_id)
         return
@@ -121,73 +127,25 @@ async def get_log_channel(bot: bridge.Bot, guild_id: int, log_feature: str) -> d
     return log_channel
 
 
-def _get_css(minify: bool = False) -> str:
-    with open("assets/style.css") as f:
-        t = f.read()
-    if not minify:
-        return t
-    t = re.sub(r"\s+", "", t)
-    return t
-
-
 async def format_html(message: discord.Message):
-    with open(Path.cwd() / "assets" / "bulk-delete.html") as f:
-        template = Template(f.read())
-    embeds = [embed.to_dict() for embed in message.embeds]
-    for n, embed in enumerate(embeds, start=1):
-        embed.setdefault("title", "Untitled Embed %d" % n)
-    embeds = [json.dumps(embed, separators=(",", ":"), default=str, ensure_ascii=False) for embed in embeds]
-
-    async def download_attachment(att: discord.Attachment) -> tuple[discord.Attachment, str] | tuple[None, None]:
-        bio = io.BytesIO()
-        try:
-            log.info("Downloading %r", att)
-            await att.save(bio)
-        except discord.HTTPException as e:
-            log.warning("Failed to download %r: %s", att, e, exc_info=e)
-            return None, None
-        else:
-            bio.seek(0)
-            return att, b64encode(bio.getvalue()).decode()
-
-    attachments = {}
-    tasks = []
-    for attachment in message.attachments:
-        if attachment.size <= 1024 * 1024 * 2:
-            log.debug("Adding %r to the download queue.", attachment)
-            tasks.append(download_attachment(attachment))
-    if tasks:
-        log.debug("Waiting for %d downloads", len(tasks))
-        for result in await asyncio.gather(*tasks):
-            _attachment, _data = result
-            if not _attachment:
-                continue
-            attachments[_attachment.filename] = _data
-        log.debug("Downloads finished.")
-
-    kwargs = dict(
-        message=message,
-        created_at=message.created_at.isoformat(),
-        edited_at=message.edited_at.isoformat() if message.edited_at else "N/A",
-        embeds=embeds,
-        cached_attachments=attachments,
-        now=discord.utils.utcnow().isoformat(),
-        css=_get_css(True),
-    )
-    r = template.render(**kwargs)
-    if len(r) >= (message.guild.filesize_limit - 8192):
-        log.warning("Rendered template was too big, removing cached attachments.")
-        kwargs["cached_attachments"] = {}
-        return template.render(**kwargs)
-    return r
+    size_limit = message.guild.filesize_limit - SIZE_LIMIT_HEADROOM
+    (references,), blobs = await archiver.archive([message], budget=attachment_budget([message], size_limit))
+    kwargs = message_context(message, references)
+    kwargs["attachment_blobs"] = blobs
+    kwargs["now"] = discord.utils.utcnow().isoformat()
+    return await templates.render_async("bulk-delete.html", **kwargs)
 
 
 def format_template(template: str, **kwargs) -> str:
-    p = Path("assets") / template
-    if p.exists():
-        template = p.read_text()
-    kwargs.setdefault("css", _get_css(True))
-    return Template(template).render(**kwargs)
+    """
+    Renders a template from the assets directory, or, if no such file exists, the given template source.
+
+    :param template: The template's file name, or its source.
+    """
+    if (templates.directory / template).exists():
+        return templates.render(template, **kwargs)
+    kwargs.setdefault("css", templates.css(True))
+    return templates.environment.from_string(template).render(**kwargs)
 
 
 async def entitled_to_premium(
@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+from tortoise import Tortoise
+
+
+@pytest.fixture
+def run():
+    """Runs a coroutine function against a fresh, in-memory database."""
+
+    def runner(func):
+        async def main():
+            await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["spanner.share.database"]})
+            await Tortoise.generate_schemas()
+            try:
+                return await func()
+            finally:
+                await Tortoise.close_connections()
+
+        return asyncio.run(main())
+
+    return runner
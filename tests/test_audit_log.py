@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+
+import pytest
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+
+from spanner.share.audit_log_retention import AuditLogRetention
+from spanner.share.database import AuditLogSnapshot, GuildAuditLogEntry, GuildConfig, audit_log_writer
+
+
+async def _entry(target, metadata: dict) -> GuildAuditLogEntry:
+    snapshot = AuditLogSnapshot.from_data(target)
+    await AuditLogSnapshot.bulk_create([snapshot], ignore_conflicts=True)
+    return await GuildAuditLogEntry.create(
+        guild_id=1,
+        author=2,
+        namespace="command",
+        action="prune",
+        description="test",
+        metadata=metadata,
+        version=5,
+        target_hash=snapshot.hash,
+    )
+
+
+def test_rehydrate_restores_target(run):
+    async def main():
+        await GuildConfig.create(id=1)
+        await _entry({"id": "3", "name": "general"}, {})
+        entry = await GuildAuditLogEntry.get()
+        await GuildAuditLogEntry.rehydrate([entry])
+        assert entry.metadata["target"] == {"id": "3", "name": "general"}
+
+    run(main)
+
+
+def test_rehydrate_keeps_prune_messages(run):
+    async def main():
+        await GuildConfig.create(id=1)
+        # Prune logs the channel as its target, but stores the pruned messages in metadata["target"].
+        messages = [{"id": "10", "content": "a"}, {"id": "11", "content": "b"}]
+        await _entry({"id": "3", "name": "general"}, {"target": messages, "deleted": 2})
+        entry = await GuildAuditLogEntry.get()
+        await GuildAuditLogEntry.rehydrate([entry])
+        assert entry.metadata["target"] == messages
+
+    run(main)
+
+
+def test_orphaned_snapshots_are_deleted(run):
+    async def main():
+        await GuildConfig.create(id=1)
+        kept = (await _entry({"id": "3"}, {})).target_hash
+        orphan = AuditLogSnapshot.from_data({"id": "4"})
+        await AuditLogSnapshot.bulk_create([orphan])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await AuditLogSnapshot.all().update(created_at=now - datetime.timedelta(days=2))
+
+        deleted = await AuditLogRetention()._delete_orphaned_snapshots(now - datetime.timedelta(days=1))
+        assert deleted == 1
+        assert await AuditLogSnapshot.all().values_list("hash", flat=True) == [kept]
+
+    run(main)
+
+
+def test_wait_raises_when_the_entry_cannot_be_written(run):
+    async def main():
+        await GuildConfig.create(id=1)
+        before = timezone.now()
+        entry = await GuildAuditLogEntry.generate(
+            1, 2, "test", "create", "written", {"action.historical": "created"}, wait=True
+        )
+        assert (await GuildAuditLogEntry.get(id=entry.id)).created_at >= before
+
+        # The guild does not exist, so the entry's batch (and the retry) fail.
+        with pytest.raises(IntegrityError):
+            await GuildAuditLogEntry.generate(
+                404, 2, "test", "create", "not written", {"action.historical": "created"}, wait=True
+            )
+        assert await GuildAuditLogEntry.all().count() == 1
+
+    run(main)
+
+
+def test_created_at_is_set_when_queued(run):
+    async def main():
+        await GuildConfig.create(id=1)
+        entry = await GuildAuditLogEntry.generate(1, 2, "test", "create", "queued", {"action.historical": "created"})
+        queued_at = entry.created_at
+        assert queued_at is not None
+        await asyncio.sleep(0.01)
+        await audit_log_writer.flush()
+        assert (await GuildAuditLogEntry.get(id=entry.id)).created_at == queued_at
+
+    run(main)
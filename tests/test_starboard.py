@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from spanner.cogs.starboard import StarboardCog
+
+
+@pytest.fixture
+def cog(tmp_path, monkeypatch):
+    (tmp_path / "config.toml").write_text('[spanner]\ntoken = "x"\n')
+    monkeypatch.chdir(tmp_path)
+    return StarboardCog(bot=None)
+
+
+def _message(stars: int):
+    reaction = SimpleNamespace(emoji="\N{WHITE MEDIUM STAR}", count=stars, me=False)
+    return SimpleNamespace(id=2, channel=SimpleNamespace(id=1), reactions=[reaction])
+
+
+def _payload(event_type: str = "REACTION_ADD"):
+    return SimpleNamespace(channel_id=1, message_id=2, emoji="\N{WHITE MEDIUM STAR}", event_type=event_type)
+
+
+def test_queued_adds_are_not_counted_twice(cog):
+    first, second = _payload(), _payload()
+    first_event = cog.receive_reaction_event(first)
+    second_event = cog.receive_reaction_event(second)
+    # Both adds have been applied to the cached message by the time the first one is handled.
+    message = _message(2)
+
+    assert cog.update_star_count(message, first, None, first_event) == 2
+    assert cog.update_star_count(message, second, None, second_event) == 2
+
+    third = _payload()
+    assert cog.update_star_count(_message(3), third, None, cog.receive_reaction_event(third)) == 3
+    removed = _payload("REACTION_REMOVE")
+    assert cog.update_star_count(_message(2), removed, None, cog.receive_reaction_event(removed)) == 2
+
+
+def test_seeded_from_entry(cog):
+    first, second = _payload(), _payload()
+    first_event = cog.receive_reaction_event(first)
+    second_event = cog.receive_reaction_event(second)
+    entry = SimpleNamespace(star_count=5)
+
+    # A persisted count does not include any of the queued events.
+    assert cog.update_star_count(_message(7), first, entry, first_event) == 6
+    assert cog.update_star_count(_message(7), second, None, second_event) == 7
+
+
+def test_uncounted_entry_is_seeded_from_reactions(cog):
+    # Entries from before star counts were stored have not been counted yet.
+    entry = SimpleNamespace(star_count=None)
+    added, removed = _payload(), _payload("REACTION_REMOVE")
+    added_event = cog.receive_reaction_event(added)
+    removed_event = cog.receive_reaction_event(removed)
+
+    # Both events are already reflected in the message's reactions.
+    assert cog.update_star_count(_message(7), added, entry, added_event) == 7
+    assert cog.update_star_count(_message(7), removed, entry, removed_event) == 7
+
+    third = _payload()
+    assert cog.update_star_count(_message(8), third, None, cog.receive_reaction_event(third)) == 8